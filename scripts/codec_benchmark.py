@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+"""Benchmarks the xml codecs supported by pydynamo on real
+configuration/data files.
+
+Usage: codec_benchmark.py FILE [FILE ...]
+
+Each file is decompressed (with whatever codec it was written with),
+then re-encoded and decoded with every codec whose python module is
+installed. The encode/decode rates are reported in MB/s of
+uncompressed xml, along with the compression ratio.
+"""
+import sys, time
+import pydynamo
+
+def best_time(f, repeats=3):
+    """Returns the result and the fastest wall time of repeats calls of f"""
+    best = float('inf')
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = f()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    print("{:<40} {:>6} {:>10} {:>8} {:>12} {:>12}".format("File", "Codec", "Size (MB)", "Ratio", "Enc. (MB/s)", "Dec. (MB/s)"))
+    for filename in sys.argv[1:]:
+        f = pydynamo.open_xml_stream(filename)
+        raw = f.read()
+        f.close()
+        MB = len(raw) / 1e6
+
+        for name, codec in pydynamo.xml_codecs.items():
+            try:
+                compressed, enc_time = best_time(lambda : codec['compress'](raw))
+                decompressed, dec_time = best_time(lambda : codec['decompress'](compressed))
+            except ImportError as e:
+                print("{:<40} {:>6} skipped ({})".format(filename[-40:], name, e))
+                continue
+            if decompressed != raw:
+                raise RuntimeError('Codec "'+name+'" failed to round trip "'+filename+'"')
+            print("{:<40} {:>6} {:>10.2f} {:>8.2f} {:>12.1f} {:>12.1f}".format(filename[-40:], name, MB, len(raw) / len(compressed), MB / max(enc_time, 1e-9), MB / max(dec_time, 1e-9)))
@@ -13,7 +13,7 @@ point.
 # Include everything "standard" in here. Try to keep external
 # dependencies only imported when they are used, so this can be
 # easilly deployed on a cluster.
-import os, glob, sys, time, math, subprocess, bz2, alive_progress, scipy
+import os, io, re, glob, sys, time, math, subprocess, bz2, json, sqlite3, abc, uuid, alive_progress, scipy
 
 from multiprocessing import Pool, cpu_count
 
@@ -55,24 +55,576 @@ def conv_to_14sf(f):
     else:
         return f
 
+# ###############################################
+# #        Parallel multi-stream bzip2          #
+# ###############################################
+#
+# A bzip2 file may be a concatenation of independent streams (this is
+# what pbzip2 writes, and dynarun/XMLFile.save now write too). Each
+# stream can be decompressed on its own, so we spread them over a
+# thread pool (the bz2 module releases the GIL while it works).
+
+#The uncompressed size of each stream written
+bz2_stream_size = 900000
+
+#The start of a bz2 stream, the "BZh" header then the block magic
+#number (pi). An empty stream is not matched, but we never write one.
+bz2_stream_header = re.compile(rb'BZh[1-9]\x31\x41\x59\x26\x53\x59')
+
+def compression_threads():
+    if XMLFile.compression_threads is None:
+        return cpu_count()
+    return XMLFile.compression_threads
+
+def compress_bz2_parallel(data, level=9):
+    """Compresses data into a pbzip2 compatible multi-stream bz2 file"""
+    chunks = [data[i:i+bz2_stream_size] for i in range(0, len(data), bz2_stream_size)] or [b'']
+    if len(chunks) == 1:
+        return bz2.compress(data, level)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(min(len(chunks), compression_threads())) as executor:
+        return b''.join(executor.map(lambda chunk : bz2.compress(chunk, level), chunks))
+
+def bz2_stream_offsets(data):
+    """Returns the (start, end) offsets of the candidate streams in a
+    bz2 file. These are only candidates, as the header could turn up
+    by chance inside the compressed data."""
+    starts = [m.start() for m in bz2_stream_header.finditer(data)]
+    if not starts or starts[0] != 0:
+        return []
+    return list(zip(starts, starts[1:] + [len(data)]))
+
+def decompress_bz2_stream(segment):
+    """Decompresses exactly one bz2 stream, raising if the segment is
+    not one complete stream."""
+    decompressor = bz2.BZ2Decompressor()
+    out = decompressor.decompress(segment)
+    if not decompressor.eof or decompressor.unused_data:
+        raise ValueError("Segment is not a single bz2 stream")
+    return out
+
+class ParallelBZ2Reader(io.RawIOBase):
+    """A readable stream over a multi-stream bz2 file, where the
+    streams are decompressed in parallel but handed out in order.
+    Only a window of a few streams per thread is held decompressed at
+    any time, so this can feed an incremental parser."""
+
+    def __init__(self, data, offsets, threads=None):
+        from concurrent.futures import ThreadPoolExecutor
+        import collections
+        self._data = data
+        self._segments = iter(offsets)
+        self._threads = threads if threads is not None else compression_threads()
+        self._executor = ThreadPoolExecutor(self._threads)
+        self._pending = collections.deque()
+        self._buffer = b''
+        self._pos = 0
+        for _ in range(2 * self._threads):
+            self._submit()
+
+    def _submit(self):
+        segment = next(self._segments, None)
+        if segment is not None:
+            start, end = segment
+            self._pending.append((start, self._executor.submit(decompress_bz2_stream, self._data[start:end])))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._pos >= len(self._buffer):
+            if not self._pending:
+                return 0
+            start, future = self._pending.popleft()
+            try:
+                self._buffer = future.result()
+                self._submit()
+            except (ValueError, OSError, EOFError):
+                #A false stream header split a stream, just decompress
+                #the rest of the file serially.
+                for _, pending in self._pending:
+                    pending.cancel()
+                self._pending.clear()
+                self._segments = iter([])
+                self._buffer = bz2.decompress(self._data[start:])
+            self._pos = 0
+        n = min(len(b), len(self._buffer) - self._pos)
+        b[:n] = self._buffer[self._pos:self._pos+n]
+        self._pos += n
+        return n
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._data = None
+        super().close()
+
+def open_bz2_stream(filename):
+    """Opens a bz2 file, decompressing in parallel if it is made up of
+    multiple streams."""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    offsets = bz2_stream_offsets(data)
+    if len(offsets) > 1 and compression_threads() > 1:
+        return io.BufferedReader(ParallelBZ2Reader(data, offsets), buffer_size=1 << 20)
+    return bz2.BZ2File(io.BytesIO(data))
+
+# ###############################################
+# #           Compression codecs                #
+# ###############################################
+#
+# Each codec is described by its file extension, the magic bytes at
+# the start of its files, and functions to open a file as a
+# decompressed stream, and to compress/decompress a bytes object. The
+# python modules for zstd (zstandard) and lz4 are only imported when
+# those codecs are used.
+def open_zstd_stream(filename):
+    import zstandard
+    return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True, closefd=True)
+
+def compress_zstd(data):
+    import zstandard
+    threads = compression_threads()
+    return zstandard.ZstdCompressor(level=3, threads=threads if threads > 1 else 0).compress(data)
+
+def decompress_zstd(data):
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+def open_lz4_stream(filename):
+    import lz4.frame
+    return lz4.frame.open(filename, 'rb')
+
+def compress_lz4(data):
+    import lz4.frame
+    return lz4.frame.compress(data)
+
+def decompress_lz4(data):
+    import lz4.frame
+    return lz4.frame.decompress(data)
+
+def open_gzip_stream(filename):
+    import gzip
+    return gzip.open(filename, 'rb')
+
+def compress_gzip(data):
+    import gzip
+    return gzip.compress(data, compresslevel=6)
+
+def decompress_gzip(data):
+    import gzip
+    return gzip.decompress(data)
+
+xml_codecs = {}
+xml_codecs['bz2'] = {'ext':'.xml.bz2', 'magic':b'BZh', 'open':open_bz2_stream, 'compress':compress_bz2_parallel, 'decompress':bz2.decompress}
+xml_codecs['zstd'] = {'ext':'.xml.zst', 'magic':b'\x28\xb5\x2f\xfd', 'open':open_zstd_stream, 'compress':compress_zstd, 'decompress':decompress_zstd}
+xml_codecs['lz4'] = {'ext':'.xml.lz4', 'magic':b'\x04\x22\x4d\x18', 'open':open_lz4_stream, 'compress':compress_lz4, 'decompress':decompress_lz4}
+xml_codecs['gzip'] = {'ext':'.xml.gz', 'magic':b'\x1f\x8b', 'open':open_gzip_stream, 'compress':compress_gzip, 'decompress':decompress_gzip}
+xml_codecs['none'] = {'ext':'.xml', 'magic':None, 'open':lambda filename : open(filename, 'rb'), 'compress':lambda data : data, 'decompress':lambda data : data}
+
+def codec_from_extension(filename):
+    """Returns the name of the codec used by filename, going by its
+    extension, or None if the extension is not a known xml file."""
+    for name, codec in xml_codecs.items():
+        if filename.endswith(codec['ext']):
+            return name
+    return None
+
+def codec_from_magic(data):
+    """Returns the name of the codec of some (compressed) data, going
+    by its magic bytes, or None if no codec matches."""
+    for name, codec in xml_codecs.items():
+        if codec['magic'] is not None and data.startswith(codec['magic']):
+            return name
+    return None
+
+def detect_codec(filename):
+    """Works out the codec of a file from its magic bytes, falling
+    back to its extension (e.g., for uncompressed xml)."""
+    with open(filename, 'rb') as f:
+        codec = codec_from_magic(f.read(4))
+    if codec is None:
+        codec = codec_from_extension(filename)
+    if codec is None:
+        raise RuntimeError('Unknown file type for xml file load "'+filename+'"')
+    return codec
+
+def is_xmlfile(filename):
+    return codec_from_extension(filename) is not None
+
+def find_xmlfile(root):
+    """Returns the existing file named root plus any of the xml codec
+    extensions (e.g., root+".xml.bz2"), or None if none exist."""
+    for codec in xml_codecs.values():
+        if os.path.isfile(root + codec['ext']):
+            return root + codec['ext']
+    return None
+
+def xmlfile_name(root, codec):
+    """The filename to use for root, this is the existing file if
+    there is one (whatever its codec), or a new file using codec."""
+    existing = find_xmlfile(root)
+    if existing is not None:
+        return existing
+    return root + xml_codecs[codec]['ext']
+
+def glob_xmlfiles(dirname, pattern):
+    """Globs for xml files of any codec, pattern is the filename
+    without the extension (e.g., "*.config")."""
+    return [f for f in glob.glob(os.path.join(dirname, pattern + '.xml*')) if is_xmlfile(f)]
+
+def open_xml_stream(filename):
+    """Opens a DynamO xml file for binary reading, decompressing it on
+    the fly with whichever codec it was written with."""
+    return xml_codecs[detect_codec(filename)]['open'](filename)
+
+# ###############################################
+# #          Columnar sidecar cache             #
+# ###############################################
+#
+# Parsing a compressed xml file is slow, so the first time a file is
+# parsed we drop a sidecar next to it. The "X.cache.json" holds the
+# cache key and a flat table of every element's tag and attributes
+# (but no text), and for configuration files "X.cache.npy" holds the
+# particle data as a memory-mappable structured array. The key is the
+# size, mtime, ctime and content hash of the file, so stale sidecars
+# are ignored automatically. The hash is rechecked unless the file was
+# last modified strictly before the sidecar was written, as a rewrite
+# can keep the size and mtime (coarse mtimes on NFS, cp -p, rsync).
+particle_dtype = np.dtype([('ID', np.int64), ('P', np.float64, 3), ('V', np.float64, 3)])
+
+def file_hash(filename):
+    """A fast content hash of a file, used to key the sidecar caches"""
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def flatten_elements(root, skip_children_of=()):
+    """Flattens an element tree into a table of (parent index, tag,
+    attributes) rows in document order. Any text is dropped, as are
+    the children of tags in skip_children_of."""
+    table = []
+    stack = [(root, -1)]
+    while stack:
+        elem, parent = stack.pop()
+        if not isinstance(elem.tag, str):
+            #Comments and processing instructions
+            continue
+        table.append((parent, elem.tag, dict(elem.attrib)))
+        if elem.tag not in skip_children_of:
+            idx = len(table) - 1
+            stack.extend((child, idx) for child in reversed(elem))
+    return table
+
+def unflatten_elements(table):
+    """Rebuilds a text-free ElementTree from a flattened table"""
+    elems = []
+    for parent, tag, attrib in table:
+        if parent < 0:
+            elems.append(ET.Element(tag, attrib))
+        else:
+            elems.append(ET.SubElement(elems[parent], tag, attrib))
+    return ET.ElementTree(elems[0])
+
+def read_sidecar(filename):
+    """Returns the sidecar metadata for filename, or None if there is
+    no sidecar or if it is stale."""
+    try:
+        with open(filename + '.cache.json', 'r') as f:
+            meta = json.load(f)
+            written = os.fstat(f.fileno()).st_mtime_ns
+        st = os.stat(filename)
+    except (OSError, ValueError):
+        return None
+
+    key = meta.get('key', {})
+    if key.get('size') != st.st_size:
+        return None
+    if key.get('mtime') != st.st_mtime_ns or key.get('ctime') != st.st_ctime_ns or st.st_mtime_ns >= written:
+        #The file might have been rewritten since the sidecar, only
+        #trust it if the contents are the same
+        if key.get('hash') != file_hash(filename):
+            return None
+        #Rewriting the sidecar saves checking again next time
+        key['mtime'], key['ctime'] = st.st_mtime_ns, st.st_ctime_ns
+        write_json_atomic(filename + '.cache.json', meta)
+    return meta
+
+def write_sidecar(filename, root, particles=None, elements=None):
+    """Writes the sidecar for filename. The root element is flattened
+    into the attribute table (unless an already flattened table is
+    passed as elements), particles (if given) is a structured array
+    of particle_dtype. Failures to write (e.g., read-only data) are
+    silently ignored, the cache is just an optimisation."""
+    try:
+        st = os.stat(filename)
+        if elements is None:
+            elements = flatten_elements(root, skip_children_of=('ParticleData',))
+        meta = {'key': {'size': st.st_size, 'mtime': st.st_mtime_ns, 'ctime': st.st_ctime_ns, 'hash': file_hash(filename)},
+                'elements': elements,
+                'particles': particles is not None,
+        }
+        if particles is not None:
+            tmpname = filename + '.cache.npy.tmp'
+            with open(tmpname, 'wb') as f:
+                np.save(f, particles)
+            os.replace(tmpname, filename + '.cache.npy')
+        write_json_atomic(filename + '.cache.json', meta)
+    except OSError:
+        pass
+
+def write_json_atomic(filename, data):
+    try:
+        tmpname = filename + '.tmp' + str(os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmpname, filename)
+    except OSError:
+        pass
+
+class SelectiveTreeBuilder:
+    """A parser target which only builds the subtrees rooted at the
+    tags in keep (and the ancestors of those subtrees). Everything
+    else, in particular large text blobs, is dropped as it streams
+    past. The tags and attributes of every element are still recorded
+    in elements, as a flattened table for the sidecar."""
+    def __init__(self, keep, skip_children_of=('ParticleData',)):
+        self._keep = keep
+        self._skip_children_of = skip_children_of
+        self._builder = ET.TreeBuilder()
+        #Stack of [tag, attrib, started in builder, index in elements]
+        self._stack = []
+        #Depth inside a kept subtree
+        self._depth = 0
+        self.elements = []
+
+    def start(self, tag, attrib, *args):
+        attrib = dict(attrib)
+        idx = None
+        if not self._stack:
+            idx = len(self.elements)
+            self.elements.append((-1, tag, attrib))
+        else:
+            ptag, _, _, pidx = self._stack[-1]
+            if pidx is not None and ptag not in self._skip_children_of:
+                idx = len(self.elements)
+                self.elements.append((pidx, tag, attrib))
+        self._stack.append([tag, attrib, False, idx])
+
+        if self._depth or tag in self._keep or len(self._stack) == 1:
+            if self._depth or tag in self._keep:
+                self._depth += 1
+            #Start this element, and any ancestors not yet started
+            for entry in self._stack:
+                if not entry[2]:
+                    self._builder.start(entry[0], entry[1])
+                    entry[2] = True
+
+    def end(self, tag):
+        started = self._stack.pop()[2]
+        if self._depth:
+            self._depth -= 1
+        if started:
+            self._builder.end(tag)
+
+    def data(self, data):
+        if self._depth:
+            self._builder.data(data)
+
+    def close(self):
+        return self._builder.close()
+
+def xpath_root_tag(path):
+    """The tag of the first step of an XPath, e.g. "EventCounters"
+    for './/EventCounters/Entry[@Name="SOCells"]'. Returns None if the
+    first step isn't a plain tag."""
+    tag = path.lstrip('./').split('/')[0].split('[')[0]
+    if tag in ('', '*', '.', '..'):
+        return None
+    return tag
+
+def parse_selective(filename, keep):
+    """Stream parses filename with a SelectiveTreeBuilder, returning
+    the (partial) ElementTree and the flattened table of all elements."""
+    target = SelectiveTreeBuilder(keep)
+    if ET.__name__ == 'lxml.etree':
+        parser = ET.XMLParser(target=target, huge_tree=True)
+        feed, close = parser.feed, parser.close
+    else:
+        #The ElementTree parser splits text at every newline, so use
+        #expat directly where the text can be buffered into far fewer
+        #callbacks
+        from xml.parsers import expat
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.buffer_size = 1 << 20
+        parser.StartElementHandler = target.start
+        parser.EndElementHandler = target.end
+        parser.CharacterDataHandler = target.data
+        feed = lambda chunk : parser.Parse(chunk, False)
+        def close():
+            parser.Parse(b'', True)
+            return target.close()
+    f = open_xml_stream(filename)
+    try:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            feed(chunk)
+    finally:
+        f.close()
+    return ET.ElementTree(close()), target.elements
+
+def load_particle_arrays(filename):
+    """Streams the particle data out of a configuration file into
+    NumPy arrays, without building an element tree.
+
+    The file is parsed incrementally and each <Pt> element is thrown
+    away once it has been copied into the arrays, so the peak memory
+    use is roughly the size of the returned arrays. The arrays are
+    preallocated using the N attribute of the ParticleData tag, older
+    files without it have their arrays grown as they are read.
+
+    Returns a dict holding the particle 'ID's (int64, shape (N,)),
+    positions 'P' and velocities 'V' (float64, shape (N, 3)), and the
+    'SimulationSize' (float64, shape (3,)).
+
+    If a valid sidecar cache exists, the arrays are memory-mapped from
+    it instead, and if not, one is written after parsing.
+    """
+    meta = read_sidecar(filename) if XMLFile.use_cache else None
+    if meta is not None and meta['particles']:
+        try:
+            particles = np.load(filename + '.cache.npy', mmap_mode='r')
+            simsize = unflatten_elements(meta['elements']).find('.//SimulationSize').attrib
+            return {'ID':particles['ID'], 'P':particles['P'], 'V':particles['V'],
+                    'SimulationSize':np.array([float(simsize['x']), float(simsize['y']), float(simsize['z'])])}
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    capacity = 0
+    N = 0
+    ids = np.empty(0, dtype=np.int64)
+    pos = np.empty((0, 3))
+    vel = np.empty((0, 3))
+    simsize = None
+    root = None
+    pdata = None
+
+    f = open_xml_stream(filename)
+    try:
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                if elem.tag == 'ParticleData':
+                    pdata = elem
+                    capacity = int(elem.attrib.get('N', 1024))
+                    ids = np.empty(capacity, dtype=np.int64)
+                    pos = np.empty((capacity, 3))
+                    vel = np.empty((capacity, 3))
+                continue
+
+            if elem.tag == 'Pt':
+                if N == capacity:
+                    #Old file without a particle count, double the storage
+                    capacity = max(2 * capacity, 1024)
+                    ids = np.resize(ids, capacity)
+                    pos = np.resize(pos, (capacity, 3))
+                    vel = np.resize(vel, (capacity, 3))
+                P = elem.find('P').attrib
+                V = elem.find('V').attrib
+                ids[N] = int(elem.attrib.get('ID', N))
+                pos[N] = (float(P['x']), float(P['y']), float(P['z']))
+                vel[N] = (float(V['x']), float(V['y']), float(V['z']))
+                N += 1
+                #Drop the particle from the partially built tree
+                del pdata[:]
+            elif elem.tag == 'SimulationSize':
+                simsize = np.array([float(elem.attrib['x']), float(elem.attrib['y']), float(elem.attrib['z'])])
+    finally:
+        f.close()
+
+    if simsize is None:
+        raise RuntimeError('Could not find the SimulationSize tag in "'+filename+'"')
+
+    if N != capacity:
+        ids, pos, vel = ids[:N].copy(), pos[:N].copy(), vel[:N].copy()
+
+    if XMLFile.use_cache:
+        particles = np.empty(N, dtype=particle_dtype)
+        particles['ID'] = ids
+        particles['P'] = pos
+        particles['V'] = vel
+        write_sidecar(filename, root, particles)
+    return {'ID':ids, 'P':pos, 'V':vel, 'SimulationSize':simsize}
+
+class QueryCache:
+    """Memoizes XPath queries on a tree. Queries of the form
+    './/Tag...' (nearly all of ours) are answered from an index of tag
+    names to elements, built with a single walk of the tree the first
+    time it is needed, rather than searching the whole tree again."""
+    simple_path = re.compile(r'^\.//([A-Za-z_][\w.-]*)((?:[\[/].*)?)$')
+
+    def __init__(self, tree):
+        self.tree = tree
+        self._index = None
+        self._results = {}
+
+    def index(self):
+        if self._index is None:
+            root = self.tree.getroot() if hasattr(self.tree, 'getroot') else self.tree
+            self._index = {}
+            elems = root.iter()
+            #.// only matches the descendants of the root
+            next(elems)
+            for elem in elems:
+                if isinstance(elem.tag, str):
+                    self._index.setdefault(elem.tag, []).append(elem)
+        return self._index
+
+    def findall(self, path):
+        if path not in self._results:
+            match = QueryCache.simple_path.match(path)
+            if match is None:
+                self._results[path] = self.tree.findall(path)
+            else:
+                tag, rest = match.groups()
+                candidates = self.index().get(tag, [])
+                if rest:
+                    candidates = [elem for candidate in candidates for elem in candidate.findall('.' + rest)]
+                self._results[path] = candidates
+        return self._results[path]
+
+    def find(self, path):
+        result = self.findall(path)
+        return result[0] if result else None
+
 class XMLFile:
-    """A wrapper around  to allow loading and saving to
-    bzip2 compressed files. """
+    """A wrapper around ElementTree to allow loading and saving to
+    compressed files (see xml_codecs).
+
+    The tree is only parsed when first used. Queries that only need
+    tags and attributes should go through find(), which can answer
+    them from the sidecar cache without decompressing the file. The
+    results of find() and findall() are memoized for the lifetime of
+    the object."""
+
+    #Set to False to disable reading and writing the sidecar caches
+    use_cache = True
+
+    #Threads used for bz2 (de)compression, None for all cores
+    compression_threads = None
     
     def __init__(self, filename, compressed=None):
-        """Loads the xml file, decompressing it with bz2 first if the
-        filename ends with .bz2"""
-        import io
+        """Opens the xml file, it is decompressed first if it was
+        written with one of the xml_codecs"""
+        self._tree = None
+        self._skeleton = None
+        self._query_caches = []
         if isinstance(filename, str):
             self._filename = filename        
-            if  filename.endswith('.xml.bz2'):
-                import bz2
-                f = bz2.BZ2File(filename)
-                self.tree = ET.parse(f)
-                f.close()
-            elif filename.endswith('.xml'):
-                self.tree = ET.parse(filename)
-            else:
+            if not is_xmlfile(filename):
                 raise RuntimeError('Unknown file extension for configuration file load "'+filename+'"')
         elif isinstance(filename, io.BytesIO):
             data = filename.read()
@@ -80,38 +632,128 @@ class XMLFile:
                 self._filename = filename.name
             except:
                 self._filename = "bytestream.xml"
+            codec = codec_from_magic(data)
             try:
-                import bz2
-                data = bz2.decompress(data)
-                print("Successfully decompressed!")
+                if codec is not None:
+                    data = xml_codecs[codec]['decompress'](data)
+                    print("Successfully decompressed!")
             except:
                 print("Could not decompress, trying direct reading")
-            self.tree = ET.fromstring(data)
+            self._tree = ET.fromstring(data)
         else:
             raise RuntimeError("Could not determine file type")
+
+    @property
+    def tree(self):
+        """The full ElementTree of the file, parsed on first access."""
+        if self._tree is None:
+            f = open_xml_stream(self._filename)
+            self._tree = ET.parse(f)
+            f.close()
+            if XMLFile.use_cache and self._skeleton is None and read_sidecar(self._filename) is None:
+                write_sidecar(self._filename, self._tree.getroot())
+        return self._tree
+
+    def skeleton(self):
+        """A tree of the tags and attributes of the file, without any
+        text. This comes from the sidecar cache if it is valid,
+        otherwise it is the full tree."""
+        if self._skeleton is not None:
+            return self._skeleton
+        if self._tree is not None:
+            return self._tree
+        if XMLFile.use_cache:
+            meta = read_sidecar(self._filename)
+            if meta is not None:
+                self._skeleton = unflatten_elements(meta['elements'])
+        if self._skeleton is not None:
+            return self._skeleton
+        return self.tree
+
+    def queries(self, tree):
+        """The QueryCache of tree (either the skeleton or full tree)"""
+        for cache in self._query_caches:
+            if cache.tree is tree:
+                return cache
+        cache = QueryCache(tree)
+        self._query_caches.append(cache)
+        return cache
+
+    def find(self, path):
+        """Finds the first element matching path. The element is only
+        guaranteed to carry its tag and attributes, use findall() if
+        the text is needed."""
+        return self.queries(self.skeleton()).find(path)
+
+    def findall(self, path):
+        """Finds all elements of the full tree matching path."""
+        return self.queries(self.tree).findall(path)
         
     def save(self, filename):
-        if filename.endswith('.xml.bz2'):
-            import bz2
-            f = bz2.BZ2File(filename, mode='w')
-            f.write(ET.tostring(self.tree.getroot()))
-            f.close()
-        elif filename.endswith('.xml'):
-            open(filename, 'w').write(ET.tostring(self.tree.getroot()))
-        else:
+        codec = codec_from_extension(filename)
+        if codec is None:
             raise RuntimeError('Unknown file extension for configuration file save "'+filename+'"')
+        with open(filename, 'wb') as f:
+            f.write(xml_codecs[codec]['compress'](ET.tostring(self.tree.getroot())))
 
     def __str__(self):
         return "XMLFile("+self._filename+")"
 
+def read_config_header(filename):
+    """A text-free tree of the tags and attributes of a configuration
+    file up to (and including) its ParticleData tag, but not the
+    particles. This comes from the sidecar cache if it is valid,
+    otherwise the file is only decompressed and parsed up to the
+    start of the particle data (which DynamO writes last)."""
+    meta = read_sidecar(filename) if XMLFile.use_cache else None
+    if meta is not None:
+        return unflatten_elements(meta['elements'])
+    f = open_xml_stream(filename)
+    try:
+        root = None
+        for event, elem in ET.iterparse(f, events=('start',)):
+            if root is None:
+                root = elem
+            if elem.tag == 'ParticleData':
+                break
+    finally:
+        f.close()
+    return ET.ElementTree(root)
+
 # A XMLFile/ElementTree but specialised for DynamO configuration files
 class ConfigFile(XMLFile):
-    def __init__(self, filename):
+    def __init__(self, filename, header_only=False):
+        """If header_only is set, find() (and so the config_props)
+        only reads the file up to the particle data, and N() comes
+        from the particle count written in it."""
         super().__init__(filename)
+        self._header_only = header_only
+
+    def skeleton(self):
+        if self._header_only and self._skeleton is None and self._tree is None:
+            self._skeleton = read_config_header(self._filename)
+        return super().skeleton()
 
     # Number of particles in the config
     def N(self):
-        return int(len(self.tree.findall('.//Pt')))
+        if self._tree is None:
+            #The particle count on the ParticleData tag avoids reading the particles
+            header = self.skeleton() if self._header_only else read_config_header(self._filename)
+            pdata = header.find('.//ParticleData')
+            if pdata is not None and 'N' in pdata.attrib:
+                return int(pdata.attrib['N'])
+            return len(self.particles()['ID'])
+        return int(len(self.findall('.//Pt')))
+
+    # The particle data as NumPy arrays (see load_particle_arrays)
+    def particles(self):
+        if self._tree is None:
+            return load_particle_arrays(self._filename)
+        particles = self.findall('.//Pt')
+        pos = np.array([[float(pt.find('P').attrib[c]) for c in 'xyz'] for pt in particles]).reshape(-1, 3)
+        vel = np.array([[float(pt.find('V').attrib[c]) for c in 'xyz'] for pt in particles]).reshape(-1, 3)
+        ids = np.array([int(pt.attrib.get('ID', i)) for i, pt in enumerate(particles)], dtype=np.int64)
+        return {'ID':ids, 'P':pos, 'V':vel, 'SimulationSize':np.array(self.image_dimensions())}
 
     # Primary image volume
     def V(self):
@@ -129,8 +771,8 @@ class ConfigFile(XMLFile):
         return "ConfigFile("+self._filename+")"
 
     def histogramTether(self, limits=[None, None, None]):
-        tethers = self.tree.findall('.//Global/CellOrigins/Origin')
-        particles = self.tree.findall('.//Pt/P')
+        tethers = self.findall('.//Global/CellOrigins/Origin')
+        particles = self.findall('.//Pt/P')
         data = np.ndarray((len(tethers), 3))
         
         for idx, tether, particle in zip(range(len(tethers)), tethers, particles):
@@ -140,8 +782,8 @@ class ConfigFile(XMLFile):
         return np.histogramdd(data, range=[limits, limits, limits], bins=11)
 
     def histogramTether1D(self, limits=[None]):
-        tethers = self.tree.findall('.//Global/CellOrigins/Origin')
-        particles = self.tree.findall('.//Pt/P')
+        tethers = self.findall('.//Global/CellOrigins/Origin')
+        particles = self.findall('.//Pt/P')
         data = np.ndarray((len(tethers), 1))
         for idx, tether, particle in zip(range(len(tethers)), tethers, particles):
             p = np.array(list(map(float, [particle.attrib['x'], particle.attrib['y'], particle.attrib['z']])))
@@ -150,7 +792,7 @@ class ConfigFile(XMLFile):
         return np.histogramdd(data, bins=11)
 
     def image_dimensions(self):
-        V = self.tree.find('.//SimulationSize')
+        V = self.find('.//SimulationSize')
         return [float(V.attrib['x']), float(V.attrib['y']), float(V.attrib['z'])]
     
     def to_freud(self):
@@ -159,7 +801,7 @@ class ConfigFile(XMLFile):
         frame = np.zeros((N, 3), dtype=np.float32)
         box = self.image_dimensions()
         box = freud.box.Box(Lx = box[0], Ly = box[1], Lz = box[2])
-        particles = self.tree.findall('.//Pt/P')
+        particles = self.findall('.//Pt/P')
         
         for idx, particle in enumerate(particles):
             frame[idx, 0] = np.float32(particle.attrib['x'])
@@ -172,20 +814,54 @@ class ConfigFile(XMLFile):
 
 # A XMLFile/ElementTree but specialised for DynamO output files
 class OutputFile(XMLFile):
-    def __init__(self, filename):
+    #The paths read by the methods below
+    base_paths = ['.//ParticleCount', './/Duration', './/Density']
+    
+    def __init__(self, filename, paths=None):
+        """If paths (a list of XPaths) is given, only the subtrees
+        needed to answer those queries are built when the file is
+        parsed, the text of everything else is skipped. All tags and
+        attributes are still available through find()."""
         super().__init__(filename)
-        
+        self._keep = None
+        if paths is not None:
+            keep = set(map(xpath_root_tag, list(paths) + OutputFile.base_paths))
+            if None not in keep:
+                self._keep = keep
+
+    @property
+    def tree(self):
+        if self._tree is None and self._keep is not None:
+            self._tree, elements = parse_selective(self._filename, self._keep)
+            self._skeleton = unflatten_elements(elements)
+            if XMLFile.use_cache and read_sidecar(self._filename) is None:
+                write_sidecar(self._filename, None, elements=elements)
+        return super().tree
+
+    def findall(self, path):
+        """As XMLFile.findall, but if the file was opened with paths
+        the query must start at one of their tags, as the text of
+        everything else was dropped."""
+        if self._keep is not None and xpath_root_tag(path) not in self._keep:
+            raise RuntimeError('The query "'+path+'" is outside the paths '+str(self)+' was opened with')
+        return super().findall(path)
+
+    def save(self, filename):
+        if self._keep is not None:
+            raise RuntimeError('Cannot save '+str(self)+' as it was only partially parsed (opened with paths)')
+        super().save(filename)
+
     def N(self):
-        return int(self.tree.find('.//ParticleCount').attrib['val'])
+        return int(self.find('.//ParticleCount').attrib['val'])
 
     def events(self):
-        return int(self.tree.find('.//Duration').attrib['Events'])
+        return int(self.find('.//Duration').attrib['Events'])
 
     def t(self):
-        return float(self.tree.find('.//Duration').attrib['Time'])
+        return float(self.find('.//Duration').attrib['Time'])
 
     def numdensity(self):
-        return float(self.tree.find('.//Density').attrib['val'])
+        return float(self.find('.//Density').attrib['val'])
 
     def __getitem__(self, key):
         return OutputFile.output_props[key](self)
@@ -195,13 +871,84 @@ class OutputFile(XMLFile):
     
     output_props = {}
 
-def validate_xmlfile(filename):
+####################### Integrity manifests ########################
+# Fully parsing every config/data file of a run just to check it is
+# intact is slow. Instead, once a file is known to be good (dynarun
+# finished writing it, or it passed a full parse) its size and a fast
+# checksum are recorded in a manifest in its directory. Later
+# validations only need to checksum the file, and the full parse is
+# only needed if the manifest entry is missing or doesn't match.
+manifest_name = 'manifest.json'
+
+def file_checksum(filename):
+    """Returns (algorithm, hexdigest) of the file contents, using
+    xxhash if it is installed and CRC32 otherwise."""
+    try:
+        import xxhash
+        h = xxhash.xxh64()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return 'xxh64', h.hexdigest()
+    except ImportError:
+        import zlib
+        crc = 0
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                crc = zlib.crc32(chunk, crc)
+        return 'crc32', format(crc, '08x')
+
+def read_manifest(dirname):
+    try:
+        with open(os.path.join(dirname, manifest_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def record_manifest(*filenames):
+    """Records the size and checksum of the passed (known good) files
+    in the manifest of their directory."""
+    by_dir = {}
+    for filename in filenames:
+        by_dir.setdefault(os.path.dirname(filename), []).append(filename)
+    for dirname, files in by_dir.items():
+        manifest = read_manifest(dirname)
+        for filename in files:
+            try:
+                algo, digest = file_checksum(filename)
+                manifest[os.path.basename(filename)] = {'size':os.path.getsize(filename), algo:digest}
+            except OSError:
+                manifest.pop(os.path.basename(filename), None)
+        write_json_atomic(os.path.join(dirname, manifest_name), manifest)
+
+def check_manifest(filename):
+    """True if the file matches its manifest entry, False if there is
+    no entry or it doesn't match."""
+    entry = read_manifest(os.path.dirname(filename)).get(os.path.basename(filename))
+    if entry is None:
+        return False
     try:
-        ET.parse(bz2.BZ2File(filename))
+        if os.path.getsize(filename) != entry['size']:
+            return False
+    except OSError:
+        return False
+    algo, digest = file_checksum(filename)
+    return entry.get(algo) == digest
+
+def validate_xmlfile(filename, full_parse=False):
+    if not full_parse and check_manifest(filename):
         return True
+    try:
+        f = open_xml_stream(filename)
+        try:
+            ET.parse(f)
+        finally:
+            f.close()
     except Exception as e:
         print("#!!!#", filename, e)
         return False
+    record_manifest(filename)
+    return True
     
 def validate_outputfile(filename):
     return validate_xmlfile(filename)
@@ -210,8 +957,676 @@ def validate_configfile(filename):
     return validate_xmlfile(filename)
     
 import pickle as pickle
+
+# ###############################################
+# #              Run database                   #
+# ###############################################
+#
+# Rather than rediscovering the runs by listing, globbing, unpickling
+# and probing files in the workdir (slow on shared filesystems), the
+# state of each run is kept in a SQLite database in the workdir. It
+# records each state directory, each completed block (with its event
+# count, N, t, and file checksums), and the output properties
+# extracted from each block. Only the parent process writes to it,
+# the workers report what they did through their return values.
+class RunDB:
+    filename = 'runs.db'
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE IF NOT EXISTS states (dir TEXT PRIMARY KEY, state BLOB NOT NULL);
+    CREATE TABLE IF NOT EXISTS blocks (
+        dir TEXT NOT NULL, counter INTEGER NOT NULL,
+        config TEXT NOT NULL, data TEXT NOT NULL,
+        events INTEGER NOT NULL, N INTEGER NOT NULL, t REAL NOT NULL,
+        config_size INTEGER, config_checksum TEXT,
+        data_size INTEGER, data_checksum TEXT,
+        seconds REAL, density REAL, segments TEXT, warm_start INTEGER,
+        PRIMARY KEY (dir, counter));
+    CREATE TABLE IF NOT EXISTS properties (
+        dir TEXT NOT NULL, counter INTEGER NOT NULL, name TEXT NOT NULL, value BLOB,
+        PRIMARY KEY (dir, counter, name));
+    CREATE TABLE IF NOT EXISTS reductions (
+        dir TEXT NOT NULL, key TEXT NOT NULL,
+        blocks INTEGER NOT NULL, digest TEXT NOT NULL, executed_events INTEGER NOT NULL, value BLOB NOT NULL,
+        PRIMARY KEY (dir, key));
+    CREATE TABLE IF NOT EXISTS quarantine (
+        dir TEXT PRIMARY KEY, state BLOB NOT NULL, attempts INTEGER NOT NULL, error TEXT, time REAL);
+    """
+
+    #The tables with rows for each state directory
+    dir_tables = ('states', 'blocks', 'properties', 'reductions', 'quarantine')
+
+    #The meta key of the saved plan of an unfinished SimManager.reorg_dirs
+    reorg_key = 'reorg_plan'
+
+    #Columns added since the first version of the schema, as (table, column, type)
+    added_columns = [('blocks', 'seconds', 'REAL'), ('blocks', 'density', 'REAL'), ('blocks', 'segments', 'TEXT'), ('blocks', 'warm_start', 'INTEGER')]
+
+    def __init__(self, workdir):
+        self.path = os.path.join(workdir, RunDB.filename)
+        self._conn = None
+
+    def __getstate__(self):
+        #The connection stays in the process that opened it
+        return {'path': self.path, '_conn': None}
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.row_factory = sqlite3.Row
+            with self._conn:
+                self._conn.executescript(RunDB.schema)
+                for table, column, decl in RunDB.added_columns:
+                    if column not in [row['name'] for row in self._conn.execute('PRAGMA table_info('+table+')')]:
+                        self._conn.execute('ALTER TABLE '+table+' ADD COLUMN '+column+' '+decl)
+        return self._conn
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return default if row is None else row['value']
+
+    def set_meta(self, key, value):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def dirs(self):
+        return [row['dir'] for row in self.conn.execute('SELECT dir FROM states ORDER BY dir')]
+
+    def state(self, dirname):
+        row = self.conn.execute('SELECT state FROM states WHERE dir=?', (dirname,)).fetchone()
+        return None if row is None else pickle.loads(row['state'])
+
+    def states(self):
+        return {row['dir']: pickle.loads(row['state']) for row in self.conn.execute('SELECT dir, state FROM states')}
+
+    def blocks(self, dirname):
+        """The completed blocks of a state directory, in order"""
+        return [dict(row) for row in self.conn.execute('SELECT * FROM blocks WHERE dir=? ORDER BY counter', (dirname,))]
+
+    def properties(self, dirname):
+        """The extracted output properties of a state directory, as a
+        dict of (counter, name) to the pickled value"""
+        return {(row['counter'], row['name']): row['value'] for row in self.conn.execute('SELECT counter, name, value FROM properties WHERE dir=?', (dirname,))}
+
+    def reduction(self, dirname, key):
+        """The partial reduction of the outputs of a state directory
+        (see perdir), or None if there isn't one"""
+        row = self.conn.execute('SELECT blocks, digest, executed_events, value FROM reductions WHERE dir=? AND key=?', (dirname, key)).fetchone()
+        return None if row is None else dict(row)
+
+    def record(self, record):
+        """Records what a worker found/did in a state directory. The
+        record is a dict with the "dir", and optionally the "state",
+        the "blocks" (see block_record), the extracted "properties"
+        as a list of (counter, name, pickled value), and a partial
+        "reduction" of the outputs."""
+        dirname = record['dir']
+        with self.conn:
+            if record.get('state') is not None:
+                self.conn.execute('INSERT OR REPLACE INTO states VALUES (?, ?)', (dirname, pickle.dumps(record['state'])))
+            for block in record.get('blocks', []):
+                #If a block was rerun, its extracted properties are stale
+                self.conn.execute('DELETE FROM properties WHERE dir=? AND counter=? AND EXISTS (SELECT 1 FROM blocks WHERE dir=? AND counter=? AND data_checksum IS NOT ?)',
+                                  (dirname, block['counter'], dirname, block['counter'], block['data_checksum']))
+                self.conn.execute('INSERT OR REPLACE INTO blocks (dir, counter, config, data, events, N, t, config_size, config_checksum, data_size, data_checksum, seconds, density, segments, warm_start) '
+                                  'VALUES (:dir, :counter, :config, :data, :events, :N, :t, :config_size, :config_checksum, :data_size, :data_checksum, :seconds, :density, :segments, :warm_start)',
+                                  dict({'seconds':None, 'density':None, 'segments':None, 'warm_start':None}, **block, dir=dirname))
+            self.conn.executemany('INSERT OR REPLACE INTO properties VALUES (?, ?, ?, ?)',
+                                  [(dirname, counter, name, value) for counter, name, value in record.get('properties', [])])
+            if record.get('reduction') is not None:
+                self.conn.execute('INSERT OR REPLACE INTO reductions VALUES (:dir, :key, :blocks, :digest, :executed_events, :value)',
+                                  dict(record['reduction'], dir=dirname))
+
+    def quarantine(self, dirname, state, attempts, error):
+        """Records that the runs of a state directory keep failing"""
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO quarantine VALUES (?, ?, ?, ?, ?)', (dirname, pickle.dumps(state), attempts, error, time.time()))
+
+    def quarantined(self):
+        """The quarantined state directories, as a dict of the
+        directory to its state, attempts, error and time"""
+        return {row['dir']: dict(row, state=pickle.loads(row['state'])) for row in self.conn.execute('SELECT * FROM quarantine')}
+
+    def release(self, dirnames=None):
+        """Removes state directories (all if None) from the quarantine"""
+        with self.conn:
+            if dirnames is None:
+                self.conn.execute('DELETE FROM quarantine')
+            else:
+                self.conn.executemany('DELETE FROM quarantine WHERE dir=?', [(dirname,) for dirname in dirnames])
+
+    def move(self, olddir, newdir, state):
+        """Records that a state directory was moved/renamed"""
+        self.move_many([(olddir, newdir, state)])
+
+    def move_many(self, moves):
+        """Records that state directories were moved/renamed, given as
+        a list of (olddir, newdir, state). A directory can move to the
+        old name of another, as everything is first moved to a
+        temporary name."""
+        with self.conn:
+            for stage in (0, 1):
+                for idx, (olddir, newdir, state) in enumerate(moves):
+                    if olddir == newdir:
+                        continue
+                    src, dst = (olddir, '\0'+str(idx)) if stage == 0 else ('\0'+str(idx), newdir)
+                    for table in RunDB.dir_tables:
+                        if stage == 1:
+                            #Drop the stale rows of a directory which was deleted
+                            self.conn.execute('DELETE FROM '+table+' WHERE dir=?', (dst,))
+                        self.conn.execute('UPDATE '+table+' SET dir=? WHERE dir=?', (dst, src))
+            self.conn.executemany('INSERT OR REPLACE INTO states VALUES (?, ?)', [(newdir, pickle.dumps(state)) for olddir, newdir, state in moves])
+            #The moves of a SimManager.reorg_dirs plan are complete
+            self.conn.execute('DELETE FROM meta WHERE key=?', (RunDB.reorg_key,))
+
+def block_record(counter, configfile, datafile):
+    """Summarises a completed block for the run database"""
+    of = OutputFile(datafile, [])
+    record = {'counter':counter, 'config':os.path.basename(configfile), 'data':os.path.basename(datafile),
+              'events':of.events(), 'N':of.N(), 't':of.t(), 'seconds':None, 'density':None, 'segments':None, 'warm_start':None}
+    #The run time is used to estimate the cost of future blocks
+    timing = of.find('.//Timing')
+    if timing is not None and 'RuntimeSeconds' in timing.attrib:
+        record['seconds'] = float(timing.attrib['RuntimeSeconds'])
+    if counter == 0 and os.path.isfile(os.path.join(os.path.dirname(datafile), warm_start_name)):
+        record['warm_start'] = 1
+    #Blocks resumed from a checkpoint also include the earlier segments
+    segments = read_segments(os.path.dirname(datafile), counter)
+    if segments:
+        record['segments'] = json.dumps(segments)
+        for segment in segments:
+            segment_of = OutputFile(os.path.join(os.path.dirname(datafile), segment['data']), [])
+            record['events'] += segment_of.events()
+            record['t'] += segment_of.t()
+            timing = segment_of.find('.//Timing')
+            if record['seconds'] is not None and timing is not None and 'RuntimeSeconds' in timing.attrib:
+                record['seconds'] += float(timing.attrib['RuntimeSeconds'])
+    density = of.find('.//Density')
+    if density is not None:
+        record['density'] = float(density.attrib['val'])
+    manifest = read_manifest(os.path.dirname(datafile))
+    for key, filename in (('config', configfile), ('data', datafile)):
+        size = os.path.getsize(filename)
+        #Reuse the checksum in the manifest if it is for this file
+        entry = manifest.get(os.path.basename(filename), {})
+        checksums = [algo+':'+digest for algo, digest in entry.items() if algo != 'size']
+        record[key+'_size'] = size
+        record[key+'_checksum'] = checksums[0] if (entry.get('size') == size and checksums) else ':'.join(file_checksum(filename))
+    return record
+
+def blocks_digest(blocks, digest=''):
+    """A digest identifying a sequence of blocks and their contents.
+    It is chained, so the digest of further blocks can be added to an
+    existing digest."""
+    import hashlib
+    for block in blocks:
+        digest = hashlib.blake2b((digest+str(block['counter'])+':'+str(block['data_checksum'])).encode(), digest_size=16).hexdigest()
+    return digest
+
+def block_intact(workdir, block):
+    """A cheap check that the files of a block recorded in the run
+    database are still in place"""
+    try:
+        return (all(os.path.getsize(os.path.join(workdir, block[key])) == block[key+'_size'] for key in ('config', 'data'))
+                and all(os.path.isfile(os.path.join(workdir, segment['data'])) for segment in json.loads(block.get('segments') or '[]')))
+    except OSError:
+        return False
+
+#Each state directory has a journal, with a line appended for every
+#block as it is completed (or first found to be complete). Each line
+#is the block_record of the block plus the production "run_events"
+#(per particle) of the chain up to and including it, so a restarted
+#chain only needs to read and check the last line.
+journal_name = 'journal.jsonl'
+
+def append_journal(workdir, block, run_events):
+    with open(os.path.join(workdir, journal_name), 'a') as f:
+        #Rows from the run database also name the directory, which could be moved
+        f.write(json.dumps({key:value for key, value in dict(block, run_events=run_events).items() if key != 'dir'}) + '\n')
+
+def read_journal_tail(workdir):
+    """The last entry of the journal of workdir, read from the end of
+    the file, or None if there isn't one"""
+    try:
+        with open(os.path.join(workdir, journal_name), 'rb') as f:
+            pos = f.seek(0, os.SEEK_END)
+            data = b''
+            while pos > 0:
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+                lines = data.rstrip(b'\n').split(b'\n')
+                if len(lines) > 1 or pos == 0:
+                    return json.loads(lines[-1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+def read_journal(workdir):
+    """All the entries of the journal of workdir by counter, the
+    latest entry of each block wins"""
+    entries = {}
+    try:
+        with open(os.path.join(workdir, journal_name)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    #A torn write
+                    continue
+                entries[entry['counter']] = entry
+    except OSError:
+        pass
+    return entries
+
+def journal_block(entry):
+    """The block_record of a journal entry"""
+    return {key:value for key, value in entry.items() if key != 'run_events'}
+
+def journal_record(workdir, state, known_blocks):
+    """The run database record of the blocks of workdir which are in
+    its journal but not in known_blocks (e.g., those completed by a
+    task which then failed), or None if there are none"""
+    known = {block['counter'] for block in known_blocks}
+    blocks = [journal_block(entry) for counter, entry in sorted(read_journal(workdir).items())
+              if counter not in known and block_intact(workdir, entry)]
+    if not blocks:
+        return None
+    return {'dir':os.path.basename(workdir), 'state':state, 'blocks':blocks}
+
+def scan_dir(args):
+    """Rebuilds the run database record of a state directory from the
+    files in it. This is only used to import runs the database
+    doesn't know about."""
+    output_dir, manager = args
+    path = os.path.join(manager.workdir, output_dir)
+    if not os.path.isdir(path):
+        return None
+    try:
+        state = pickle.load(open(os.path.join(path, "state.pkl"), 'rb'))
+    except FileNotFoundError:
+        return None
+    _, state = make_state(state)
+
+    #Blocks in the journal only need their file sizes checking
+    journal = read_journal(path)
+    blocks = []
+    while len(blocks) in journal and block_intact(path, journal[len(blocks)]):
+        blocks.append(journal_block(journal[len(blocks)]))
+    while True:
+        configfile = find_xmlfile(os.path.join(path, str(len(blocks))+'.config'))
+        datafile = find_xmlfile(os.path.join(path, str(len(blocks))+'.data'))
+        if configfile is None or not validate_configfile(configfile) or datafile is None or not validate_outputfile(datafile):
+            break
+        blocks.append(block_record(len(blocks), configfile, datafile))
+    return {'dir':output_dir, 'state':state, 'blocks':blocks}
+
+class CostModel:
+    """Predicts the run time of simulation blocks from the blocks in
+    the run database.
+
+    The run time of a block is taken to be proportional to its length
+    in particle events (events/N). The run time per particle event is
+    measured directly for directories with completed blocks. Other
+    states use the measurement of the nearest measured state in
+    (log(N), density), rescaled by N, or default_rate if nothing has
+    been measured yet."""
+    default_rate = 1e6 #Events per second
+
+    def __init__(self, db):
+        #dir -> (N, density, seconds per particle event)
+        self.measured = {}
+        #dir -> the estimated seconds per particle event of an
+        #unmeasured directory, until the next measurement
+        self._estimates = {}
+        for dirname in db.dirs():
+            self.update(dirname, db.blocks(dirname))
+
+    def update(self, dirname, blocks):
+        timed = [block for block in blocks if block.get('seconds') is not None and block['events'] > 0]
+        if timed:
+            self.measured[dirname] = (timed[-1]['N'], timed[-1]['density'],
+                                      sum(block['seconds'] for block in timed) / sum(block['events'] / block['N'] for block in timed))
+            #Any measurement can be the new nearest one
+            self._estimates.clear()
+
+    def seconds_per_particle_event(self, dirname, state):
+        if dirname in self.measured:
+            return self.measured[dirname][2]
+        if dirname not in self._estimates:
+            self._estimates[dirname] = self.estimate(state)
+        return self._estimates[dirname]
+
+    def estimate(self, state):
+        """The seconds per particle event of an unmeasured state"""
+        statevars = dict(state)
+        N, density = statevars.get('N'), statevars.get('ndensity')
+        if not self.measured:
+            return (N or 1) / CostModel.default_rate
+        if N is None:
+            return float(np.median([s for _, _, s in self.measured.values()]))
+        def distance(measurement):
+            mN, mdensity, _ = measurement
+            d = math.log(mN / N)**2
+            if density is not None and mdensity is not None:
+                d += ((mdensity - density) / density)**2
+            return d
+        mN, _, s = min(self.measured.values(), key=distance)
+        return s * N / mN
+
+def predict_makespan(chains, processes):
+    """Simulates running chains of tasks (lists of task run times,
+    each task depending on the one before it) on processes workers,
+    always starting the ready task with the most run time left in its
+    chain. Returns the total wall time."""
+    import heapq
+    ready = [(-sum(chain), idx, 0) for idx, chain in enumerate(chains) if chain]
+    heapq.heapify(ready)
+    running = []
+    now = 0
+    while ready or running:
+        while ready and len(running) < processes:
+            _, idx, task = heapq.heappop(ready)
+            heapq.heappush(running, (now + chains[idx][task], idx, task))
+        now, idx, task = heapq.heappop(running)
+        if task + 1 < len(chains[idx]):
+            heapq.heappush(ready, (-sum(chains[idx][task+1:]), idx, task + 1))
+    return now
+
+# ###############################################
+# #           Simulation supervisor             #
+# ###############################################
+class SupervisedProcess:
+    """The live status of a dynarun/dynamod process, parsed from the
+    ticker lines it prints every --print-events events, e.g.,
+    "ETA 3min 2s, Events 1200k, t 143.2, <MFT> 0.1, T 1, U 0". The
+    rates are smoothed over the ticks."""
+    ticker = re.compile(r'Events (\d+)k, t ([^,\s]+)')
+    smoothing = 0.3
+
+    def __init__(self, name, args, events=None):
+        self.name = name
+        self.args = args
+        #The event count the process will stop at (if known)
+        self.target_events = events
+        self.pid = None
+        self.returncode = None
+        self.started = self.last_tick = time.time()
+        self.ticks = 0
+        self.events = 0
+        self.t = 0.0
+        self.events_per_sec = None
+        self.sim_time_per_sec = None
+
+    def update(self, line, now):
+        match = SupervisedProcess.ticker.search(line)
+        if match is None:
+            return
+        events, t = int(match.group(1)) * 1000, float(match.group(2))
+        dt = now - self.last_tick
+        #The first tick includes the start up time, so is only used
+        #as the starting point for the rates
+        if self.ticks and dt > 0 and events > self.events:
+            rates = ((events - self.events) / dt, (t - self.t) / dt)
+            if self.events_per_sec is None:
+                self.events_per_sec, self.sim_time_per_sec = rates
+            else:
+                a = SupervisedProcess.smoothing
+                self.events_per_sec = a * rates[0] + (1 - a) * self.events_per_sec
+                self.sim_time_per_sec = a * rates[1] + (1 - a) * self.sim_time_per_sec
+        self.events, self.t, self.last_tick = events, t, now
+        self.ticks += 1
+
+    def eta(self):
+        """Seconds until the process reaches its target event count, or None if unknown"""
+        if self.target_events is None or not self.events_per_sec:
+            return None
+        return max(0, self.target_events - self.events) / self.events_per_sec
+
+    def stalled(self, timeout, now=None):
+        """If the process hasn't ticked for timeout seconds"""
+        return self.returncode is None and (now or time.time()) - self.last_tick > timeout
+
+class Supervisor:
+    """Runs dynarun/dynamod processes from an asyncio event loop in a
+    background thread. Their output is streamed into their logfile
+    and their ticker output parsed as it arrives, so the events/s,
+    simulation time and ETA of every running process is available
+    from status(). check_call is thread safe, so many threads (see
+    ThreadExecutor) can run processes through one supervisor."""
+    def __init__(self):
+        import asyncio, threading
+        self._processes = {}
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+    async def _run(self, status, args, logfile, cwd, cores=None):
+        import asyncio, codecs
+        proc = await asyncio.create_subprocess_exec(*args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
+        #Pinned from here, as a preexec_fn isn't safe in a threaded process
+        if cores:
+            try:
+                os.sched_setaffinity(proc.pid, cores)
+            except ProcessLookupError:
+                #It has already exited
+                pass
+        status.pid = proc.pid
+        forward_status(status)
+        partial = b''
+        #Characters can be split between chunks
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            chunk = await proc.stdout.read(1 << 16)
+            if not chunk:
+                break
+            logfile.write(decoder.decode(chunk))
+            logfile.flush()
+            *lines, partial = (partial + chunk).split(b'\n')
+            now = time.time()
+            ticks = status.ticks
+            for line in lines:
+                status.update(line.decode(errors='replace'), now)
+            if status.ticks != ticks:
+                forward_status(status)
+        logfile.write(decoder.decode(b'', final=True))
+        logfile.flush()
+        status.returncode = await proc.wait()
+        return status.returncode
+
+    def check_call(self, args, logfile, name=None, events=None, cwd=None, cores=None):
+        """Runs a process to completion like subprocess.check_call,
+        with its output going to logfile. events is the event count
+        it will stop at, used for the ETA. If given, the process is
+        pinned to the list of cores."""
+        import asyncio
+        status = SupervisedProcess(name or os.path.basename(args[0]), list(args), events)
+        with self._lock:
+            self._processes[id(status)] = status
+        try:
+            returncode = asyncio.run_coroutine_threadsafe(self._run(status, args, logfile, cwd, cores), self._loop).result()
+        finally:
+            with self._lock:
+                del self._processes[id(status)]
+            forward_status(status, finished=True)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+
+    def status(self):
+        """The SupervisedProcess of every running process"""
+        with self._lock:
+            return list(self._processes.values())
+
+#Pool processes of a LocalExecutor send the status of the processes
+#they supervise to its status queue (see init_pool_process), as
+#(pool process pid, key, SupervisedProcess or None once finished)
+_status_queue = None
+
+def forward_status(status, finished=False):
+    if _status_queue is not None:
+        _status_queue.put((os.getpid(), id(status), None if finished else status))
+
+_supervisor = None
+def supervisor():
+    """The supervisor of this process. There's one per process, as
+    pool workers are forked from processes which might have one
+    already."""
+    global _supervisor
+    if _supervisor is None or _supervisor[0] != os.getpid():
+        _supervisor = (os.getpid(), Supervisor())
+    return _supervisor[1]
+
+def supervised_call(args, logfile, name=None, events=None, cwd=None):
+    """Runs dynarun/dynamod (or anything else) through this process's supervisor"""
+    supervisor().check_call(args, logfile, name, events, cwd, current_cores())
+
+# ###############################################
+# #               Checkpointing                 #
+# ###############################################
+#Production blocks are run with dynarun saving a snapshot (a config
+#and the output data so far) every so many events into the block's
+#checkpoint directory. If the run is interrupted, the newest valid
+#snapshot becomes a "segment" of the block, and the block resumes
+#from its config. A finished block is then its segments plus the
+#final config/data, and its outputs are combined from all of them.
+segments_name = 'segments.json'
+
+def checkpoint_dir(workdir, counter):
+    return os.path.join(workdir, str(counter)+'.ckpt')
+
+def read_segments(workdir, counter):
+    """The segments of a block as a list of {'config':..., 'data':...}
+    paths relative to workdir, in the order they were run"""
+    try:
+        return json.load(open(os.path.join(checkpoint_dir(workdir, counter), segments_name)))
+    except FileNotFoundError:
+        return []
+
+def latest_snapshot(ckptdir):
+    """The {'config':..., 'data':...} filenames of the newest valid
+    snapshot dynarun saved in ckptdir, or None if there isn't one"""
+    snapshots = {}
+    for name in os.listdir(ckptdir):
+        match = re.match(r'Snapshot\.(output\.)?(\d+)e\.xml', name)
+        if match:
+            snapshots.setdefault(int(match.group(2)), {})['data' if match.group(1) else 'config'] = name
+    for idx in sorted(snapshots, reverse=True):
+        snapshot = snapshots[idx]
+        if ('config' in snapshot and 'data' in snapshot
+            and validate_configfile(os.path.join(ckptdir, snapshot['config']))
+            and validate_outputfile(os.path.join(ckptdir, snapshot['data']))):
+            return snapshot
+    return None
+
+def run_checkpointed(inputfile, outputfile, datafile, N, particle_events, checkpoint_events, outputplugins, logfile, workdir, counter):
+    """Runs a production block, saving a snapshot every
+    checkpoint_events particle events (if set). An interrupted earlier
+    attempt is resumed from its newest valid snapshot."""
+    ckptdir = checkpoint_dir(workdir, counter)
+    os.makedirs(ckptdir, exist_ok=True)
+    segments = read_segments(workdir, counter)
+    if not all(os.path.isfile(os.path.join(workdir, segment[key])) for segment in segments for key in ('config', 'data')):
+        print("Segments of run "+str(counter)+" are missing, restarting it", file=logfile)
+        segments = []
+    snapshot = latest_snapshot(ckptdir)
+    if snapshot is not None:
+        segment = {}
+        for key, name in snapshot.items():
+            newname = 'seg'+str(len(segments))+'.'+key+name[name.index('.xml'):]
+            os.replace(os.path.join(ckptdir, name), os.path.join(ckptdir, newname))
+            segment[key] = os.path.join(os.path.basename(ckptdir), newname)
+        segments.append(segment)
+    with open(os.path.join(ckptdir, segments_name+'.tmp'), 'w') as f:
+        json.dump(segments, f)
+    os.replace(os.path.join(ckptdir, segments_name+'.tmp'), os.path.join(ckptdir, segments_name))
+    #Snapshots are numbered from zero for each attempt, so old ones must go
+    for name in os.listdir(ckptdir):
+        if name.startswith('Snapshot.'):
+            os.remove(os.path.join(ckptdir, name))
+
+    events = N * particle_events
+    if segments:
+        events -= sum(OutputFile(os.path.join(workdir, segment['data']), []).events() for segment in segments)
+        inputfile = os.path.join(workdir, segments[-1]['config'])
+        print("Resuming run "+str(counter)+" from "+inputfile+" with "+str(events)+" events left", file=logfile, flush=True)
+    #dynarun writes nothing if asked to run no events
+    events = max(events, 1)
+    #dynarun writes snapshots into its working directory
+    args = ["dynarun", os.path.abspath(inputfile), '-o', os.path.abspath(outputfile), '-c', str(events), "--out-data-file", os.path.abspath(datafile)]+outputplugins
+    if checkpoint_events:
+        args += ['--snapshot-events', str(int(N * checkpoint_events))]
+    supervised_call(args, logfile, name=os.path.basename(workdir)+'/'+str(counter), events=events, cwd=ckptdir)
+
+    if segments:
+        for name in os.listdir(ckptdir):
+            if name.startswith('Snapshot.'):
+                os.remove(os.path.join(ckptdir, name))
+    else:
+        shutil.rmtree(ckptdir)
+
+def merge_segments(results):
+    """Combines the results of the segments of a block into the single
+    sample an uninterrupted block would have given"""
+    results = [result for result in results if result is not None]
+    if len(results) == 0:
+        return None
+    if len(results) == 1 or not all(isinstance(result, (WeightedFloat, WeightedArray)) for result in results):
+        import functools
+        return functools.reduce(lambda a, b: a + b, results)
+    weight = sum(result._w_sum for result in results)
+    sum_v = sum(result._w_v_sum for result in results)
+    #Array outputs have a scalar weight, so size the output by the value
+    value = np.divide(sum_v, weight, out=np.zeros(np.broadcast(sum_v, weight).shape), where=np.asarray(weight) != 0)
+    if isinstance(results[0], WeightedFloat):
+        return WeightedFloat(float(value), weight)
+    return WeightedArray(value, weight)
+
+# ###############################################
+# #                Warm starts                  #
+# ###############################################
+#A state point can be started from the final config of a finished
+#neighbouring state (see SimManager.warm_start_source), rescaled to
+#its density, and then only needs a short equilibration. The marker
+#file records this, so the shortened equilibration run still counts
+#as a full one when the data is processed.
+warm_start_name = 'warm_start.json'
+
+def warm_start_config(source, startconfig, state, logfile):
+    """Makes startconfig from the config source, rescaled to the
+    number density of state. Expanding just scales the positions and
+    box, while compressing (which could overlap particles) is done
+    with dynarun's compression engine."""
+    target = dict(state)['ndensity']
+    #The density only needs the header, the file is only fully parsed if it is rescaled here
+    config = ConfigFile(source, header_only=True)
+    density = config.n()
+    print("Warm starting from", source, "at density", print_to_14sf(density), file=logfile, flush=True)
+    if target > density:
+        supervised_call(["dynarun", source, '--engine', '3', '--target-density', repr(target), '-o', startconfig], logfile, name=os.path.basename(os.path.dirname(startconfig))+'/compress')
+    else:
+        scale = (density / target) ** (1.0 / 3)
+        tree = config.tree
+        for element in tree.findall('.//SimulationSize') + tree.findall('.//Pt/P') + tree.findall('.//CellOrigins/Origin'):
+            for c in 'xyz':
+                element.attrib[c] = repr(float(element.attrib[c]) * scale)
+        config.save(startconfig)
+
 #This function actually sets up and runs the simulations and is run in parallel
-def worker(state, workdir, outputplugins, particle_equil_events, particle_run_events, particle_run_events_block_size, setup_worker):
+def worker(state, workdir, outputplugins, particle_equil_events, particle_run_events, particle_run_events_block_size, setup_worker, codec='bz2', checkpoint_events=None,
+           warm_source=None, warm_equil_events=None, known_blocks=None):
+    """Runs a state point up to particle_run_events, with production
+    runs saving a checkpoint every checkpoint_events (if set). A new
+    state point is warm started from the config warm_source (if
+    given), with only warm_equil_events of equilibration. known_blocks are
+    the completed blocks (by counter) already in the run database,
+    these are skipped without validating their files. Returns a run
+    database record of the state and the blocks found or run here."""
+    if known_blocks is None:
+        known_blocks = {}
+    blocks = []
     try:
         if True:
             if not os.path.isdir(workdir):
@@ -227,57 +1642,99 @@ def worker(state, workdir, outputplugins, particle_equil_events, particle_run_ev
             print("#        Setup Config          #", file=logfile)
             print("################################  ", file=logfile, flush=True)
         
-            startconfig = os.path.join(workdir, "start.config.xml.bz2")
+            startconfig = xmlfile_name(os.path.join(workdir, "start.config"), codec)
             if not os.path.isfile(startconfig) or not validate_configfile(startconfig):
                 print("No (valid) config found, creating...", file=logfile, flush=True)
                 try:
-                    setup_worker(startconfig, state, logfile, particle_equil_events)
+                    if warm_source is not None:
+                        warm_start_config(warm_source, startconfig, state, logfile)
+                        with open(os.path.join(workdir, warm_start_name), 'w') as f:
+                            json.dump({'source':warm_source, 'equil_events':warm_equil_events}, f)
+                    else:
+                        setup_worker(startconfig, state, logfile, particle_equil_events)
                 except SkipThisPoint as e:
                     #Leave the work dir, we'll just skip the point
-                    return
+                    return None
                 except subprocess.CalledProcessError as e:
                     raise RuntimeError('Failed while running setup worker, command was\n"'+str(e.cmd)+'"\nSee logfile "'+str(os.path.join(workdir, 'run.log'))+'"')
+                record_manifest(startconfig)
             else:
                 print("Initial config found.", file=logfile, flush=True)
         
             #Do the equilibration run
             inputfile = startconfig
-            outputfile = os.path.join(workdir, '0.config.xml.bz2')
-            datafile = os.path.join(workdir, '0.data.xml.bz2')
+            outputfile = xmlfile_name(os.path.join(workdir, '0.config'), codec)
+            datafile = xmlfile_name(os.path.join(workdir, '0.data'), codec)
         
+            #The journal records how far the chain got, so a restart
+            #only has to check the files of the last block
+            tail = read_journal_tail(workdir)
+            if tail is not None and not block_intact(workdir, tail):
+                tail = None
+
             #Parse how many particles there are
-            inconfig = ConfigFile(inputfile)
-            N = inconfig.N()
-            inconfig = None # Just doing this to free the XML reader
+            if tail is not None:
+                N = tail['N']
+            else:
+                N = len(load_particle_arrays(inputfile)['ID'])
+
+            if os.path.isfile(os.path.join(workdir, warm_start_name)):
+                particle_equil_events = json.load(open(os.path.join(workdir, warm_start_name)))['equil_events']
             
             print("\n", file=logfile)
             print("################################", file=logfile)
             print("#      Equilibration Run       #", file=logfile)
             print("################################\n", file=logfile, flush=True)
             
-            from subprocess import check_call
             #Only actually do the equilibration if the output data/config is missing
-            if not os.path.isfile(outputfile) or not validate_configfile(outputfile) or not os.path.isfile(datafile) or not validate_outputfile(datafile):
-                check_call(["dynarun", inputfile, '-o', outputfile, '-c', str(N * particle_equil_events), "--out-data-file", datafile], stdout=logfile, stderr=logfile)
+            if tail is not None:
+                print("Found completed runs up to "+str(tail['counter'])+" in the progress journal", file=logfile)
+            elif 0 in known_blocks and block_intact(workdir, known_blocks[0]):
+                print("Found completed equilibration run in the run database", file=logfile)
+                append_journal(workdir, known_blocks[0], 0)
+            elif not os.path.isfile(outputfile) or not validate_configfile(outputfile) or not os.path.isfile(datafile) or not validate_outputfile(datafile):
+                supervised_call(["dynarun", inputfile, '-o', outputfile, '-c', str(int(N * particle_equil_events)), "--out-data-file", datafile], logfile,
+                                name=os.path.basename(workdir)+'/0', events=int(N * particle_equil_events))
+                record_manifest(outputfile, datafile)
+                blocks.append(block_record(0, outputfile, datafile))
+                append_journal(workdir, blocks[-1], 0)
             else:
                 print("Found existing valid equilibration run", file=logfile)
+                blocks.append(block_record(0, outputfile, datafile))
+                append_journal(workdir, blocks[-1], 0)
         
             #Now do the production runs
             counter = 1
             curr_particle_events = 0
+            if tail is not None:
+                counter = tail['counter'] + 1
+                curr_particle_events = tail['run_events']
+                #Journalled blocks the run database is missing are reported
+                missing = [idx for idx in range(counter) if idx not in known_blocks]
+                if missing:
+                    journal = read_journal(workdir)
+                    blocks += [journal_block(journal[idx]) for idx in missing if idx in journal]
             while curr_particle_events < particle_run_events:
                 print("\n", file=logfile)
                 print("################################", file=logfile)
                 print("#        Production Run        #", file=logfile)
                 print("################################", file=logfile, flush=True)
                 print("Events ",curr_particle_events, "/", particle_run_events, "\n", file=logfile, flush=True)
-                inputfile = os.path.join(workdir, str(counter-1)+'.config.xml.bz2')
+                if counter in known_blocks and block_intact(workdir, known_blocks[counter]):
+                    events_per_N_run = known_blocks[counter]['events'] / known_blocks[counter]['N']
+                    curr_particle_events += events_per_N_run
+                    append_journal(workdir, known_blocks[counter], curr_particle_events)
+                    print("Found completed run "+str(counter)+" with "+str(events_per_N_run)+"N events in the run database, skipping", file=logfile)
+                    counter += 1
+                    continue
+                
+                inputfile = find_xmlfile(os.path.join(workdir, str(counter-1)+'.config'))
                 # Abort if input file is missing
-                if not os.path.isfile(inputfile):
+                if inputfile is None:
                     print("ERROR! input file missing?", file=logfile)
-                    return
-                outputfile = os.path.join(workdir, str(counter)+'.config.xml.bz2')
-                datafile = os.path.join(workdir, str(counter)+'.data.xml.bz2')
+                    return {'dir':os.path.basename(workdir), 'state':state, 'blocks':blocks}
+                outputfile = xmlfile_name(os.path.join(workdir, str(counter)+'.config'), codec)
+                datafile = xmlfile_name(os.path.join(workdir, str(counter)+'.data'), codec)
                 dotherun = False
                 if (not os.path.isfile(outputfile)):
                     print("output config file for run "+str(counter)+" "+outputfile+" is missing, doing the run", file=logfile)
@@ -293,13 +1750,18 @@ def worker(state, workdir, outputplugins, particle_equil_events, particle_run_ev
                     dotherun = True
 
                 if dotherun:
-                    check_call(["dynarun", inputfile, '-o', outputfile, '-c', str(N * particle_run_events_block_size), "--out-data-file", datafile]+outputplugins, stdout=logfile, stderr=logfile)
+                    run_checkpointed(inputfile, outputfile, datafile, N, particle_run_events_block_size, checkpoint_events, outputplugins, logfile, workdir, counter)
+                    record_manifest(outputfile, datafile)
+                    blocks.append(block_record(counter, outputfile, datafile))
                     curr_particle_events += particle_run_events_block_size
+                    append_journal(workdir, blocks[-1], curr_particle_events)
                     counter += 1
                 else:
-                    of = OutputFile(datafile)
-                    events_per_N_run = of.events() / of.N()
+                    block = block_record(counter, outputfile, datafile)
+                    blocks.append(block)
+                    events_per_N_run = block['events'] / block['N']
                     curr_particle_events += events_per_N_run
+                    append_journal(workdir, block, curr_particle_events)
                     print("Found existing config and data for run "+str(counter)+" with "+str(events_per_N_run)+"N events, skipping", file=logfile)
                     counter += 1
         
@@ -309,71 +1771,221 @@ def worker(state, workdir, outputplugins, particle_equil_events, particle_run_ev
             print("#        Run Complete          #", file=logfile)
             print("################################", file=logfile)
             print("Events ",curr_particle_events, "/", particle_run_events, "\n", file=logfile, flush=True)
+            return {'dir':os.path.basename(workdir), 'state':state, 'blocks':blocks}
     except subprocess.CalledProcessError as e:
         raise RuntimeError('Failed while running worker, command was\n"'+str(e.cmd)+'"\nSee logfile "'+str(os.path.join(workdir, 'run.log'))+'"')
         
+# ###############################################
+# #               Batched runs                  #
+# ###############################################
+#For small systems, starting dynarun and reading/writing the configs
+#can take longer than the simulation itself. The production blocks
+#of several state points can instead be run by one dynarun, using
+#the replica exchange engine with swapping disabled. It then runs
+#each config as an independent simulation and numbers the outputs by
+#their position on the command line.
+def batch_block(args):
+    """If the worker task args only has a single production block
+    left to run, which can be run without checkpointing, returns
+    (N, counter, inputfile, outputfile, datafile, particle events run
+    before it) for it. Otherwise returns None."""
+    state, workdir, outputplugins, particle_equil_events, particle_run_events, particle_run_events_block_size, setup_worker, codec, checkpoint_events, warm_source, warm_equil_events, known_blocks = args
+    if 0 not in known_blocks or not block_intact(workdir, known_blocks[0]):
+        return None
+    counter = 1
+    curr_particle_events = 0
+    tail = read_journal_tail(workdir)
+    if tail is not None and all(idx in known_blocks for idx in range(tail['counter'] + 1)) and block_intact(workdir, tail):
+        counter = tail['counter'] + 1
+        curr_particle_events = tail['run_events']
+    while counter in known_blocks:
+        if not block_intact(workdir, known_blocks[counter]):
+            return None
+        curr_particle_events += known_blocks[counter]['events'] / known_blocks[counter]['N']
+        counter += 1
+    if curr_particle_events >= particle_run_events or curr_particle_events + particle_run_events_block_size < particle_run_events:
+        return None
+    #Partial (checkpointed) or unrecorded runs of the block are left to the worker
+    if (os.path.isdir(checkpoint_dir(workdir, counter)) or find_xmlfile(os.path.join(workdir, str(counter)+'.config')) is not None
+        or find_xmlfile(os.path.join(workdir, str(counter)+'.data')) is not None):
+        return None
+    inputfile = find_xmlfile(os.path.join(workdir, str(counter-1)+'.config'))
+    if inputfile is None:
+        return None
+    return (known_blocks[0]['N'], counter, inputfile,
+            xmlfile_name(os.path.join(workdir, str(counter)+'.config'), codec),
+            xmlfile_name(os.path.join(workdir, str(counter)+'.data'), codec), curr_particle_events)
+
+#The result batch_worker gives tasks it didn't run, which SimManager.run
+#then queues again to run on their own
+batch_requeue = 'requeue'
+
+#Lines of a batched dynarun's output about one of its simulations
+batch_log_id = re.compile(r'\bID\s*[=:]?\s*(\d+)\b')
+
+def batch_member_log(log, ID):
+    """The lines of the output of a batched dynarun for its
+    simulation ID, and those not about any one simulation"""
+    lines = []
+    for line in log.splitlines(keepends=True):
+        match = batch_log_id.search(line)
+        if match is None or int(match.group(1)) == ID:
+            lines.append(line)
+    return ''.join(lines)
+
+def batch_worker(batch):
+    """Runs a batch of worker tasks (a list of worker args), returning
+    a list of their results. Tasks with one production block of the
+    same size left to run are run together in a single dynarun. The
+    rest are not run here, as that would hold up this slot, and their
+    result is batch_requeue."""
+    results = [batch_requeue] * len(batch)
+    groups = {}
+    for idx, args in enumerate(batch):
+        block = batch_block(args)
+        if block is not None:
+            N = block[0]
+            groups.setdefault((int(N * args[5]), tuple(args[2]), args[7]), []).append((idx, block))
+
+    for (events, outputplugins, codec), members in groups.items():
+        if len(members) == 1:
+            continue
+        batchdir = os.path.join(os.path.dirname(os.path.abspath(batch[members[0][0]][1])), '.batch-'+uuid.uuid4().hex)
+        os.mkdir(batchdir)
+        try:
+            logfile = open(os.path.join(batchdir, 'run.log'), 'w')
+            print("Batched run of", ", ".join(os.path.basename(batch[idx][1])+'/'+str(block[1]) for idx, block in members), file=logfile, flush=True)
+            ext = xml_codecs[codec]['ext']
+            args = ["dynarun", '--engine', '2', '--replex-swap-mode', '0', '--replex-interval', '1e300',
+                    '-c', str(events), '-o', os.path.join(batchdir, 'config.%ID'+ext), "--out-data-file", os.path.join(batchdir, 'data.%ID'+ext)]
+            args += list(outputplugins) + [os.path.abspath(block[2]) for idx, block in members]
+            try:
+                supervised_call(args, logfile, name='batch/'+str(len(members)), cwd=batchdir)
+            except subprocess.CalledProcessError as e:
+                raise RuntimeError('Failed while running batch, command was\n"'+str(e.cmd)+'"\nSee logfile "'+str(os.path.join(batchdir, 'run.log'))+'"')
+            logfile.close()
+            log = open(os.path.join(batchdir, 'run.log')).read()
+
+            for ID, (idx, (N, counter, inputfile, outputfile, datafile, curr_particle_events)) in enumerate(members):
+                state, workdir = batch[idx][:2]
+                os.replace(os.path.join(batchdir, 'config.'+str(ID)+ext), outputfile)
+                os.replace(os.path.join(batchdir, 'data.'+str(ID)+ext), datafile)
+                record_manifest(outputfile, datafile)
+                with open(os.path.join(workdir, 'run.log'), 'a') as f:
+                    print("\n", file=f)
+                    print("################################", file=f)
+                    print("#    Production Run (Batch)    #", file=f)
+                    print("################################\n", file=f)
+                    print("Run "+str(counter)+" was simulation "+str(ID)+" of the batch\n", file=f)
+                    f.write(batch_member_log(log, ID))
+                block = block_record(counter, outputfile, datafile)
+                append_journal(workdir, block, curr_particle_events + block['events'] / block['N'])
+                results[idx] = {'dir':os.path.basename(workdir), 'state':state, 'blocks':[block]}
+        finally:
+            shutil.rmtree(batchdir)
+    return results
+
 def perdir(args):
-    output_dir, particle_equil_events, manager = args
+    """Extracts the outputs of a state directory. The state and the
+    completed blocks of the directory come from the run database.
+
+    The reduction can be resumed from a partial reduction: blocks is
+    then only the blocks after the partial reduction, with
+    executed_events, dataout (pickled), and digest taken from it.
+    Returns the reduced outputs, and a run database record of the
+    per-block values and the new partial reduction."""
+    output_dir, particle_equil_events, manager, state, blocks, executed_events, dataout, digest, key = args
+    dirname = output_dir
     output_dir = os.path.join(manager.workdir, output_dir)
-    if not os.path.isdir(output_dir):
-        return {}
     
-    configs = glob.glob(os.path.join(output_dir, "*.config.xml.bz2"))
-    if len(configs) == 0:
-        return {}
-
-    try:
-        state = pickle.load(open(os.path.join(output_dir, "state.pkl"), 'rb'))
-    except FileNotFoundError:
-        print("Skipping: Could not find state.pkl in ", output_dir)
-        return {}
-    statedict, state = make_state(state)
-
-    #Filter to only the set states (if enabled)
-    if manager.only_current_statevars and state not in manager.states:
-        return {}
+    #Only the parts of the output files used by the outputs are parsed
+    paths = manager.output_paths()
+
+    start_time = time.time()
+    dataout = {} if dataout is None else pickle.loads(dataout)
+    properties = []
+    processed = []
+    for block in blocks:
+        if not block_intact(output_dir, block):
+            print("Skipping the rest of", output_dir, "as the files of block", block['counter'], "are missing")
+            break
+        configfilename = os.path.join(output_dir, block['config'])
+        datafilename = os.path.join(output_dir, block['data'])
+        counter = block['counter'] + 1
         
-    counter = 0
-    executed_events = 0
-
-    dataout = {}
-    while True:
-        if True:
-        #try:
-            configfilename = os.path.join(output_dir, str(counter)+'.config.xml.bz2')
-            datafilename = os.path.join(output_dir, str(counter)+'.data.xml.bz2')
-            counter += 1
-            
-            if (not os.path.isfile(configfilename)) or (not os.path.isfile(datafilename)):
-                break
-            
-            outputfile = OutputFile(datafilename)
-            run_events = outputfile.events()
-            N = outputfile.N()
+        if executed_events < particle_equil_events * block['N']:
+            executed_events += block['events']
+            #A warm started state only has a short equilibration run
+            if block.get('warm_start'):
+                executed_events = max(executed_events, particle_equil_events * block['N'])
+            processed.append(block)
+            continue
             
-            if executed_events < particle_equil_events * N:
-                executed_events += run_events
-                continue
-            
-            if "NEventsTot" not in dataout:
-                dataout["NEventsTot"] = 0
-            dataout["NEventsTot"] += outputfile.events()
+        if "NEventsTot" not in dataout:
+            dataout["NEventsTot"] = 0
+        dataout["NEventsTot"] += block['events']
                 
-            if "tTotal" not in dataout:
-                dataout["tTotal"] = 0
-            dataout["tTotal"] += outputfile.t()
-                            
-            for prop in manager.outputs:
-                outputplugin = OutputFile.output_props[prop]
-                result = outputplugin.result(state, outputfile, configfilename, counter, manager, output_dir)
-                if result != None:
-                    if prop not in dataout:
-                        dataout[prop] = outputplugin.init()
-                    dataout[prop] += result
-        #except Exception as e:
-        #    print("Processing", output_dir, " gave exception", e)
-        #    #raise
-    return {state: dataout}
+        if "tTotal" not in dataout:
+            dataout["tTotal"] = 0
+        dataout["tTotal"] += block['t']
+
+        #Blocks resumed from checkpoints are processed segment by
+        #segment. Properties which only use the config (no paths) are
+        #only taken from the final config.
+        outputfiles = [(os.path.join(output_dir, segment['config']), OutputFile(os.path.join(output_dir, segment['data']), paths))
+                       for segment in json.loads(block.get('segments') or '[]')]
+        outputfiles.append((configfilename, OutputFile(datafilename, paths)))
+        for prop in manager.outputs:
+            outputplugin = OutputFile.output_props[prop]
+            segments = outputfiles if outputplugin.paths() != [] else outputfiles[-1:]
+            result = merge_segments([outputplugin.result(state, outputfile, segment_config, counter, manager, output_dir) for segment_config, outputfile in segments])
+            if result != None:
+                #Pickled now, as adding to the total modifies the result
+                properties.append((block['counter'], prop, pickle.dumps(result)))
+                if prop not in dataout:
+                    dataout[prop] = outputplugin.init()
+                dataout[prop] += result
+        processed.append(block)
+
+    reduction = None
+    if len(processed) > 0:
+        reduction = {'key':key, 'blocks':processed[-1]['counter'] + 1, 'digest':blocks_digest(processed, digest),
+                     'executed_events':executed_events, 'value':pickle.dumps(dataout)}
+    return {state: dataout}, {'dir':dirname, 'properties':properties, 'reduction':reduction, 'parse_seconds':time.time() - start_time}
+
+def relative_error(value):
+    """The largest relative standard error of a WeightedFloat or
+    WeightedArray, or nan if it can't be estimated yet (fewer than two
+    samples, or an average and error of zero). Elements of an array
+    which are always zero (e.g., the core of a radial distribution)
+    are ignored."""
+    if value._count < 2:
+        return float('nan')
+    error = np.abs(np.asarray(value.std_error(), dtype=float))
+    avg = np.abs(np.asarray(value.avg(), dtype=float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative = np.atleast_1d(error / avg)
+    #A zero average with an error is infinitely far from converged
+    relative = relative[~np.isnan(relative)]
+    if relative.size == 0 or np.isnan(error).any():
+        return float('nan')
+    return float(np.max(relative))
+
+def convergence_worker(args):
+    """Checks if the outputs of a state (over all its restarts) have
+    reached their target relative errors, given the perdir arguments
+    of its directories (see SimManager.convergence_args). Returns if
+    it has, and the run database records of the updated reductions."""
+    state, perdir_args, target_error = args
+    totals = {}
+    records = []
+    for dirargs in perdir_args:
+        result, record = perdir(dirargs)
+        records.append(record)
+        for prop in target_error:
+            if prop in result[state]:
+                totals[prop] = result[state][prop] if prop not in totals else totals[prop] + result[state][prop]
+    return all(prop in totals and relative_error(totals[prop]) <= target for prop, target in target_error.items()), records
 
 def make_state(state):
     #Convert anything (list, tuple, dict) to a state dictionary
@@ -385,16 +1997,19 @@ import shutil
 
         
 def reorg_dir_worker(args):
-    entry, manager = args
+    entry, oldstate, blocks, manager = args
     oldpath = os.path.join(manager.workdir, entry)
     if os.path.isdir(oldpath):
-        configs = glob.glob(os.path.join(oldpath, "*.config.xml.bz2"))
-        if len(configs) == 0:
-            return []
-        oldstate = pickle.load(open(os.path.join(oldpath, "state.pkl"), 'rb'))
+        if len(blocks) > 0:
+            config = os.path.join(oldpath, blocks[0]['config'])
+        else:
+            config = find_xmlfile(os.path.join(oldpath, "start.config"))
+            if config is None:
+                return []
         oldstatedict, oldstate = make_state(oldstate)
 
-        XMLconfig = ConfigFile(configs[0])
+        #The state variables only need the tags before the particle data
+        XMLconfig = ConfigFile(config, header_only=True)
         newstate = oldstatedict.copy()
         for statevar in manager.used_statevariables:
             can_regen = ConfigFile.config_props[statevar]['recalculable']
@@ -415,14 +2030,563 @@ def reorg_dir_worker(args):
         return [(oldpath, newstate)]
     return []
 
+# ###############################################
+# #                 Telemetry                   #
+# ###############################################
+class Telemetry:
+    """Live metrics of a sweep. They are published (at most every
+    interval seconds) in the Prometheus text format to metrics_file,
+    e.g. for the node exporter's textfile collector, and served as
+    JSON (or Prometheus text at /metrics) by an HTTP server on
+    localhost:http_port. Both are optional. The server only binds its
+    port from serve() until close().
+
+    Metrics are set by name, with an optional dict of labels, e.g.
+    set('tasks', 3, {'state':'running'})."""
+    def __init__(self, metrics_file=None, http_port=None, interval=5, prefix='pydynamo_'):
+        import threading
+        self.metrics_file = metrics_file
+        self.http_port = http_port
+        self.interval = interval
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        #Each metric is a dict of its labels (as a sorted tuple of items) to its value
+        self._metrics = {}
+        self._help = {}
+        self._published = 0
+        self._server = None
+        #The port the server is bound to, once serving
+        self.port = None
+
+    def set(self, name, value, labels=None, help=None):
+        with self._lock:
+            self._metrics.setdefault(name, {})[tuple(sorted((labels or {}).items()))] = value
+            if help is not None:
+                self._help[name] = help
+
+    def inc(self, name, value=1, labels=None, help=None):
+        with self._lock:
+            key = tuple(sorted((labels or {}).items()))
+            metric = self._metrics.setdefault(name, {})
+            metric[key] = metric.get(key, 0) + value
+            if help is not None:
+                self._help[name] = help
+
+    def clear(self, name):
+        """Removes all the (labelled) values of a metric"""
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def snapshot(self):
+        """The metrics as a dict, unlabelled metrics are just their
+        value and labelled ones a list of {'labels':..., 'value':...}"""
+        with self._lock:
+            result = {'time':time.time()}
+            for name, values in self._metrics.items():
+                if list(values) == [()]:
+                    result[name] = values[()]
+                else:
+                    result[name] = [{'labels':dict(labels), 'value':value} for labels, value in values.items()]
+            return result
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            for name in sorted(self._metrics):
+                if name in self._help:
+                    lines.append('# HELP '+self.prefix+name+' '+self._help[name])
+                lines.append('# TYPE '+self.prefix+name+' '+('counter' if name.endswith('_total') else 'gauge'))
+                for labels, value in sorted(self._metrics[name].items()):
+                    label_text = ','.join(key+'="'+str(val).replace('\\', '\\\\').replace('"', '\\"')+'"' for key, val in labels)
+                    lines.append(self.prefix+name+('{'+label_text+'}' if label_text else '')+' '+repr(float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def publish(self, force=False):
+        """Writes the metrics file, if it is due"""
+        if self.metrics_file is None or (not force and time.time() - self._published < self.interval):
+            return
+        self._published = time.time()
+        tmpname = self.metrics_file + '.tmp' + str(os.getpid())
+        with open(tmpname, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmpname, self.metrics_file)
+
+    def serve(self):
+        """Starts the HTTP server, if there is a port and it isn't running"""
+        if self.http_port is None or self._server is not None:
+            return
+        import threading
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        telemetry = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') == '/metrics':
+                    body, content_type = telemetry.prometheus().encode(), 'text/plain; version=0.0.4'
+                else:
+                    body, content_type = json.dumps(telemetry.snapshot()).encode(), 'application/json'
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.http_port), Handler)
+        #Port 0 picks a free port
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        """Publishes the final metrics and stops the HTTP server"""
+        self.publish(force=True)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+# ###############################################
+# #               CPU placement                 #
+# ###############################################
+#Each executor slot can be pinned to its own set of cores (see
+#plan_core_sets), so the OS doesn't migrate simulations between cores
+#and sockets. Pool processes are pinned when they start, and
+#dynarun/dynamod inherit this. Threads can't be pinned separately, so
+#ThreadExecutor instead passes the core set of each task to the
+#supervisor, which pins the processes it starts.
+import threading
+_placement = threading.local()
+
+def parse_cpulist(text):
+    """Parses a Linux cpulist (e.g., "0-3,8-11") into a list of cores"""
+    cores = []
+    for part in text.strip().split(','):
+        if part:
+            first, _, last = part.partition('-')
+            cores += list(range(int(first), int(last or first) + 1))
+    return cores
+
+def numa_nodes():
+    """The cores this process may use on each NUMA node, as a dict of
+    the node number to a sorted list of its cores. Without NUMA
+    information, everything is on node 0."""
+    usable = os.sched_getaffinity(0)
+    nodes = {}
+    for path in glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'):
+        node = int(re.search(r'node(\d+)', path).group(1))
+        with open(path) as f:
+            cores = [core for core in parse_cpulist(f.read()) if core in usable]
+        if cores:
+            nodes[node] = cores
+    if not nodes:
+        nodes = {0: sorted(usable)}
+    return nodes
+
+def plan_core_sets(slots, reserve=0, numa=False):
+    """Splits the usable cores into slots core sets, one per executor
+    slot. The first reserve cores are left free for the parent process
+    (e.g., the scheduling and the data processing). With numa, each
+    set is within a single NUMA node, and the slots are shared between
+    the nodes in proportion to their cores. If there are more slots
+    than cores, cores are shared."""
+    nodes = numa_nodes()
+    cores = [core for node in sorted(nodes) for core in nodes[node]]
+    reserved = set(cores[:reserve])
+    groups = [[core for core in nodes[node] if core not in reserved] for node in sorted(nodes)] if numa else [cores[reserve:]]
+    groups = [group for group in groups if group]
+    if not groups:
+        raise RuntimeError("No cores are left for the simulations after reserving "+str(reserve))
+    total = sum(map(len, groups))
+    #The slots of each group, by largest remainder
+    shares = [slots * len(group) / total for group in groups]
+    counts = [int(share) for share in shares]
+    for idx in sorted(range(len(groups)), key=lambda idx: counts[idx] - shares[idx])[:slots - sum(counts)]:
+        counts[idx] += 1
+    core_sets = []
+    for group, count in zip(groups, counts):
+        if count == 0:
+            #More NUMA nodes than slots, this node gets none
+            continue
+        if count <= len(group):
+            core_sets += [list(map(int, cores)) for cores in np.array_split(group, count)]
+        else:
+            core_sets += [[group[idx % len(group)]] for idx in range(count)]
+    return core_sets
+
+def pin_process(core_sets, counter):
+    """Pins a pool process to the next of core_sets. counter is a shared multiprocessing.Value, so processes the pool
+    respawns (e.g., after maxtasksperchild or a crash) wrap around the
+    core sets instead of waiting for one that will never come."""
+    with counter.get_lock():
+        idx = counter.value
+        counter.value += 1
+    os.sched_setaffinity(0, core_sets[idx % len(core_sets)])
+
+def init_pool_process(status_queue, core_sets=None, counter=None):
+    """Pool initializer of LocalExecutor. The status of the processes
+    the pool process supervises is forwarded to status_queue, and it
+    is pinned to a core set if core_sets is given (see pin_process)."""
+    global _status_queue
+    _status_queue = status_queue
+    if core_sets:
+        pin_process(core_sets, counter)
+
+def current_cores():
+    """The cores the current ThreadExecutor task is pinned to, or None"""
+    return getattr(_placement, 'cores', None)
+
+# ###############################################
+# #                 Executors                   #
+# ###############################################
+#SimManager.run hands the blocks of each state point to an executor.
+#It only submits a task when the executor has a free slot, and only
+#submits the next block of a state point once the last one has
+#completed, so the executors don't need to know about dependencies.
+
+class Executor(abc.ABC):
+    """Runs worker tasks for SimManager.run. slots is how many tasks
+    can run at once. submit must call either callback(result) or
+    error_callback(exception) (from any thread) when the task is done.
+    The local executors can pin each slot to one of core_sets (see
+    plan_core_sets)."""
+    slots = 1
+    core_sets = None
+
+    @abc.abstractmethod
+    def submit(self, fn, args, callback, error_callback):
+        pass
+
+    def close(self):
+        pass
+
+    def status(self):
+        """The SupervisedProcess of each running simulation, if the
+        executor can see them"""
+        return []
+
+    def __getstate__(self):
+        #Pools, threads and the like stay in the process that made them
+        return {key:value for key, value in self.__dict__.items() if not key.startswith('_')}
+
+class LocalExecutor(Executor):
+    """Runs tasks in a multiprocessing pool on this machine. The pool
+    processes forward the status of their simulations, so they can be
+    reported live like those of a ThreadExecutor."""
+    def __init__(self, processes=None, core_sets=None):
+        self.slots = processes if processes is not None else cpu_count()
+        self.core_sets = core_sets
+
+    def submit(self, fn, args, callback, error_callback):
+        if getattr(self, '_pool', None) is None:
+            import multiprocessing
+            self._status_queue = multiprocessing.Queue()
+            #(pool process pid, key) -> SupervisedProcess
+            self._running = {}
+            #Each pool process takes the next core set as it starts
+            counter = multiprocessing.Value('i', 0)
+            self._pool = Pool(processes=self.slots, initializer=init_pool_process, initargs=(self._status_queue, self.core_sets, counter))
+        self._pool.apply_async(fn, args=args, callback=callback, error_callback=error_callback)
+
+    def close(self):
+        if getattr(self, '_pool', None) is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._status_queue.close()
+            self._status_queue = None
+
+    def status(self):
+        if getattr(self, '_status_queue', None) is None:
+            return []
+        import queue
+        while True:
+            try:
+                pid, key, status = self._status_queue.get_nowait()
+            except queue.Empty:
+                break
+            if status is None:
+                self._running.pop((pid, key), None)
+            else:
+                self._running[(pid, key)] = status
+        #A pool process which died can't say its simulations finished
+        for pid, key in list(self._running):
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                del self._running[(pid, key)]
+        return list(self._running.values())
+
+class ThreadExecutor(Executor):
+    """Runs tasks in threads of this process. The simulations are
+    still separate processes, but they are all run by this process's
+    supervisor, so SimManager.run can report their progress live."""
+    def __init__(self, slots=None, core_sets=None):
+        self.slots = slots if slots is not None else cpu_count()
+        self.core_sets = core_sets
+
+    def submit(self, fn, args, callback, error_callback):
+        if getattr(self, '_pool', None) is None:
+            from concurrent.futures import ThreadPoolExecutor
+            import queue
+            self._pool = ThreadPoolExecutor(self.slots)
+            #The core sets not in use by a running task
+            self._free_cores = queue.Queue()
+            for idx in range(self.slots if self.core_sets else 0):
+                self._free_cores.put(self.core_sets[idx % len(self.core_sets)])
+        def done(future):
+            if future.exception() is not None:
+                error_callback(future.exception())
+            else:
+                callback(future.result())
+        self._pool.submit(self._pinned, fn, args).add_done_callback(done)
+
+    def _pinned(self, fn, args):
+        """Runs fn with the processes it starts pinned to a free core set"""
+        if not self.core_sets:
+            return fn(*args)
+        _placement.cores = self._free_cores.get()
+        try:
+            return fn(*args)
+        finally:
+            self._free_cores.put(_placement.cores)
+            _placement.cores = None
+
+    def close(self):
+        if getattr(self, '_pool', None) is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def status(self):
+        return supervisor().status()
+
+#Jobs for other machines are pickled to a file which is run by
+#"pydynamo.py --run-job JOBFILE RESULTFILE". Functions are pickled by
+#reference, so the remote side needs to import the script that made
+#the job. Like multiprocessing's spawn start method, this means the
+#main script must be safe to import (i.e., its sweep must be under an
+#'if __name__ == "__main__":' guard) if it defines the setup_worker.
+job_env = 'PYDYNAMO_JOB'
+
+def write_job(jobfile, fn, args):
+    main = getattr(sys.modules['__main__'], '__file__', None)
+    job = {'cwd':os.getcwd(), 'sys_path':sys.path, 'main':os.path.abspath(main) if main else None,
+           'task':pickle.dumps((fn, args))}
+    with open(jobfile+'.tmp', 'wb') as f:
+        pickle.dump(job, f)
+    os.replace(jobfile+'.tmp', jobfile)
+
+def read_job_result(resultfile):
+    """Returns (successful, result or exception) of a job, or None if it hasn't finished"""
+    try:
+        with open(resultfile, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+def run_job(jobfile, resultfile):
+    """Runs a job written by write_job, saving (successful, result or exception) to resultfile"""
+    import runpy, types
+    try:
+        job = pickle.load(open(jobfile, 'rb'))
+        os.chdir(job['cwd'])
+        sys.path[:0] = [path for path in job['sys_path'] if path not in sys.path]
+        os.environ[job_env] = jobfile
+        try:
+            fn, args = pickle.loads(job['task'])
+        except AttributeError:
+            if job['main'] is None:
+                raise
+            #Load the main script, as functions defined there are pickled as __main__.name
+            main = types.ModuleType('__mp_main__')
+            main.__dict__.update(runpy.run_path(job['main'], run_name='__mp_main__'))
+            sys.modules['__main__'] = sys.modules['__mp_main__'] = main
+            fn, args = pickle.loads(job['task'])
+        outcome = (True, fn(*args))
+    except Exception as e:
+        import traceback
+        outcome = (False, RuntimeError('Job "'+jobfile+'" failed on '+os.uname().nodename+'\n'+''.join(traceback.format_exception(type(e), e, e.__traceback__))))
+    with open(resultfile+'.tmp', 'wb') as f:
+        pickle.dump(outcome, f)
+    os.replace(resultfile+'.tmp', resultfile)
+
+class SSHExecutor(Executor):
+    """Runs tasks over ssh on a list of hosts, which must share the
+    working directory (and this script) with this machine. Hosts are
+    given as "host" or "host:slots" for hosts running several tasks
+    at once. Job files are written to jobdir, which must also be
+    shared."""
+    def __init__(self, hosts, jobdir, python='python3', ssh=('ssh', '-o', 'BatchMode=yes')):
+        self.hosts = []
+        for host in hosts:
+            name, _, slots = host.partition(':')
+            self.hosts += [name] * int(slots or 1)
+        self.slots = len(self.hosts)
+        self.jobdir = os.path.abspath(jobdir)
+        self.python = python
+        self.ssh = list(ssh)
+
+    def submit(self, fn, args, callback, error_callback):
+        import threading, queue, shlex
+        if getattr(self, '_free', None) is None:
+            os.makedirs(self.jobdir, exist_ok=True)
+            self._free = queue.Queue()
+            for host in self.hosts:
+                self._free.put(host)
+        jobfile = os.path.join(self.jobdir, uuid.uuid4().hex+'.job')
+        write_job(jobfile, fn, args)
+        def run():
+            host = self._free.get()
+            try:
+                command = ' '.join(map(shlex.quote, [self.python, os.path.abspath(__file__), '--run-job', jobfile, jobfile+'.result']))
+                proc = subprocess.run(self.ssh + [host, command], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                outcome = read_job_result(jobfile+'.result')
+                if outcome is None:
+                    outcome = (False, RuntimeError('Job "'+jobfile+'" on '+host+' exited with '+str(proc.returncode)+', output was\n'+proc.stdout.decode(errors='replace')))
+            except Exception as e:
+                outcome = (False, e)
+            finally:
+                self._free.put(host)
+            for filename in (jobfile, jobfile+'.result'):
+                if os.path.exists(filename):
+                    os.remove(filename)
+            (callback if outcome[0] else error_callback)(outcome[1])
+        threading.Thread(target=run, daemon=True).start()
+
+class QueueExecutor(Executor):
+    """Puts tasks in a directory based job queue, to be run by
+    "pydynamo.py --drain QUEUEDIR" on any machine sharing the working
+    directory (e.g., as a job array submitted to a cluster
+    scheduler). slots is how many tasks are queued/running at once.
+
+    The queue has pending/, running/ and done/ subdirectories. Jobs
+    are claimed by renaming them from pending/ to running/, which is
+    atomic, and their results written to done/. While a job runs, the
+    drainer touches its file in running/ as a heartbeat. If it goes
+    lease_timeout seconds without one (e.g., the drainer was killed by
+    the scheduler), the job fails, so SimManager.run retries it."""
+    def __init__(self, queuedir, slots, poll_interval=5, lease_timeout=600):
+        self.queuedir = os.path.abspath(queuedir)
+        self.slots = slots
+        self.poll_interval = poll_interval
+        self.lease_timeout = lease_timeout
+
+    def submit(self, fn, args, callback, error_callback):
+        import threading
+        if getattr(self, '_jobs', None) is None:
+            for subdir in ('pending', 'running', 'done'):
+                os.makedirs(os.path.join(self.queuedir, subdir), exist_ok=True)
+            self._jobs = {}
+            self._abandoned = set()
+            self._lock = threading.Lock()
+            self._counter = 0
+            threading.Thread(target=self._poll, daemon=True).start()
+        with self._lock:
+            #Jobs are named so the queue is drained in submission order
+            name = '{:09d}-{}.job'.format(self._counter, os.getpid())
+            self._counter += 1
+            self._jobs[name] = (callback, error_callback)
+        write_job(os.path.join(self.queuedir, 'pending', name), fn, args)
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                jobs = list(self._jobs)
+            for name in list(self._abandoned):
+                resultfile = os.path.join(self.queuedir, 'done', name+'.result')
+                if os.path.exists(resultfile):
+                    os.remove(resultfile)
+                    self._abandoned.discard(name)
+            for name in jobs:
+                resultfile = os.path.join(self.queuedir, 'done', name+'.result')
+                outcome = read_job_result(resultfile)
+                if outcome is None:
+                    outcome = self._expired(name)
+                    if outcome is None:
+                        continue
+                else:
+                    os.remove(resultfile)
+                with self._lock:
+                    callback, error_callback = self._jobs.pop(name)
+                (callback if outcome[0] else error_callback)(outcome[1])
+
+    def _expired(self, name):
+        """Fails a running job whose drainer has stopped heartbeating"""
+        jobfile = os.path.join(self.queuedir, 'running', name)
+        try:
+            age = time.time() - os.stat(jobfile).st_mtime
+        except FileNotFoundError:
+            #Still pending, or finished between the checks
+            return None
+        if age < self.lease_timeout:
+            return None
+        try:
+            os.remove(jobfile)
+        except FileNotFoundError:
+            return None
+        #In case the drainer was only stalled, its result is thrown away
+        self._abandoned.add(name)
+        return (False, RuntimeError('Job "'+jobfile+'" has had no heartbeat for '+str(int(age))+'s, its drainer has probably died'))
+
+def drain_queue(queuedir, idle_timeout=None, poll_interval=5, heartbeat=60):
+    """Runs jobs from a QueueExecutor's queue until it has been empty
+    for idle_timeout seconds (or forever if None). The file of the
+    running job is touched every heartbeat seconds, which must be well
+    below the QueueExecutor's lease_timeout."""
+    #Jobs change the working directory
+    queuedir = os.path.abspath(queuedir)
+    pending, running, done = [os.path.join(queuedir, subdir) for subdir in ('pending', 'running', 'done')]
+    idle_since = time.time()
+    while idle_timeout is None or time.time() - idle_since < idle_timeout:
+        for name in sorted(os.listdir(pending)):
+            if not name.endswith('.job'):
+                continue
+            jobfile = os.path.join(running, name)
+            try:
+                os.rename(os.path.join(pending, name), jobfile)
+            except OSError:
+                #Another worker claimed it first
+                continue
+            #The rename keeps the submission time, so renew the lease now
+            try:
+                os.utime(jobfile)
+            except FileNotFoundError:
+                #It had waited so long it was failed as we claimed it
+                continue
+            stop = threading.Event()
+            def beat(jobfile, stop):
+                while not stop.wait(heartbeat):
+                    try:
+                        os.utime(jobfile)
+                    except OSError:
+                        #The lease expired and the job was failed
+                        return
+            threading.Thread(target=beat, args=(jobfile, stop), daemon=True).start()
+            try:
+                run_job(jobfile, os.path.join(done, name+'.result'))
+            finally:
+                stop.set()
+            if os.path.exists(jobfile):
+                os.remove(jobfile)
+            idle_since = time.time()
+            break
+        else:
+            time.sleep(poll_interval)
+
 class SimManager:
-    def __init__(self, workdir, statevars, outputs, restarts=1, processes=None):
+    def __init__(self, workdir, statevars, outputs, restarts=1, processes=None, codec='bz2', executor=None, skip_state=None,
+                 metrics_file=None, metrics_port=None, pin_cores=False, numa=False, reserve_cores=0):
         if not shutil.which("dynamod"):
             raise RuntimeError("Could not find dynamod executable.")
 
         if not shutil.which("dynarun"):
             raise RuntimeError("Could not find dynamod executable.")
 
+        if codec not in xml_codecs:
+            raise RuntimeError('Unknown codec "'+codec+'", valid codecs are '+', '.join(xml_codecs))
+        #The codec used to compress the config and data files of new runs
+        self.codec = codec
+
         self.restarts = restarts
         self.outputs = set(outputs)
         self.workdir = workdir
@@ -433,10 +2597,19 @@ class SimManager:
         
         #Make sure the state vars are in ascending order for easy output to screen
         self.statevars = [[(key, sorted(value)) for key, value in sweep] for sweep in statevars]
+
+        #skip_state(state) is called with the dict of each generated
+        #state, which is dropped from the sweep if it returns True (or
+        #raises SkipThisPoint). This prunes states before any tasks
+        #are made for them, unlike raising SkipThisPoint in the
+        #setup_worker. It stays in this process, so can be a lambda.
+        self._skip_state = skip_state
        
         #Now create all states for iteration. We need to do this now,
         #as we need to get the generated state variables too.
         self.states = self.iterate_state(self.statevars)
+        if len(self.states) == 0:
+            raise RuntimeError("Every state point was rejected by the skip_state filter")
 
         #We need a list of the state variables used 
         self.used_statevariables = list(map(lambda x : x[0], next(iter(self.states))))
@@ -463,9 +2636,86 @@ class SimManager:
             
         if not os.path.isdir(workdir):
             os.mkdir(workdir)
+        self.db = RunDB(workdir)
         self.processes = processes
         if self.processes is None:
             self.processes = cpu_count()
+        #Where the simulations are run, the data processing is
+        #always done locally
+        self.executor = executor
+        if self.executor is None:
+            self.executor = LocalExecutor(self.processes if processes is not None or not pin_cores else max(1, len(os.sched_getaffinity(0)) - reserve_cores))
+        #With pin_cores, each slot of the executor runs its
+        #simulations on its own cores, within a single NUMA node if
+        #numa is set. reserve_cores cores are kept free for this
+        #process and its data processing.
+        if pin_cores:
+            if not isinstance(self.executor, (LocalExecutor, ThreadExecutor)):
+                raise RuntimeError("Cores can only be pinned with the local executors, not "+type(self.executor).__name__)
+            self.executor.core_sets = plan_core_sets(self.executor.slots, reserve_cores, numa)
+            print("Pinning", self.executor.slots, "slots to cores", " ".join(','.join(map(str, cores)) for cores in self.executor.core_sets))
+        #Live metrics of run and fetch_data, written to metrics_file
+        #and/or served on localhost:metrics_port (see Telemetry)
+        self._telemetry = Telemetry(metrics_file, metrics_port)
+
+    def __getstate__(self):
+        #The manager is passed to the pool processes, but the state
+        #filter might not pickle
+        return {key:value for key, value in self.__dict__.items() if not key.startswith('_')}
+
+    def close(self):
+        """Releases the metrics port and closes the run database"""
+        self._telemetry.close()
+        if self.db._conn is not None:
+            self.db._conn.close()
+            self.db._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def skipped(self, state):
+        """If the state is pruned by the skip_state filter"""
+        if self._skip_state is None:
+            return False
+        try:
+            return bool(self._skip_state(dict(state)))
+        except SkipThisPoint:
+            return True
+
+    def import_dirs(self, rescan=False):
+        """Imports state directories missing from the run database
+        (e.g., made by older versions) by scanning their files. This
+        is only done once per workdir, unless rescan is set, in which
+        case every directory is rescanned."""
+        #The directories are only where the database says once any
+        #interrupted reorganisation is finished
+        self.finish_reorg()
+        if not rescan and self.db.get_meta('imported') is not None:
+            return
+        known = set(self.db.dirs())
+        entries = [d for d in os.listdir(self.workdir) if (rescan or d not in known) and not d.startswith(RunDB.filename)]
+        if len(entries) > 0:
+            print("Importing existing data directories into the run database...")
+            with Pool(processes=self.processes) as pool, alive_progress.alive_bar(len(entries)) as progress:
+                for record in pool.imap_unordered(scan_dir, [(d, self) for d in entries], chunksize=10):
+                    if record is not None:
+                        self.db.record(record)
+                    progress()
+        self.db.set_meta('imported', '1')
+
+    def output_paths(self):
+        """The union of the output file XPaths read by the outputs, or
+        None if any of them needs the whole file."""
+        paths = []
+        for output in self.outputs:
+            output_paths = OutputFile.output_props[output].paths()
+            if output_paths is None:
+                return None
+            paths += output_paths
+        return paths
 
     def getstatedir(self, state, idx):
         return os.path.join(self.workdir, self.statename(state) + "_" + str(idx))
@@ -491,31 +2741,105 @@ class SimManager:
             if not os.path.isdir(newpath) and not os.path.isfile(newpath):
                 return newpath            
             idx += 1
-            
-    def reorg_dirs(self):
-        entries = os.listdir(self.workdir)
+
+    def plan_moves(self, actions, entries):
+        """Plans the renames to bring the state directories in line
+        with their states. actions is a list of (old directory name,
+        new state), and entries the names in the workdir. Returns a
+        list of (old name, new name, new state).
+
+        Like getnextstatedir, every directory takes the lowest free
+        restart index of its new state, which includes the names of
+        directories moving away. Directories already named for their
+        state are placed first, so they only ever move down."""
+        moving = {}
+        for olddir, newstate in actions:
+            prefix = self.statename(newstate) + '_'
+            idx = olddir[len(prefix):]
+            #Sorts the directories already named for their state first, by index
+            key = (0, int(idx), olddir) if olddir.startswith(prefix) and idx.isdigit() else (1, 0, olddir)
+            moving[olddir] = (key, prefix, newstate)
+        occupied = set(entries) - set(moving)
+        #The next restart index to try for each state
+        next_idx = {}
+        moves = []
+        for olddir in sorted(moving, key=lambda olddir : moving[olddir][0]):
+            key, prefix, newstate = moving[olddir]
+            idx = next_idx.get(prefix, 0)
+            while prefix + str(idx) in occupied:
+                idx += 1
+            next_idx[prefix] = idx + 1
+            occupied.add(prefix + str(idx))
+            moves.append((olddir, prefix + str(idx), newstate))
+        return moves
+
+    def reorg_dirs(self, threads=16):
+        """Renames the state directories to match the state variables
+        recalculated from their configs. The renames are done by
+        threads threads, as on a shared filesystem each one can take
+        a while."""
+        self.import_dirs()
+        states = self.db.states()
+        entries = [(d, states[d], self.db.blocks(d)) for d in sorted(states)]
         print("Reorganising existing data directories...")
         n = len(entries)
-        
-        pool = Pool(processes=self.processes)
-        with alive_progress.alive_bar(n) as progress:
+
+        actions = []
+        with Pool(processes=self.processes) as pool, alive_progress.alive_bar(n) as progress:
             #This is a parallel loop, returning items as they finish in arbitrary order
-            for actions in pool.imap_unordered(reorg_dir_worker, [(d, self) for d in entries], chunksize=10):
-                #We do the actual moving here. We only want one thread
-                #doing the moving as it must check what directories
-                #already exist to figure out the new name. This is
-                #hard to do in parallel
-                for oldpath, newstate in actions:
-                    newpath = self.getnextstatedir(newstate, oldpath=oldpath)
-                    if oldpath != newpath:
-                        shutil.move(oldpath, newpath)
+            for result in pool.imap_unordered(reorg_dir_worker, [(d, state, blocks, self) for d, state, blocks in entries], chunksize=10):
+                actions += [(os.path.basename(oldpath), newstate) for oldpath, newstate in result]
                 progress()
+
+        #The moves are planned all at once from a single listing of
+        #the workdir, rather than probing for a free name for each
+        moves = self.plan_moves(actions, os.listdir(self.workdir))
+        if any(olddir != newdir for olddir, newdir, newstate in moves):
+            #Everything goes through a temporary name first, so a
+            #directory can take the old name of another. The names are
+            #unique to this plan, so never clash with leftovers.
+            token = uuid.uuid4().hex[:8]
+            tmpnames = {olddir: '.reorg-'+token+'-'+str(idx) for idx, (olddir, newdir, newstate) in enumerate(moves) if olddir != newdir}
+            #The plan is saved before anything is renamed, so an
+            #interrupted reorganisation is finished by the next
+            #finish_reorg (see import_dirs)
+            self.db.set_meta(RunDB.reorg_key, pickle.dumps({'moves':moves, 'tmpnames':tmpnames, 'stage':0}))
+        self.finish_reorg(threads)
+
+    def finish_reorg(self, threads=16):
+        """Carries out the saved plan of reorg_dirs, which is
+        resumable. Each rename is atomic and each stage is recorded
+        once done, so an interrupted stage is redone, skipping the
+        renames that already happened. The run database is updated
+        and the plan dropped in a single transaction at the end."""
+        plan = self.db.get_meta(RunDB.reorg_key)
+        if plan is None:
+            return
+        plan = pickle.loads(plan)
+        moves, tmpnames = plan['moves'], plan['tmpnames']
+        path = lambda name : os.path.join(self.workdir, name)
+        def rename(src, dst):
+            #Done by an earlier, interrupted attempt if src has gone
+            if os.path.exists(path(src)):
+                os.rename(path(src), path(dst))
+        from concurrent.futures import ThreadPoolExecutor
+        if tmpnames:
+            print("Moving", len(tmpnames), "directories...")
+        with ThreadPoolExecutor(threads) as executor:
+            if plan['stage'] == 0:
+                list(executor.map(lambda olddir : rename(olddir, tmpnames[olddir]), tmpnames))
+                plan['stage'] = 1
+                self.db.set_meta(RunDB.reorg_key, pickle.dumps(plan))
+            newdirs = {olddir: newdir for olddir, newdir, newstate in moves}
+            list(executor.map(lambda olddir : rename(tmpnames[olddir], newdirs[olddir]), tmpnames))
+        self.db.move_many(moves)
         
     def iterate_state(self, statevars):
         # Loop over all permutations of the state variables. We use a
         # set to automatically remove repeats, especially as we're
         # running these states in parallel.
         states = set()
+        skipped = set()
         
         import itertools
         for sweep in statevars:
@@ -531,45 +2855,52 @@ class SimManager:
                     if 'gen_state' in ConfigFile.config_props[svar]:
                         state = ConfigFile.config_props[svar]['gen_state'](state)
                 _, state = make_state(state)
-                states.add(state)
+                if self.skipped(state):
+                    skipped.add(state)
+                else:
+                    states.add(state)
+        if skipped:
+            print("Skipping", len(skipped), "state points rejected by the skip_state filter")
         return states
 
     def get_run_files(self, workdir, min_events, max_events=None):
         if max_events is None:
             max_events = float("inf")
-        counter = 0
         curr_particle_events = 0
 
-        #First, get past the min_events configs
+        dirname = os.path.basename(os.path.normpath(workdir))
+        blocks = self.db.blocks(dirname)
+        if len(blocks) == 0:
+            #Not in the run database yet, find what's there
+            record = scan_dir((dirname, self))
+            if record is not None:
+                self.db.record(record)
+                blocks = record['blocks']
+        
         equil_configs=[]
-        while curr_particle_events < min_events:
-            outputfile = os.path.join(workdir, str(counter)+'.config.xml.bz2')
-            datafile = os.path.join(workdir, str(counter)+'.data.xml.bz2')
-
-            #Check both files exist, if not, bail!
-            if not os.path.isfile(outputfile) or not validate_configfile(outputfile) or not os.path.isfile(datafile) or not validate_outputfile(datafile):
-                return equil_configs, []
-            equil_configs.append((outputfile, datafile))
-            of = OutputFile(datafile)
-            counter += 1
-            curr_particle_events += of.events() / of.N()
-
         run_configs=[]
-        while curr_particle_events < max_events:
-            outputfile = os.path.join(workdir, str(counter)+'.config.xml.bz2')
-            datafile = os.path.join(workdir, str(counter)+'.data.xml.bz2')
-
-            #Check both files exist, if not, bail!
-            if not os.path.isfile(outputfile) or not validate_configfile(outputfile) or not os.path.isfile(datafile) or not validate_outputfile(datafile):
-                return equil_configs, run_configs
+        for counter, block in enumerate(blocks):
+            #Check the blocks are contiguous and the files still exist, if not, bail!
+            if block['counter'] != counter or not block_intact(workdir, block):
+                break
             
-            run_configs.append((outputfile, datafile))
-            of = OutputFile(datafile)
-            counter += 1
-            curr_particle_events += of.events() / of.N()
+            files = (os.path.join(workdir, block['config']), os.path.join(workdir, block['data']))
+            #First, get past the min_events configs
+            if curr_particle_events < min_events:
+                equil_configs.append(files)
+            elif curr_particle_events < max_events:
+                run_configs.append(files)
+            else:
+                break
+            curr_particle_events += block['events'] / block['N']
+        return equil_configs, run_configs
             
                         
-    def run(self, setup_worker, particle_equil_events, particle_run_events, particle_run_events_block_size):            
+    def run(self, setup_worker, particle_equil_events, particle_run_events, particle_run_events_block_size, stall_timeout=600, checkpoint_events=None,
+            target_error=None, max_particle_run_events=None, warm_start=False, warm_equil_fraction=0.1, batch_size=1,
+            retries=2, retry_delay=30, retry_quarantined=False):            
+        if job_env in os.environ:
+            raise RuntimeError('SimManager.run called inside a job, the main script must be safe to import (put the sweep under if __name__ == "__main__":)')
         print("Generating simulation tasks for the following sweeps")
         for idx, sweep in enumerate(self.statevars):
             print(" Sweep", idx)
@@ -583,22 +2914,88 @@ class SimManager:
         tasks_failed = 0
         task_count = 0
         errors = []
-        pool = Pool(processes=self.processes)
+        executor = self.executor
         
+        #If target errors are given (e.g., {"p":0.01}), particle_run_events
+        #is only the minimum run length. Each state point keeps adding
+        #blocks until the relative standard errors of these outputs
+        #are below their targets, or max_particle_run_events is reached.
+        if target_error:
+            for prop in target_error:
+                if prop not in self.outputs:
+                    raise RuntimeError('Cannot converge the "'+prop+'" output as it is not one of the outputs')
+            if max_particle_run_events is None:
+                max_particle_run_events = 10 * particle_run_events
+
+        #A failed task is retried up to retries times, waiting
+        #retry_delay seconds, doubling for each further attempt. If it
+        #still fails, only its own chain is abandoned and its state
+        #directory is quarantined in the run database. Quarantined
+        #states are skipped by later runs, unless retry_quarantined
+        #is set (see also SimManager.quarantined()).
+        quarantined = self.db.quarantined()
+        if retry_quarantined:
+            self.db.release()
+            quarantined = {}
+        elif quarantined:
+            print("Skipping", len(quarantined), "quarantined state directories:", ", ".join(sorted(quarantined)))
+
+        #Up to batch_size production blocks of different state points
+        #with the same N are run together in one dynarun process (see
+        #batch_worker). This is only worth it for small systems, where
+        #starting dynarun and loading the configs dominates the
+        #runtime. Batched blocks are not checkpointed.
+        #
+        #Production runs save a checkpoint every checkpoint_events
+        #particle events (0 to disable), so they can be resumed
+        if checkpoint_events is None:
+            checkpoint_events = particle_run_events_block_size / 10
+
         print("Building task tree...")
+        db = self.db
+        import queue, heapq, traceback
+        #The pool's callbacks put each task on this queue as it
+        #finishes, so the next block of a chain is started straight
+        #away without scanning all the running tasks. The messages are
+        #(kind, tasks, successful, results or error), where kind is
+        #'run' for simulation tasks, or 'check' for convergence checks.
+        finished = queue.Queue()
+        model = CostModel(db)
+        #Blocks which are already complete cost nothing to "rerun"
+        completed = {d: {block['counter'] for block in db.blocks(d)} for d in db.dirs()}
+        manager = self
         class Task:
-            def __init__(self, workertuple):
+            def __init__(self, workertuple, blocks, restart=0):
                 self._workertuple = workertuple
+                self._restart = restart
                 self._next_tasks = []
-
-            def is_done(self):
-                return self._result.ready()
-
-            def is_successful(self):
-                return self._result.successful()
-            
-            def start(self):
-                self._result = pool.apply_async(worker, args=self._workertuple)
+                self._dirname = os.path.basename(workertuple[1])
+                #The (counter, particle events) of the blocks this task runs
+                self._blocks = blocks
+                self._attempts = 0
+                #Retries of failed batches are run on their own
+                self._single = False
+                #The particle events left in the chain from this task (see chain_cost)
+                self._chain_events = None
+
+            def args(self):
+                #Pass the blocks already completed, so the worker can skip them
+                workdir = self._workertuple[1]
+                known_blocks = {block['counter']: block for block in db.blocks(os.path.basename(workdir))}
+                #New state points can start from a finished neighbour
+                warm_source = None
+                if warm_start and not known_blocks and not os.path.isdir(workdir):
+                    warm_source = manager.warm_start_source(self._workertuple[0], self._restart)
+                return self._workertuple + (warm_source, particle_equil_events * warm_equil_fraction, known_blocks)
+
+            def batch_key(self):
+                """Tasks with the same (not None) key can be run as a batch"""
+                if batch_size < 2 or self._single or any(counter == 0 for counter, events in self._blocks):
+                    return None
+                blocks = db.blocks(self._dirname)
+                if not blocks or blocks[0]['counter'] != 0:
+                    return None
+                return (blocks[0]['N'], self._workertuple[5])
                 
             def to_follow(self, task):
                 self._next_tasks.append(task)
@@ -608,88 +3005,457 @@ class SimManager:
 
             def failed(self):
                 return 1 + sum([task.failed() for task in self._next_tasks])
+
+            def extend(self):
+                """Adds another block to the end of the chain"""
+                counter = max(counter for counter, events in self._blocks) + 1
+                new_task = Task(self._workertuple[:4] + (self._workertuple[4] + particle_run_events_block_size,) + self._workertuple[5:], [(counter, particle_run_events_block_size)], self._restart)
+                self.to_follow(new_task)
+                self._chain_events = None
+                return new_task
+
+            def run_events(self):
+                return self._workertuple[4]
+
+            def events(self):
+                """The particle events of the blocks this task has left to run"""
+                done = completed.get(self._dirname, ())
+                return sum(events for counter, events in self._blocks if counter not in done)
+
+            def cost(self):
+                """The predicted run time of the blocks this task has left to run"""
+                return self.events() * model.seconds_per_particle_event(self._dirname, self._workertuple[0])
+
+            def chain_cost(self):
+                """The predicted run time of this task and those following
+                it. A chain is all one directory, so this is the particle
+                events left in the chain, which are cached, at its rate."""
+                chain, task = [], self
+                while task is not None and task._chain_events is None:
+                    chain.append(task)
+                    task = task._next_tasks[0] if task._next_tasks else None
+                events = 0 if task is None else task._chain_events
+                for task in reversed(chain):
+                    events += task.events()
+                    task._chain_events = events
+                return events * model.seconds_per_particle_event(self._dirname, self._workertuple[0])
+
+            def chain_costs(self):
+                """The predicted run times of this task and those following it"""
+                costs, task = [], self
+                while task is not None:
+                    costs.append(task.cost())
+                    task = task._next_tasks[0] if task._next_tasks else None
+                return costs
         
         #We break up tasks into blocks of events
         for state in self.states:
             for idx in range(self.restarts):
                 workdir = self.getstatedir(state, idx)
+                if os.path.basename(workdir) in quarantined:
+                    continue
                 run_events = 0
                 parent_task = None
+                counter = 1
                 while run_events < particle_run_events:
                     run_events += particle_run_events_block_size
-                    new_task = Task((state, workdir, self.output_plugins, particle_equil_events, run_events, particle_run_events_block_size, setup_worker))
+                    blocks = [(counter, particle_run_events_block_size)]
+                    if parent_task is None:
+                        #The first task also does the equilibration run
+                        blocks.append((0, particle_equil_events))
+                    new_task = Task((state, workdir, self.output_plugins, particle_equil_events, run_events, particle_run_events_block_size, setup_worker, self.codec, checkpoint_events), blocks, idx)
                     if parent_task is None:
                         running_tasks.append(new_task)
                     else:
                         parent_task.to_follow(new_task)
                     parent_task = new_task
+                    counter += 1
                     task_count += 1
 
-        print("Running", len(self.states) * self.restarts, "state points as ", task_count, "simulation tasks in parallel with", self.processes, "processes")
-
-        with alive_progress.alive_bar(task_count, manual=True) as progress:
-            for task in running_tasks:
-                task.start()
-
-            ok = True
-            while len(running_tasks) > 0:
-                still_running = []
-                for task in running_tasks:
-                    if not task.is_done():
-                        still_running.append(task)
-                    else:
-                        if task.is_successful():
-                            tasks_completed += 1
-                            if ok:
-                                for nxttask in task.next_tasks():
-                                    nxttask.start()
-                                    still_running.append(nxttask)
+        print("Running", len(running_tasks), "state points as ", task_count, "simulation tasks in parallel with", executor.slots, "slots on", type(executor).__name__)
+
+        #Tasks are dispatched longest (remaining) chain first, and
+        #only as slots become free, so the executor doesn't queue
+        #them in its own order.
+        ready = []
+        for seq, task in enumerate(running_tasks):
+            heapq.heappush(ready, (-task.chain_cost(), seq, task))
+        predicted = predict_makespan([task.chain_costs() for _, _, task in ready], executor.slots)
+        print("Predicted makespan {:.1f}s".format(predicted), "("+str(len(model.measured)), "directories with measured run times)")
+        telemetry = self._telemetry
+        #The metrics port is only held while running
+        telemetry.serve()
+        try:
+            telemetry.set('predicted_makespan_seconds', predicted, help='Predicted wall time of the current run')
+            telemetry.set('slots', executor.slots, help='Tasks the executor can run at once')
+            #Tasks which have been dispatched and not finished
+            in_flight = 0
+            #Events and dynarun time of the blocks completed in this run
+            run_events = 0
+            run_seconds = 0
+
+            def update_telemetry():
+                now = time.time()
+                retrying = len(delayed)
+                done = tasks_completed - tasks_failed
+                for state, value in (('queued', task_count - tasks_completed - in_flight - retrying), ('running', in_flight),
+                                     ('retrying', retrying), ('done', done), ('failed', tasks_failed)):
+                    telemetry.set('tasks', value, {'state':state}, help='Tasks of the current run by state')
+                telemetry.set('elapsed_seconds', now - start_time, help='Wall time of the current run')
+                telemetry.set('run_events_per_second', run_events / max(now - start_time, 1e-9), help='Events completed per second of wall time in the current run')
+                if run_seconds > 0:
+                    telemetry.set('worker_events_per_second', run_events / run_seconds, help='Mean event rate of a dynarun process over the completed blocks')
+                #Live rates, if the executor can see the processes
+                processes = executor.status()
+                telemetry.clear('process_events_per_second')
+                for proc in processes:
+                    if proc.events_per_sec:
+                        telemetry.set('process_events_per_second', proc.events_per_sec, {'process':proc.name, 'pid':proc.pid}, help='Live event rate of each running simulation')
+                telemetry.set('events_per_second', sum(proc.events_per_sec or 0 for proc in processes), help='Live event rate of all running simulations (if the executor can see them)')
+                telemetry.publish()
+
+            def dispatch(tasks):
+                """Starts a task, or a batch of tasks in one slot"""
+                if len(tasks) == 1:
+                    executor.submit(worker, tasks[0].args(),
+                                    callback=lambda result : finished.put(('run', tasks, True, [result])),
+                                    error_callback=lambda error : finished.put(('run', tasks, False, error)))
+                else:
+                    executor.submit(batch_worker, ([task.args() for task in tasks],),
+                                    callback=lambda results : finished.put(('run', tasks, True, results)),
+                                    error_callback=lambda error : finished.put(('run', tasks, False, error)))
+
+            def check(task):
+                """Starts a convergence check of the state of a chain"""
+                executor.submit(convergence_worker, (self.convergence_args(task._workertuple[0], particle_equil_events, target_error),),
+                                callback=lambda result : finished.put(('check', [task], True, result)),
+                                error_callback=lambda error : finished.put(('check', [task], False, error)))
+
+            #Batchable tasks wait here (by batch key) until there are
+            #batch_size of them, or there is nothing else to run
+            pending = {}
+            def next_tasks():
+                while ready:
+                    task = heapq.heappop(ready)[2]
+                    key = task.batch_key()
+                    if key is None:
+                        return [task]
+                    pending.setdefault(key, []).append(task)
+                    if len(pending[key]) == batch_size:
+                        return pending.pop(key)
+                if pending:
+                    return pending.pop(max(pending, key=lambda key: len(pending[key])))
+                return None
+
+            start_time = time.time()
+            #Processes already warned about stalling
+            warned = set()
+            #Failed tasks waiting to be retried, as (due time, seq, task)
+            delayed = []
+            #The last tasks of chains to check for convergence, which are
+            #run on the executor so the dispatch loop isn't held up
+            checks = []
+            with alive_progress.alive_bar(task_count, manual=True) as progress:
+                running = 0
+                seq = len(ready)
+                while True:
+                    while delayed and delayed[0][0] <= time.time():
+                        _, task_seq, task = heapq.heappop(delayed)
+                        heapq.heappush(ready, (-task.chain_cost(), task_seq, task))
+                    while running < executor.slots:
+                        if checks:
+                            check(checks.pop())
+                            running += 1
+                            continue
+                        tasks = next_tasks()
+                        if tasks is None:
+                            break
+                        dispatch(tasks)
+                        running += 1
+                        in_flight += len(tasks)
+                    if running == 0 and not delayed and not checks:
+                        break
+                    try:
+                        kind, tasks, successful, results = finished.get(timeout=min(1, max(0, delayed[0][0] - time.time())) if delayed else 1)
+                    except queue.Empty:
+                        self.report_status(executor.status(), progress, stall_timeout, warned)
+                        update_telemetry()
+                        continue
+                    running -= 1
+                    if kind == 'check':
+                        task, = tasks
+                        if successful:
+                            converged, records = results
+                            for record in records:
+                                db.record(record)
                         else:
-                            tasks_completed += task.failed()
-                            ok = False
-                            try:
-                                task._result.get()
-                            except Exception as e:
-                                print("\n ERROR: Found error ", e, "\n")
-                                errors.append(e)
-                
-                running_tasks = still_running
-                progress(tasks_completed / task_count)
-                time.sleep(0.5)
-
-        print("Terminating and joining threads...")
-        pool.close()
-        pool.join()
+                            converged = True
+                            print("\n WARNING: Convergence check of", task._dirname, "failed, not extending it:", results, "\n")
+                        if not converged:
+                            seq += 1
+                            nxttask = task.extend()
+                            heapq.heappush(ready, (-nxttask.chain_cost(), seq, nxttask))
+                            task_count += 1
+                            progress(tasks_completed / task_count)
+                        continue
+                    in_flight -= len(tasks)
+                    if successful:
+                        for task, result in zip(tasks, results):
+                            if result == batch_requeue:
+                                #Left out of the batch, so it runs on its own
+                                task._single = True
+                                seq += 1
+                                heapq.heappush(ready, (-task.chain_cost(), seq, task))
+                                continue
+                            tasks_completed += 1
+                            if result is not None:
+                                db.record(result)
+                                model.update(result['dir'], db.blocks(result['dir']))
+                                for block in result['blocks']:
+                                    run_events += block['events']
+                                    run_seconds += block.get('seconds') or 0
+                                    telemetry.inc('events_total', block['events'], help='Events of the blocks completed')
+                                    telemetry.inc('bytes_written_total', block['config_size'] + block['data_size'], help='Bytes of config and data files of the blocks completed')
+                            if (target_error and result is not None and not task.next_tasks()
+                                and task.run_events() + particle_run_events_block_size <= max_particle_run_events):
+                                #The chain is extended by the check's callback if need be
+                                checks.append(task)
+                            for nxttask in task.next_tasks():
+                                seq += 1
+                                heapq.heappush(ready, (-nxttask.chain_cost(), seq, nxttask))
+                    else:
+                        error = results
+                        for task in tasks:
+                            #Blocks the task completed before failing are only in its journal
+                            record = journal_record(task._workertuple[1], task._workertuple[0], db.blocks(task._dirname))
+                            if record is not None:
+                                db.record(record)
+                                model.update(task._dirname, db.blocks(task._dirname))
+                            task._attempts += 1
+                            task._single = task._single or len(tasks) > 1
+                            if task._attempts <= retries:
+                                delay = retry_delay * 2 ** (task._attempts - 1)
+                                print("\n WARNING: Task in", task._dirname, "failed (attempt", task._attempts, "of", str(retries + 1)+"), retrying in", delay, "s:", error, "\n")
+                                seq += 1
+                                heapq.heappush(delayed, (time.time() + delay, seq, task))
+                            else:
+                                #Only this chain is abandoned
+                                tasks_completed += task.failed()
+                                tasks_failed += task.failed()
+                                telemetry.inc('quarantined_total', help='State directories quarantined')
+                                print("\n ERROR: Found error in", task._dirname, error, "\n")
+                                errors.append(error)
+                                db.quarantine(task._dirname, task._workertuple[0], task._attempts, ''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+                    progress(tasks_completed / task_count)
+                    update_telemetry()
+            print("Actual makespan {:.1f}s (predicted {:.1f}s)".format(time.time() - start_time, predicted))
+        finally:
+            #Also on errors (or Ctrl-C), so the port and the workers are released
+            telemetry.close()
+            print("Terminating and joining threads...")
+            executor.close()
         
         if len(errors) > 0:
-            import traceback
-            print("\nERROR: Found",len(errors),"exceptions while processing")
-            print(''.join(traceback.format_exception(etype=type(errors[0]), value=errors[0], tb=errors[0].__traceback__)))
+            print("\nERROR: Found",len(errors),"exceptions while processing, the failed state directories are quarantined")
+            print(''.join(traceback.format_exception(type(errors[0]), errors[0], errors[0].__traceback__)))
             f=open("error.log", 'w')
-            print(''.join([''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__)) for error in errors]), file=f)
+            print(''.join([''.join(traceback.format_exception(type(error), error, error.__traceback__)) for error in errors]), file=f)
             
             print('Remaining errors written to "error.log"')
             raise RuntimeError("Parallel execution failed")
 
+    def refine(self, setup_worker, particle_equil_events, particle_run_events, particle_run_events_block_size,
+               output, statevar, max_points, points_per_round=None, tolerance=0, **run_kwargs):
+        """Adaptively refines the sweeps along the statevar state
+        variable, returning the final data (as fetch_data).
+
+        The current states are run, then each sweep containing statevar
+        is split into lines (one per value of its other state
+        variables) and the intervals between neighbouring points are
+        scored by the larger of the interpolation error of output
+        (|f''| h^2 / 8, from its curvature) and the mean standard
+        error of its ends. The midpoints of the worst intervals are
+        added as new sweeps, and this repeats until there are
+        max_points states or no interval scores above tolerance."""
+        import itertools
+        if not any(var == statevar for sweep in self.statevars for var, _ in sweep):
+            raise RuntimeError('Cannot refine along "'+statevar+'" as it is not swept')
+        if output not in self.outputs:
+            raise RuntimeError('Cannot refine using the "'+output+'" output as it is not one of the outputs')
+
+        while True:
+            self.run(setup_worker, particle_equil_events, particle_run_events, particle_run_events_block_size, **run_kwargs)
+            df = self.fetch_data(particle_equil_events, only_current_statevars=True)
+            budget = max_points - len(self.states)
+            if budget <= 0:
+                return df
+
+            #The new sweep for each candidate point, and its score
+            intervals = {}
+            for sweep in self.statevars:
+                sweep = dict(sweep)
+                #Single points (e.g., added by earlier refinement) are
+                #on the lines of the sweeps they refine
+                if len(sweep.get(statevar, [])) < 2:
+                    continue
+                others = [var for var in sweep if var != statevar]
+                for values in itertools.product(*[sweep[var] for var in others]):
+                    line = df
+                    for var, value in zip(others, values):
+                        line = line[line[var] == conv_to_14sf(value)]
+                    line = line.sort_values(by=statevar)
+                    x = [float(v) for v in line[statevar]]
+                    f = [getattr(v, 'nominal_value', v) for v in line[output]]
+                    err = [getattr(v, 'std_dev', 0) for v in line[output]]
+                    #The curvature at each interior point, from the second divided difference
+                    curvature = [0] * len(x)
+                    for i in range(1, len(x) - 1):
+                        hl, hr = x[i] - x[i-1], x[i+1] - x[i]
+                        curvature[i] = abs(2 * ((f[i+1] - f[i]) / hr - (f[i] - f[i-1]) / hl) / (hl + hr))
+                    for i in range(len(x) - 1):
+                        h = x[i+1] - x[i]
+                        midpoint = conv_to_14sf((x[i] + x[i+1]) / 2)
+                        if isinstance(line[statevar].iloc[i], (int, np.integer)):
+                            midpoint = int(round(midpoint))
+                        if midpoint in (x[i], x[i+1]):
+                            continue
+                        score = max(max(curvature[i], curvature[i+1]) * h * h / 8, (err[i] + err[i+1]) / 2)
+                        new_sweep = tuple((var, (value,)) for var, value in zip(others, values)) + ((statevar, (midpoint,)),)
+                        intervals[new_sweep] = max(score, intervals.get(new_sweep, score))
+
+            #Points already added (but pruned by skip_state) are not tried again
+            intervals = [(score, [(var, list(value)) for var, value in new_sweep]) for new_sweep, score in intervals.items() if score > tolerance]
+            intervals = [(score, new_sweep) for score, new_sweep in intervals if new_sweep not in self.statevars]
+            if len(intervals) == 0:
+                return df
+            intervals.sort(key=lambda interval: -interval[0])
+            count = min(budget, points_per_round or budget, len(intervals))
+            print("Refining", statevar, "at", count, "new points, largest interval score is", print_to_14sf(intervals[0][0]))
+            self.statevars += [new_sweep for score, new_sweep in intervals[:count]]
+            self.states = self.iterate_state(self.statevars)
+
+    def report_status(self, processes, progress, stall_timeout, warned):
+        """Shows the live throughput of the running simulations and
+        warns (once) about any which have stalled"""
+        if not processes:
+            return
+        now = time.time()
+        rates = [proc.events_per_sec for proc in processes if proc.events_per_sec]
+        etas = [(proc.eta(), proc.name) for proc in processes if proc.eta() is not None]
+        text = str(len(processes))+" running, {:.3g} events/s".format(sum(rates))
+        if etas:
+            text += ", longest ETA {:.0f}s ({})".format(*max(etas))
+        progress.text(text)
+        for proc in processes:
+            if proc.stalled(stall_timeout, now) and id(proc) not in warned:
+                warned.add(id(proc))
+                print("\nWARNING:", proc.name, "(pid "+str(proc.pid)+") has not ticked for {:.0f}s".format(now - proc.last_tick))
+
+    def quarantined(self):
+        """The state directories quarantined by run after they kept
+        failing, as a dict of the directory to its state, attempts,
+        error and time"""
+        return self.db.quarantined()
+
+    def release(self, dirnames=None):
+        """Releases state directories (all if None) from the quarantine"""
+        self.db.release(dirnames)
+
+    def warm_start_source(self, state, restart=0):
+        """The final config of the finished state nearest in number
+        density to state, of those differing from it only in density
+        (or None). Different restarts are started from different
+        neighbouring directories where possible, to keep them
+        independent."""
+        statevars = dict(state)
+        if 'ndensity' not in statevars:
+            return None
+        candidates = []
+        for d, other in self.db.states().items():
+            other = dict(other)
+            if set(other) != set(statevars) or other['ndensity'] == statevars['ndensity'] or any(other[var] != statevars[var] for var in statevars if var != 'ndensity'):
+                continue
+            #Finished means equilibrated and at least one production run
+            blocks = self.db.blocks(d)
+            if len(blocks) < 2 or not block_intact(os.path.join(self.workdir, d), blocks[-1]):
+                continue
+            candidates.append((abs(other['ndensity'] - statevars['ndensity']), d, os.path.join(self.workdir, d, blocks[-1]['config'])))
+        if len(candidates) == 0:
+            return None
+        candidates.sort()
+        nearest = [candidate for candidate in candidates if candidate[0] == candidates[0][0]]
+        return nearest[restart % len(nearest)][2]
+
+    def reduction_key(self, particle_equil_events):
+        """Identifies the partial reductions saved for these outputs"""
+        return json.dumps([particle_equil_events, sorted(self.outputs)])
+
+    def perdir_args(self, d, state, particle_equil_events, key):
+        """The perdir arguments to bring the reduction of a directory
+        up to date, resuming from its saved partial reduction if the
+        blocks it covers haven't changed"""
+        blocks = self.db.blocks(d)
+        reduction = self.db.reduction(d, key)
+        if reduction is not None and blocks_digest(blocks[:reduction['blocks']]) == reduction['digest']:
+            start, executed_events, dataout, digest = reduction['blocks'], reduction['executed_events'], reduction['value'], reduction['digest']
+        else:
+            start, executed_events, dataout, digest = 0, 0, None, ''
+        return (d, particle_equil_events, self, state, blocks[start:], executed_events, dataout, digest, key)
+
+    def convergence_args(self, state, particle_equil_events, target_error):
+        """The convergence_worker arguments to check a state. The
+        reductions of its directories are brought up to date, as
+        fetch_data would."""
+        key = self.reduction_key(particle_equil_events)
+        dirs = set(self.db.dirs())
+        perdir_args = [self.perdir_args(d, state, particle_equil_events, key)
+                       for d in (os.path.basename(self.getstatedir(state, idx)) for idx in range(self.restarts)) if d in dirs]
+        return (state, perdir_args, target_error)
+
     def fetch_data(self, particle_equil_events, only_current_statevars = False):
         self.only_current_statevars = only_current_statevars
         
-        output_dirs = os.listdir(self.workdir)
+        self.import_dirs()
+        states = self.db.states()
+        #Filter to only the set states (if enabled)
+        output_dirs = [d for d in sorted(states) if not only_current_statevars or states[d] in self.states]
         print("Fetching data...")
         n = len(output_dirs)
 
         pool = Pool(processes=self.processes)
 
-        import collections
+        import collections, itertools
         #We store the extracted data in a dict of dicts. The first
         #dict is for the state, the second for the property.
         state_data = collections.defaultdict(dict)        
 
+        #Each directory has a partial reduction saved from the last
+        #fetch, along with the number of blocks it covers (and a
+        #digest of them, to check they haven't changed). Only the
+        #blocks after that need to be processed.
+        key = self.reduction_key(particle_equil_events)
+        tasks = []
+        cached = []
+        for d in output_dirs:
+            args = self.perdir_args(d, states[d], particle_equil_events, key)
+            if len(args[4]) == 0 and args[6] is not None:
+                cached.append(({states[d]: pickle.loads(args[6])}, None))
+            else:
+                tasks.append(args)
+        print(len(cached), "directories are up to date,", len(tasks), "have new data")
+
         #So we run the per data dir operation, then reduce everything
         state_data = {}
+        telemetry = self._telemetry
+        start_time = time.time()
         with alive_progress.alive_bar(n) as progress:
             #This is a parallel loop, returning items as they finish in arbitrary order
-            for result in pool.imap_unordered(perdir, [(d, particle_equil_events, self) for d in output_dirs], chunksize=10):
+            for result, record in itertools.chain(cached, pool.imap_unordered(perdir, tasks, chunksize=10)):
+                if record is not None:
+                    self.db.record(record)
+                    telemetry.inc('fetch_parse_seconds_total', record['parse_seconds'], help='Time spent parsing output files in fetch_data (summed over processes)')
+                    telemetry.inc('fetch_blocks_total', len({counter for counter, name, value in record['properties']}), help='Production blocks processed by fetch_data')
+                    telemetry.publish()
                 #Here we process the returned data from a single directory
                 for state, data in result.items():
                     if state not in state_data:
@@ -702,6 +3468,10 @@ class SimManager:
                             else:
                                 target[key] += value
                 progress()
+        telemetry.set('fetch_seconds', time.time() - start_time, help='Wall time of the last fetch_data')
+        telemetry.set('fetch_dirs', len(tasks), {'state':'processed'}, help='Directories of the last fetch_data by state')
+        telemetry.set('fetch_dirs', len(cached), {'state':'cached'})
+        telemetry.publish(force=True)
         
         #We now prep the data for processing, we convert our
         #WeightedFloat's to ufloats as pandas supports that natively.
@@ -729,7 +3499,6 @@ class SimManager:
         df = df.sort_values(by=[statevar for statevar in self.used_statevariables])
 
         #Now we write out the data
-        import pickle
         pickle.dump(df, open(self.workdir+".pkl", 'wb'))
 
         return df
@@ -743,7 +3512,7 @@ ConfigFile.config_props["InitState"] = {'recalculable':False, 'recalc': lambda c
 
 
 def Lambda_config(XMLconfig):
-    tag = XMLconfig.tree.find('.//Interaction[@Type="SquareWell"]')
+    tag = XMLconfig.find('.//Interaction[@Type="SquareWell"]')
     if tag is None:
         return float('inf')
     else:
@@ -751,7 +3520,7 @@ def Lambda_config(XMLconfig):
 ConfigFile.config_props["Lambda"] = {'recalculable':True, 'recalc': lambda config: Lambda_config}
 
 def Rso_config(XMLconfig):
-    tag = XMLconfig.tree.find('.//Global[@Type="SOCells"]')
+    tag = XMLconfig.find('.//Global[@Type="SOCells"]')
     if tag is None:
         return float('inf')
     else:
@@ -787,7 +3556,7 @@ def PhiT_gen(state):
 ConfigFile.config_props["PhiT"] = {'recalculable':True, 'recalc':PhiT_config, 'gen_state':PhiT_gen}
 
 def kT_config(XMLconfig):
-    tag = XMLconfig.tree.find('.//System[@Name="Thermostat"]')
+    tag = XMLconfig.find('.//System[@Name="Thermostat"]')
     if tag is None:
         return float('inf')
     else:
@@ -806,6 +3575,11 @@ class OutputProperty:
 
     def result(self, state, outputfile, configfilename, counter, manager, output_dir):
         return None
+
+    def paths(self):
+        """The XPaths of the output file read by result(), or None if
+        the whole file is needed."""
+        return None
     
 class SingleAttrib(OutputProperty):
     def __init__(self, tag, attrib, dependent_statevars, dependent_outputs, dependent_outputplugins, time_weighted=True, div_by_N=False, div_by_t=False, missing_val = 0, skip_missing=False):
@@ -822,7 +3596,7 @@ class SingleAttrib(OutputProperty):
         return WeightedFloat()
 
     def value(self, outputfile):
-        tag = outputfile.tree.find('.//'+self._tag)
+        tag = outputfile.find('.//'+self._tag)
         if tag is None:
             if self._missing_val is None:
                 raise RuntimeError('Failed to find the tag "'+self._tag+'" in the outputfile')
@@ -847,26 +3621,41 @@ class SingleAttrib(OutputProperty):
         return val
 
     def weight(self, outputfile):
-        tag = outputfile.tree.find('.//'+self._tag)
+        tag = outputfile.find('.//'+self._tag)
         #If we have a missing_val defined, then we can use and weight it, else don't give this any weight
         if ((self._missing_val is None) or self._skip_missing) and (tag is None or self._attrib not in tag.attrib):
             return 0
         
         if self._time_weighted:
-            return float(outputfile.tree.find('.//Duration').attrib['Time'])
+            return outputfile.t()
         else:
-            return float(outputfile.tree.find('.//Duration').attrib['Events'])
+            return float(outputfile.events())
 
     def result(self, state, outputfile, configfilename, counter, manager, output_dir):
         return WeightedFloat(self.value(outputfile), self.weight(outputfile))
 
-def parseToArray(text):
-    data = []
-    for row in text.split('\n'):
-        row_data = list(map(float, row.split()))
-        if len(row_data) > 0:
-            data.append(row_data)
-    return np.array(data)
+    def paths(self):
+        return ['.//'+self._tag]
+
+def parseToArray(text, min_columns=1):
+    """Decodes a text node holding a whitespace delimited table of
+    numbers (as written for correlators, VACFs, RDFs, etc.) into a 2D
+    array with one row per line. Rows with fewer than min_columns
+    values (e.g., blank lines) are dropped.
+
+    The table is decoded by NumPy's C parser in one call, only ragged
+    tables fall back to parsing line by line."""
+    lines = text.strip().splitlines() if text else []
+    if len(lines) == 0:
+        return np.empty((0, 0))
+    try:
+        data = np.loadtxt(lines, ndmin=2)
+        if data.shape[1] >= min_columns:
+            return data
+    except ValueError:
+        pass
+    rows = [line.split() for line in lines]
+    return np.array([list(map(float, row)) for row in rows if len(row) >= min_columns])
 
 class VACFOutputProperty(OutputProperty):
     def __init__(self):
@@ -876,13 +3665,16 @@ class VACFOutputProperty(OutputProperty):
         restart_idx = output_dir.split('_')[-1]
         filename_root = manager.workdir+'_VACF/' + manager.statename(state, var_separator='/') + "/run_" + restart_idx + '_' + str(counter)
         os.makedirs(filename_root, exist_ok=True)
-        for tag in outputfile.tree.findall('.//VACF/Particles/Species'):
+        for tag in outputfile.findall('.//VACF/Particles/Species'):
             pickle.dump(parseToArray(tag.text), open(filename_root + '/species_'+tag.attrib['Name']+'.pkl', 'wb'))
         
-        for tag in outputfile.tree.findall('.//VACF/Topology/Structure'):
+        for tag in outputfile.findall('.//VACF/Topology/Structure'):
             pickle.dump(parseToArray(tag.text), open(filename_root + '/topology_'+tag.attrib['Name']+'.pkl', 'wb'))
         return None
 
+    def paths(self):
+        return ['.//VACF']
+
 class RadialDistributionOutputProperty(OutputProperty):
     def __init__(self):
         OutputProperty.__init__(self, dependent_statevars=[], dependent_outputs=[], dependent_outputplugins=['-LRadialDistribution'])
@@ -892,11 +3684,11 @@ class RadialDistributionOutputProperty(OutputProperty):
 
     def result(self, state, outputfile, configfilename, counter, manager, output_dir):
         #Presume that each tag is in order, and has a common bin width
-        samples = float(outputfile.tree.find('.//RadialDistributionMoments').attrib["SampleCount"])
+        samples = float(outputfile.find('.//RadialDistributionMoments').attrib["SampleCount"])
         bin_width = 0.01        
         #Grab all the moments, drop the R values for now
-        moment_tags = outputfile.tree.findall('.//RadialDistributionMoments/Species/Moment')
-        moments = np.array([[float(line.split()[1]) for line in tag.text.strip().split("\n")] for tag in moment_tags])
+        moment_tags = outputfile.findall('.//RadialDistributionMoments/Species/Moment')
+        moments = np.array([parseToArray(tag.text)[:,1] for tag in moment_tags])
 
         # In the simulation we have collected the moments of, N(r), the number of pairs below a radius r. 
         # These moments are collected about an origin/offset N₀(r), i.e. ⟨(N(r)-N₀(r))^n⟩
@@ -930,6 +3722,9 @@ class RadialDistributionOutputProperty(OutputProperty):
 
         return WeightedArray(central_moments, samples)
 
+    def paths(self):
+        return ['.//RadialDistributionMoments']
+
 class RadialDistEndOutputProperty(OutputProperty):
     def __init__(self):
         OutputProperty.__init__(self, dependent_statevars=[], dependent_outputs=[], dependent_outputplugins=[])
@@ -948,41 +3743,35 @@ class RadialDistEndOutputProperty(OutputProperty):
         
         logfile = open(os.path.join(filename_root, 'run.log'), 'a')
         from subprocess import check_call
-        check_call(["dynarun", configfilename, '-o', os.path.join(filename_root, 'RadDist.config.xml.bz2'), '-c', '0', "--out-data-file", os.path.join(filename_root, 'RadDist.out.xml.bz2'), '-LRadialDistribution'], stdout=logfile, stderr=logfile)
+        ext = xml_codecs[manager.codec]['ext']
+        check_call(["dynarun", configfilename, '-o', os.path.join(filename_root, 'RadDist.config'+ext), '-c', '0', "--out-data-file", os.path.join(filename_root, 'RadDist.out'+ext), '-LRadialDistribution'], stdout=logfile, stderr=logfile)
         
-        of = OutputFile(os.path.join(filename_root, 'RadDist.out.xml.bz2'))
-        for tag in of.tree.findall('.//RadialDistribution/Species'):
+        of = OutputFile(os.path.join(filename_root, 'RadDist.out'+ext))
+        for tag in of.findall('.//RadialDistribution/Species'):
             A = tag.attrib['Name1']
             B = tag.attrib['Name2']
             output_pkl = filename_root + '/species_'+A+'_'+B+'.pkl'
             pickle.dump(parseToArray(tag.text), open(output_pkl, 'wb'))
         return None
 
+    def paths(self):
+        return []
+
 class OrderParameterProperty(OutputProperty):
     '''See here https://freud.readthedocs.io/en/stable/modules/order.html#freud.order.Steinhardt'''
     def __init__(self, L):
         OutputProperty.__init__(self, dependent_statevars=[], dependent_outputs=[], dependent_outputplugins=[])
         self.L = L
-    
-    def result(self, state, outputfile, configfilename, counter, manager, output_dir):
-        import freud
-        configfile = ConfigFile(configfilename)
-        box, points = configfile.to_freud()
-
-        #Steinhardt for FCC
-        ql = freud.order.Steinhardt(self.L)
-        ql.compute((box, points), neighbors={"num_neighbors": self.L})
-        ql_value = ql.particle_order
-        
-        return WeightedFloat(np.mean(ql_value), 1)
 
     def init(self):
         return WeightedFloat()
     
     def result(self, state, outputfile, configfilename, counter, manager, output_dir):
         import freud
-        configfile = ConfigFile(configfilename)
-        box, points = configfile.to_freud()
+        particles = load_particle_arrays(configfilename)
+        L = particles['SimulationSize']
+        box = freud.box.Box(Lx = L[0], Ly = L[1], Lz = L[2])
+        points = particles['P'].astype(np.float32)
 
         #Steinhardt for FCC
         ql = freud.order.Steinhardt(self.L)
@@ -991,6 +3780,9 @@ class OrderParameterProperty(OutputProperty):
         
         return WeightedFloat(np.mean(ql_value), 1)
 
+    def paths(self):
+        return []
+
     
 OutputFile.output_props["N"] = SingleAttrib('ParticleCount', 'val', [], [], [], missing_val=None)#We use missing_val=None to cause an error if the tag is missing
 OutputFile.output_props["p"] = SingleAttrib('Pressure', 'Avg', [], [], [], missing_val=None)
@@ -1013,5 +3805,17 @@ OutputFile.output_props["RadialDistribution"] = RadialDistributionOutputProperty
 OutputFile.output_props["FCCOrder"] = OrderParameterProperty(6)
 
 if __name__ == "__main__":
-
-    pass
+    import argparse
+    parser = argparse.ArgumentParser(description="Runs jobs for the SSHExecutor and QueueExecutor")
+    parser.add_argument('--run-job', nargs=2, metavar=('JOBFILE', 'RESULTFILE'), help="Run a single job file")
+    parser.add_argument('--drain', metavar='QUEUEDIR', help="Run jobs from a job queue")
+    parser.add_argument('--idle-timeout', type=float, default=None, help="Stop draining after the queue has been empty this many seconds")
+    parser.add_argument('--poll-interval', type=float, default=5, help="Seconds between checks of an empty queue")
+    parser.add_argument('--heartbeat', type=float, default=60, help="Seconds between touches of the running job's file")
+    args = parser.parse_args()
+    #Jobs refer to this module as pydynamo, not __main__
+    import pydynamo
+    if args.run_job:
+        pydynamo.run_job(*args.run_job)
+    if args.drain:
+        pydynamo.drain_queue(args.drain, args.idle_timeout, args.poll_interval, args.heartbeat)
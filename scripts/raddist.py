@@ -106,14 +106,15 @@ def filter_dataframe(df: pd.DataFrame) -> pd.DataFrame:
 
 
 def getGrData(of : pydynamo.OutputFile):
-    grs = of.tree.findall('.//RadialDistributionMoments/Species')
-    N=int(of.tree.find('.//ParticleCount').attrib['val'])
+    grs = of.findall('.//RadialDistributionMoments/Species')
+    N=int(of.find('.//ParticleCount').attrib['val'])
+    density = of.numdensity()
     #Loop over all species
     for species in grs:
         for moment in species.findall('./Moment'):
-            for line in moment.text.strip().split("\n"):
-                r, v = map(float, line.split())
-                yield (N, species.attrib["Name1"], species.attrib["Name2"], int(moment.attrib['Order']), of.numdensity(), r, v)
+            order = int(moment.attrib['Order'])
+            for r, v in pydynamo.parseToArray(moment.text, min_columns=2)[:, :2].tolist():
+                yield (N, species.attrib["Name1"], species.attrib["Name2"], order, density, r, v)
 
 def try_jit(f):
     #return f
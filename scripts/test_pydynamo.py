@@ -0,0 +1,758 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import pytest
+from datastat import WeightedFloat, WeightedArray
+from pydynamo import merge_segments
+
+def test_merge_segments_scalar():
+    merged = merge_segments([WeightedFloat(1.0, 1.0), WeightedFloat(4.0, 3.0)])
+    assert isinstance(merged, WeightedFloat)
+    assert merged._w_sum == 4.0
+    assert merged._count == 1
+    assert abs(merged.avg() - 3.25) < 1e-12
+
+def test_merge_segments_array():
+    merged = merge_segments([WeightedArray(np.array([1.0, 2.0, 3.0]), 1.0), WeightedArray(np.array([3.0, 6.0, 7.0]), 3.0)])
+    assert isinstance(merged, WeightedArray)
+    assert merged._w_sum == 4.0
+    assert merged._count == 1
+    assert np.allclose(merged.avg(), [2.5, 5.0, 6.0])
+
+def test_merge_segments_empty():
+    assert merge_segments([None, None]) is None
+    merged = merge_segments([None, WeightedFloat(2.0, 1.0)])
+    assert merged.avg() == 2.0
+
+def test_plan_core_sets_fewer_slots_than_nodes(monkeypatch):
+    import pydynamo
+    monkeypatch.setattr(pydynamo, 'numa_nodes', lambda: {0:[0, 1], 1:[2, 3], 2:[4, 5]})
+    assert pydynamo.plan_core_sets(1, numa=True) == [[0, 1]]
+    core_sets = pydynamo.plan_core_sets(2, numa=True)
+    assert len(core_sets) == 2
+    #Each set stays within one node
+    assert all(len(set(core // 2 for core in cores)) == 1 for cores in core_sets)
+
+def test_queue_executor_round_trip(tmp_path):
+    import pydynamo, threading, queue
+    executor = pydynamo.QueueExecutor(str(tmp_path), 1, poll_interval=0.05)
+    results = queue.Queue()
+    executor.submit(abs, (-3,), lambda result: results.put((True, result)), lambda e: results.put((False, e)))
+    pydynamo.drain_queue(str(tmp_path), idle_timeout=0.5, poll_interval=0.05)
+    assert results.get(timeout=5) == (True, 3)
+
+def test_queue_executor_expired_lease(tmp_path):
+    import pydynamo, queue
+    executor = pydynamo.QueueExecutor(str(tmp_path), 1, poll_interval=0.05, lease_timeout=10)
+    results = queue.Queue()
+    executor.submit(abs, (-3,), lambda result: results.put((True, result)), lambda e: results.put((False, e)))
+    #A drainer claims the job, then dies without a heartbeat
+    name, = os.listdir(str(tmp_path / 'pending'))
+    jobfile = str(tmp_path / 'running' / name)
+    os.rename(str(tmp_path / 'pending' / name), jobfile)
+    os.utime(jobfile, (0, 0))
+    successful, error = results.get(timeout=5)
+    assert not successful and 'heartbeat' in str(error)
+    assert not os.path.exists(jobfile)
+
+def test_executor_is_abstract():
+    import pydynamo, pytest
+    with pytest.raises(TypeError):
+        pydynamo.Executor()
+
+def test_plan_moves_compacts_to_lowest_free_index():
+    import pydynamo
+    manager = pydynamo.SimManager.__new__(pydynamo.SimManager)
+    manager.used_statevariables = ['N']
+    n20, n30 = (('N', 20),), (('N', 30),)
+    entries = ['N_20_0', 'N_20_3', 'N_30_4', 'N_30_2', 'runs.db']
+    moves = manager.plan_moves([('N_20_0', n20), ('N_20_3', n20), ('N_30_4', n30), ('N_30_2', n30)], entries)
+    assert sorted((olddir, newdir) for olddir, newdir, state in moves) == [('N_20_0', 'N_20_0'), ('N_20_3', 'N_20_1'), ('N_30_2', 'N_30_0'), ('N_30_4', 'N_30_1')]
+    #A directory can take the name of one moving to another state
+    moves = manager.plan_moves([('N_20_0', n30), ('N_20_3', n20)], ['N_20_0', 'N_20_3'])
+    assert sorted((olddir, newdir) for olddir, newdir, state in moves) == [('N_20_0', 'N_30_0'), ('N_20_3', 'N_20_0')]
+
+def test_relative_error():
+    import math, pydynamo
+    assert math.isnan(pydynamo.relative_error(WeightedFloat(1.0, 1.0)))
+    assert math.isnan(pydynamo.relative_error(WeightedFloat(0.0, 1.0) + WeightedFloat(0.0, 1.0)))
+    assert pydynamo.relative_error(WeightedFloat(2.0, 1.0) + WeightedFloat(2.0, 1.0)) == 0
+    assert abs(pydynamo.relative_error(WeightedFloat(1.0, 1.0) + WeightedFloat(3.0, 1.0)) - 0.5) < 1e-12
+    #Always zero elements of an array are ignored
+    value = WeightedArray(np.array([0.0, 1.0]), 1.0) + WeightedArray(np.array([0.0, 3.0]), 1.0)
+    assert abs(pydynamo.relative_error(value) - 0.5) < 1e-12
+
+def make_block(counter, checksum='x'):
+    return {'counter':counter, 'config':str(counter)+'.config.xml', 'data':str(counter)+'.data.xml',
+            'events':100, 'N':10, 't':1.0, 'config_size':1, 'config_checksum':'c', 'data_size':1, 'data_checksum':checksum}
+
+def test_rundb_record(tmp_path):
+    import pydynamo, pickle
+    db = pydynamo.RunDB(str(tmp_path))
+    state = (('N', 10),)
+    db.record({'dir':'N_10_0', 'state':state, 'blocks':[make_block(0), make_block(1)],
+               'properties':[(1, 'p', pickle.dumps(1.5))]})
+    assert db.dirs() == ['N_10_0']
+    assert db.state('N_10_0') == state
+    assert [block['counter'] for block in db.blocks('N_10_0')] == [0, 1]
+    assert db.properties('N_10_0') == {(1, 'p'): pickle.dumps(1.5)}
+    #Rerunning a block drops its stale properties
+    db.record({'dir':'N_10_0', 'blocks':[make_block(1, 'y')]})
+    assert db.properties('N_10_0') == {}
+
+def test_rundb_move_many(tmp_path):
+    import pydynamo
+    db = pydynamo.RunDB(str(tmp_path))
+    a, b = (('N', 10),), (('N', 20),)
+    db.record({'dir':'N_10_0', 'state':a, 'blocks':[make_block(0)]})
+    db.record({'dir':'N_20_0', 'state':b, 'blocks':[make_block(0), make_block(1)]})
+    db.quarantine('N_20_0', b, 3, 'error')
+    #A swap of names
+    db.move_many([('N_10_0', 'N_20_0', a), ('N_20_0', 'N_10_0', b)])
+    assert db.state('N_20_0') == a and len(db.blocks('N_20_0')) == 1
+    assert db.state('N_10_0') == b and len(db.blocks('N_10_0')) == 2
+    assert list(db.quarantined()) == ['N_10_0']
+    #Moving onto the stale rows of a deleted directory replaces them
+    db.move('N_20_0', 'N_10_0', a)
+    assert db.dirs() == ['N_10_0']
+    assert db.state('N_10_0') == a and len(db.blocks('N_10_0')) == 1
+    assert db.quarantined() == {}
+
+def test_rundb_move_many_clears_reorg_plan(tmp_path):
+    import pydynamo
+    db = pydynamo.RunDB(str(tmp_path))
+    db.set_meta(pydynamo.RunDB.reorg_key, b'plan')
+    db.move_many([])
+    assert db.get_meta(pydynamo.RunDB.reorg_key) is None
+
+def test_journal_record(tmp_path):
+    import pydynamo
+    state = (('N', 10),)
+    for counter in (0, 1):
+        for name in (str(counter)+'.config.xml', str(counter)+'.data.xml'):
+            (tmp_path / name).write_text('x')
+        pydynamo.append_journal(str(tmp_path), make_block(counter), counter)
+    record = pydynamo.journal_record(str(tmp_path), state, [make_block(0)])
+    assert record['dir'] == tmp_path.name and record['state'] == state
+    assert [block['counter'] for block in record['blocks']] == [1]
+    assert pydynamo.journal_record(str(tmp_path), state, [make_block(0), make_block(1)]) is None
+
+def test_cost_model_estimates(tmp_path):
+    import pydynamo
+    db = pydynamo.RunDB(str(tmp_path))
+    db.record({'dir':'N_10_0', 'state':(('N', 10),), 'blocks':[dict(make_block(0), seconds=1.0, density=0.5)]})
+    model = pydynamo.CostModel(db)
+    assert model.seconds_per_particle_event('N_10_0', (('N', 10),)) == 0.1
+    #Unmeasured states are rescaled from the nearest measurement, and remembered
+    assert abs(model.seconds_per_particle_event('N_20_0', (('N', 20),)) - 0.2) < 1e-12
+    assert 'N_20_0' in model._estimates
+    #Until a new measurement
+    model.update('N_30_0', [dict(make_block(0), N=30, seconds=3.0, density=0.5)])
+    assert model._estimates == {}
+    assert abs(model.seconds_per_particle_event('N_20_0', (('N', 20),)) - 0.6) < 1e-12
+
+def test_batch_member_log():
+    import pydynamo
+    log = "Batched run of A/1, B/1\nLoading\nID 0 events 10\nID 1 events 12\nID=10 done\nFinished\n"
+    assert pydynamo.batch_member_log(log, 0) == "Batched run of A/1, B/1\nLoading\nID 0 events 10\nFinished\n"
+    assert pydynamo.batch_member_log(log, 1) == "Batched run of A/1, B/1\nLoading\nID 1 events 12\nFinished\n"
+
+def test_local_executor_forwarded_status():
+    import pydynamo, multiprocessing, time
+    executor = pydynamo.LocalExecutor(1)
+    executor._status_queue = multiprocessing.Queue()
+    executor._running = {}
+    pydynamo.init_pool_process(executor._status_queue)
+    try:
+        status = pydynamo.SupervisedProcess('N_10_0/1', ['dynarun'])
+        status.update('ETA 1s, Events 1000k, t 1.5, <MFT> 0.1', time.time())
+        pydynamo.forward_status(status)
+        time.sleep(0.2)
+        assert [proc.name for proc in executor.status()] == ['N_10_0/1']
+        assert executor.status()[0].events == 1000000
+        pydynamo.forward_status(status, finished=True)
+        time.sleep(0.2)
+        assert executor.status() == []
+    finally:
+        pydynamo._status_queue = None
+
+def test_telemetry_binds_port_only_while_serving():
+    import pydynamo, socket, json, urllib.request
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    first, second = pydynamo.Telemetry(http_port=port), pydynamo.Telemetry(http_port=port)
+    first.serve()
+    first.set('slots', 2)
+    assert json.loads(urllib.request.urlopen('http://127.0.0.1:%d/' % port).read())['slots'] == 2
+    first.close()
+    #The port is free again for the next one
+    second.serve()
+    second.close()
+
+def make_config(filename, N, withN=True, x=0.1):
+    """Writes a small DynamO configuration file"""
+    import bz2
+    parts = ['<?xml version="1.0"?>\n<DynamOconfig version="1.5.0"><Simulation><SimulationSize x="10" y="11" z="12"/>'
+             '<Interactions><Interaction Type="SquareWell" Lambda="1.5"/></Interactions><Globals/>'
+             '<SystemEvents><System Name="Thermostat" Temperature="1"/></SystemEvents></Simulation><Properties/>']
+    parts.append('<ParticleData N="%d">' % N if withN else '<ParticleData>')
+    for i in range(N):
+        parts.append('<Pt ID="%d"><P x="%r" y="1.0" z="2.0"/><V x="3.0" y="4.0" z="5.0"/></Pt>\n' % (i, i * x))
+    parts.append('</ParticleData></DynamOconfig>')
+    data = ''.join(parts).encode()
+    if filename.endswith('.bz2'):
+        data = bz2.compress(data)
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+def test_sidecar_round_trip(tmp_path):
+    import pydynamo
+    filename = str(tmp_path / 'start.config.xml')
+    make_config(filename, 5)
+    first = pydynamo.ConfigFile(filename).particles()
+    meta = pydynamo.read_sidecar(filename)
+    assert meta is not None and meta['particles']
+    assert os.path.exists(filename + '.cache.npy')
+    #The second load is memory-mapped from the sidecar
+    second = pydynamo.ConfigFile(filename).particles()
+    assert isinstance(second['P'], np.memmap)
+    for key in ('ID', 'P', 'V', 'SimulationSize'):
+        assert np.array_equal(first[key], second[key])
+    assert pydynamo.ConfigFile(filename).find('.//Interaction').attrib['Lambda'] == '1.5'
+
+def test_sidecar_rejected_after_rewrite(tmp_path):
+    import pydynamo
+    filename = str(tmp_path / 'start.config.xml')
+    make_config(filename, 5, x=1.0)
+    pydynamo.ConfigFile(filename).particles()
+    st = os.stat(filename)
+    #Rewritten in place with the same size, keeping the mtime
+    make_config(filename, 5, x=2.0)
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert os.stat(filename).st_size == st.st_size
+    assert pydynamo.read_sidecar(filename) is None
+    assert np.allclose(pydynamo.ConfigFile(filename).particles()['P'][:, 0], 2.0 * np.arange(5))
+
+def test_sidecar_kept_after_touch(tmp_path):
+    import pydynamo
+    filename = str(tmp_path / 'start.config.xml')
+    make_config(filename, 5)
+    pydynamo.ConfigFile(filename).particles()
+    os.utime(filename, ns=(0, 10**9))
+    assert pydynamo.read_sidecar(filename) is not None
+    #Or if the size changes
+    make_config(filename, 6)
+    assert pydynamo.read_sidecar(filename) is None
+
+def test_load_particle_arrays_matches_full_parse(tmp_path, monkeypatch):
+    import pydynamo
+    monkeypatch.setattr(pydynamo.XMLFile, 'use_cache', False)
+    #Without the particle count, the arrays are grown past their first allocation
+    for name, N, withN in (('counted.config.xml.bz2', 50, True), ('uncounted.config.xml', 1500, False)):
+        filename = str(tmp_path / name)
+        make_config(filename, N, withN=withN)
+        streamed = pydynamo.load_particle_arrays(filename)
+        config = pydynamo.ConfigFile(filename)
+        config.tree
+        parsed = config.particles()
+        assert streamed['P'].shape == (N, 3) and streamed['ID'].dtype == np.int64
+        for key in ('ID', 'P', 'V', 'SimulationSize'):
+            assert np.array_equal(streamed[key], parsed[key])
+        assert config.N() == N
+
+def test_header_only_N(tmp_path, monkeypatch):
+    import pydynamo
+    monkeypatch.setattr(pydynamo.XMLFile, 'use_cache', False)
+    filename = str(tmp_path / 'start.config.xml.bz2')
+    make_config(filename, 40)
+    config = pydynamo.ConfigFile(filename, header_only=True)
+    #The particle count on the ParticleData tag is used, the particles aren't read
+    monkeypatch.setattr(pydynamo, 'load_particle_arrays', None)
+    assert config.N() == 40
+    assert config._tree is None
+
+def bz2_test_data():
+    return b''.join(b'<Pt ID="%d"><P x="%d"/></Pt>\n' % (i, i * i) for i in range(3000))
+
+def test_bz2_parallel_round_trip(tmp_path, monkeypatch):
+    import pydynamo, bz2
+    monkeypatch.setattr(pydynamo, 'bz2_stream_size', 5000)
+    monkeypatch.setattr(pydynamo.XMLFile, 'compression_threads', 4)
+    data = bz2_test_data()
+    compressed = pydynamo.compress_bz2_parallel(data)
+    offsets = pydynamo.bz2_stream_offsets(compressed)
+    assert len(offsets) == -(-len(data) // 5000)
+    #Still a standard (pbzip2 style) bz2 file
+    assert bz2.decompress(compressed) == data
+    filename = str(tmp_path / 'data.xml.bz2')
+    with open(filename, 'wb') as f:
+        f.write(compressed)
+    stream = pydynamo.open_bz2_stream(filename)
+    assert isinstance(stream.raw, pydynamo.ParallelBZ2Reader)
+    assert stream.read() == data
+    stream.close()
+    #A single stream file is read serially
+    monkeypatch.setattr(pydynamo.XMLFile, 'compression_threads', 1)
+    assert pydynamo.open_bz2_stream(filename).read() == data
+
+def test_bz2_parallel_false_header(monkeypatch):
+    import pydynamo
+    monkeypatch.setattr(pydynamo, 'bz2_stream_size', 5000)
+    monkeypatch.setattr(pydynamo.XMLFile, 'compression_threads', 4)
+    data = bz2_test_data()
+    compressed = pydynamo.compress_bz2_parallel(data)
+    offsets = pydynamo.bz2_stream_offsets(compressed)
+    #As if a stream header turned up by chance inside the second stream
+    (start, end) = offsets[1]
+    mid = (start + end) // 2
+    false_offsets = offsets[:1] + [(start, mid), (mid, end)] + offsets[2:]
+    reader = pydynamo.ParallelBZ2Reader(compressed, false_offsets, threads=4)
+    import io
+    assert io.BufferedReader(reader).read() == data
+
+def codec_available(codec):
+    module = {'zstd':'zstandard', 'lz4':'lz4.frame'}.get(codec)
+    if module is None:
+        return True
+    import importlib
+    try:
+        importlib.import_module(module)
+        return True
+    except ImportError:
+        return False
+
+@pytest.mark.parametrize('codec', ['bz2', 'gzip', 'zstd', 'lz4', 'none'])
+def test_codec_round_trip(tmp_path, codec, monkeypatch):
+    import pydynamo
+    if not codec_available(codec):
+        pytest.skip('The module for the '+codec+' codec is not installed')
+    monkeypatch.setattr(pydynamo.XMLFile, 'use_cache', False)
+    source = str(tmp_path / 'source.config.xml')
+    make_config(source, 20)
+    filename = pydynamo.xmlfile_name(str(tmp_path / '0.config'), codec)
+    assert pydynamo.codec_from_extension(filename) == codec
+    pydynamo.ConfigFile(source).save(filename)
+    assert pydynamo.detect_codec(filename) == codec
+    assert pydynamo.find_xmlfile(str(tmp_path / '0.config')) == filename
+    assert pydynamo.validate_configfile(filename)
+    config = pydynamo.ConfigFile(filename)
+    assert config.N() == 20
+    assert np.array_equal(config.particles()['P'], pydynamo.ConfigFile(source).particles()['P'])
+    #A truncated file fails validation
+    with open(filename, 'rb') as f:
+        data = f.read()
+    broken = str(tmp_path / ('broken' + pydynamo.xml_codecs[codec]['ext']))
+    with open(broken, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    assert not pydynamo.validate_configfile(broken)
+
+def test_manifest_validation(tmp_path, monkeypatch):
+    import pydynamo
+    filename = str(tmp_path / '0.config.xml')
+    make_config(filename, 10)
+    assert not pydynamo.check_manifest(filename)
+    #The first validation fully parses the file, then records it
+    assert pydynamo.validate_configfile(filename)
+    entry = pydynamo.read_manifest(str(tmp_path))['0.config.xml']
+    assert entry['size'] == os.path.getsize(filename)
+    assert pydynamo.check_manifest(filename)
+    #Later validations only need the checksum
+    class NoParse:
+        def parse(self, f):
+            raise AssertionError('Parsed a file already in the manifest')
+    monkeypatch.setattr(pydynamo, 'ET', NoParse())
+    assert pydynamo.validate_configfile(filename)
+    monkeypatch.undo()
+    #A changed file no longer matches, and is parsed again
+    with open(filename, 'r+b') as f:
+        f.truncate(os.path.getsize(filename) - 20)
+    assert not pydynamo.check_manifest(filename)
+    assert not pydynamo.validate_configfile(filename)
+    #A forced full parse ignores the manifest
+    make_config(filename, 10)
+    pydynamo.record_manifest(filename)
+    with open(filename, 'r+b') as f:
+        f.seek(-10, os.SEEK_END)
+        f.write(b'##########')
+    pydynamo.record_manifest(filename)
+    assert pydynamo.validate_xmlfile(filename)
+    assert not pydynamo.validate_xmlfile(filename, full_parse=True)
+
+def test_output_file_selective(tmp_path):
+    import pydynamo
+    filename = str(tmp_path / 'data.xml')
+    with open(filename, 'w') as f:
+        f.write('<OutputData><Misc><ParticleCount val="4"/><Duration Events="10" Time="2.5"/>'
+                '<Density val="0.5"/></Misc><VACF><Particles><Species Name="A">1 2\n3 4\n</Species>'
+                '</Particles></VACF><Big><Blob Name="B">' + '9 ' * 1000 + '</Blob></Big></OutputData>')
+    of = pydynamo.OutputFile(filename, paths=['.//VACF'])
+    assert of.N() == 4 and of.events() == 10 and of.t() == 2.5 and of.numdensity() == 0.5
+    species = of.findall('.//VACF/Particles/Species')
+    assert [tag.attrib['Name'] for tag in species] == ['A']
+    assert np.array_equal(pydynamo.parseToArray(species[0].text), [[1, 2], [3, 4]])
+    #Only the requested subtrees were built, but find() still sees every tag
+    assert of.tree.getroot().find('.//Blob') is None
+    assert of.find('.//Big/Blob').attrib['Name'] == 'B'
+    #Queries outside the paths, and saving the partial tree, are refused
+    with pytest.raises(RuntimeError):
+        of.findall('.//Big/Blob')
+    with pytest.raises(RuntimeError):
+        of.save(str(tmp_path / 'copy.xml'))
+    #Without paths the whole file is available
+    full = pydynamo.OutputFile(filename)
+    assert full.findall('.//Big/Blob')[0].text.split()[0] == '9'
+    full.save(str(tmp_path / 'copy.xml'))
+    assert pydynamo.OutputFile(str(tmp_path / 'copy.xml')).findall('.//Blob')[0].attrib['Name'] == 'B'
+
+def test_parse_to_array():
+    from pydynamo import parseToArray
+    text = '\n  0 1.5 2e-3\n\n1 -2.5 4E+1\n  \n'
+    assert np.array_equal(parseToArray(text), [[0, 1.5, 2e-3], [1, -2.5, 40]])
+    #A single row or column is still 2D
+    assert parseToArray('1 2 3').shape == (1, 3)
+    assert parseToArray('1\n2\n3').shape == (3, 1)
+    #Empty nodes
+    assert parseToArray(None).shape == (0, 0)
+    assert parseToArray(' \n ').shape == (0, 0)
+    #Ragged tables fall back to the line by line parse, dropping short rows
+    assert np.array_equal(parseToArray('1 2\n3\n4 5', min_columns=2), [[1, 2], [4, 5]])
+    assert np.array_equal(parseToArray('1 2\n3 4', min_columns=3), np.empty((0,)))
+
+def test_query_cache():
+    import pydynamo
+    root = pydynamo.ET.fromstring('<Root><A Name="x"><B v="1"/><B v="2"/></A><C><A Name="y"><B v="3"/></A></C>'
+                                  '<Entry Name="SOCells" Count="5"/><Entry Name="Other" Count="6"/></Root>')
+    tree = pydynamo.ET.ElementTree(root)
+    cache = pydynamo.QueryCache(tree)
+    #The indexed queries agree with ElementTree's own search
+    for path in ['.//A', './/A/B', './/B', './/Entry[@Name="SOCells"]', './/C/A/B', './/Missing', 'C/A']:
+        assert cache.findall(path) == tree.findall(path), path
+    assert cache.find('.//Entry[@Name="Other"]').attrib['Count'] == '6'
+    assert cache.find('.//Missing') is None
+    #Results are memoized
+    assert cache.findall('.//A/B') is cache.findall('.//A/B')
+
+def test_config_N_from_header(tmp_path, monkeypatch):
+    import pydynamo
+    monkeypatch.setattr(pydynamo.XMLFile, 'use_cache', False)
+    filename = str(tmp_path / 'start.config.xml')
+    make_config(filename, 30)
+    #Even without header_only, N() comes from the header rather than the particles
+    def no_particles(filename):
+        raise AssertionError('Read the particles of '+filename)
+    monkeypatch.setattr(pydynamo, 'load_particle_arrays', no_particles)
+    config = pydynamo.ConfigFile(filename)
+    assert config.N() == 30
+    assert config.n() == 30 / (10 * 11 * 12)
+    monkeypatch.undo()
+    #Configs without the particle count fall back to counting the particles
+    monkeypatch.setattr(pydynamo.XMLFile, 'use_cache', False)
+    make_config(filename, 30, withN=False)
+    assert pydynamo.ConfigFile(filename).N() == 30
+    assert pydynamo.ConfigFile(filename, header_only=True).N() == 30
+
+def write_block_files(dirname, counter, pressure):
+    """Writes the config/data files of a block, returning its record"""
+    make_config(os.path.join(dirname, str(counter)+'.config.xml'), 10)
+    with open(os.path.join(dirname, str(counter)+'.data.xml'), 'w') as f:
+        f.write('<OutputData><Misc><ParticleCount val="10"/><Duration Events="100" Time="1.0"/><Density val="0.1"/>'
+                '<Pressure Avg="%r"/></Misc></OutputData>' % pressure)
+    block = make_block(counter, checksum=str(pressure))
+    for key in ('config', 'data'):
+        block[key+'_size'] = os.path.getsize(os.path.join(dirname, block[key]))
+    return block
+
+def test_perdir_resumes_partial_reduction(tmp_path, monkeypatch):
+    import pydynamo, pickle, types
+    monkeypatch.setattr(pydynamo.XMLFile, 'use_cache', False)
+    os.mkdir(str(tmp_path / 'run_0'))
+    blocks = [write_block_files(str(tmp_path / 'run_0'), i, float(i)) for i in range(5)]
+    manager = types.SimpleNamespace(workdir=str(tmp_path), outputs=['p'])
+    manager.output_paths = lambda: pydynamo.SimManager.output_paths(manager)
+    state = (('N', 10),)
+    key = 'k'
+    #The first block (100 events of 10 particles) is the equilibration
+    def reduce(blocks, reduction=None):
+        resume = (0, None, '') if reduction is None else (reduction['executed_events'], reduction['value'], reduction['digest'])
+        return pydynamo.perdir(('run_0', 10, manager, state, blocks) + resume + (key,))
+    result, full = reduce(blocks)
+    assert result[state]['p'].avg() == 2.5
+    assert result[state]['NEventsTot'] == 400
+    assert [counter for counter, name, value in full['properties']] == [1, 2, 3, 4]
+    assert full['reduction']['blocks'] == 5
+    assert full['reduction']['digest'] == pydynamo.blocks_digest(blocks)
+    #Resuming a partial reduction only processes the new blocks, and gives the same result
+    db = pydynamo.RunDB(str(tmp_path))
+    db.record(reduce(blocks[:2])[1])
+    partial = db.reduction('run_0', key)
+    assert partial['blocks'] == 2 and partial['digest'] == pydynamo.blocks_digest(blocks[:2])
+    result, resumed = reduce(blocks[2:], partial)
+    assert [counter for counter, name, value in resumed['properties']] == [2, 3, 4]
+    assert result[state]['p'].avg() == 2.5 and result[state]['NEventsTot'] == 400
+    assert resumed['reduction']['digest'] == full['reduction']['digest']
+    #A rerun block changes the digest, invalidating the partial
+    assert pydynamo.blocks_digest([blocks[0], make_block(1, 'other')]) != partial['digest']
+    #Missing files end the reduction at the last intact block
+    os.remove(str(tmp_path / 'run_0' / '3.data.xml'))
+    result, record = reduce(blocks)
+    assert record['reduction']['blocks'] == 3 and result[state]['p'].avg() == 1.5
+
+def make_manager(tmp_path, monkeypatch, statevars, executor, **kwargs):
+    """A SimManager (with fake dynamod/dynarun on the path) running on executor"""
+    import pydynamo
+    bindir = tmp_path / 'bin'
+    bindir.mkdir(exist_ok=True)
+    for name in ('dynamod', 'dynarun'):
+        (bindir / name).write_text('#!/bin/sh\nexit 1\n')
+        (bindir / name).chmod(0o755)
+    monkeypatch.setenv('PATH', str(bindir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.chdir(tmp_path)
+    #drain_queue (see the queue executor tests) marks this process as a job
+    monkeypatch.delenv(pydynamo.job_env, raising=False)
+    return pydynamo.SimManager(str(tmp_path / 'work'), statevars, ['p'], codec='none', executor=executor, **kwargs)
+
+def fake_worker(state, workdir, outputplugins, particle_equil_events, particle_run_events, particle_run_events_block_size, setup_worker, codec, checkpoint_events,
+                warm_source, warm_equil_events, known_blocks):
+    """Stands in for worker, "running" the blocks of the chain not in known_blocks"""
+    counters = range(int(round(particle_run_events / particle_run_events_block_size)) + 1)
+    return {'dir':os.path.basename(workdir), 'state':state, 'blocks':[make_block(counter) for counter in counters if counter not in known_blocks]}
+
+def test_run_dispatches_chains_from_callbacks(tmp_path, monkeypatch):
+    import pydynamo, threading, time
+    started = []
+    lock = threading.Lock()
+    def worker(*args):
+        with lock:
+            started.append((os.path.basename(args[1]), args[4], 'start'))
+        time.sleep(0.01)
+        record = fake_worker(*args)
+        with lock:
+            started.append((os.path.basename(args[1]), args[4], 'end'))
+        return record
+    monkeypatch.setattr(pydynamo, 'worker', worker)
+    executor = pydynamo.ThreadExecutor(slots=2)
+    manager = make_manager(tmp_path, monkeypatch, [[('N', [10, 20, 30])]], executor)
+    manager.run(None, 1, 3, 1)
+    #Every block of every chain ran once, each only after the block before it finished
+    assert sorted(manager.db.dirs()) == sorted(os.path.basename(manager.getstatedir(state, 0)) for state in manager.states)
+    for d in manager.db.dirs():
+        assert [block['counter'] for block in manager.db.blocks(d)] == [0, 1, 2, 3]
+        events = [(run_events, kind) for dirname, run_events, kind in started if dirname == d]
+        assert events == [(1, 'start'), (1, 'end'), (2, 'start'), (2, 'end'), (3, 'start'), (3, 'end')]
+    #The threads ran the chains side by side
+    assert max(sum(1 if kind == 'start' else -1 for _, _, kind in started[:i]) for i in range(len(started))) == 2
+    assert executor._pool is None
+
+def test_refine_splits_the_worst_intervals(tmp_path, monkeypatch):
+    import pandas as pd
+    manager = make_manager(tmp_path, monkeypatch, [[('N', [10]), ('kT', [0.0, 1.0, 2.0, 3.0, 4.0])]], executor=None)
+    #p has a kink at kT=2, so the intervals either side of it are the worst
+    runs = []
+    manager.run = lambda *args, **kwargs: runs.append(sorted(dict(state)['kT'] for state in manager.states))
+    def fetch_data(particle_equil_events, only_current_statevars=False):
+        return pd.DataFrame([dict(state, p=10 * max(0, dict(state)['kT'] - 2)) for state in manager.states])
+    manager.fetch_data = fetch_data
+    df = manager.refine(None, 1, 3, 1, 'p', 'kT', max_points=7, points_per_round=2, tolerance=0.1)
+    assert runs == [[0, 1, 2, 3, 4], [0, 1, 1.5, 2, 2.5, 3, 4]]
+    assert sorted(df['kT']) == [0, 1, 1.5, 2, 2.5, 3, 4]
+    #Integer variables are only refined at integer midpoints
+    manager.statevars = [[('N', [10, 13, 20]), ('kT', [1.0])]]
+    manager.states = manager.iterate_state(manager.statevars)
+    manager.fetch_data = lambda particle_equil_events, only_current_statevars=False: pd.DataFrame([dict(state, p=dict(state)['N'] ** 2) for state in manager.states])
+    manager.refine(None, 1, 3, 1, 'p', 'N', max_points=4)
+    assert sorted(dict(state)['N'] for state in manager.states) == [10, 13, 16, 20]
+    #A straight line has no interval above the tolerance
+    manager.statevars = [[('N', [10]), ('kT', [0.0, 1.0, 2.0])]]
+    manager.states = manager.iterate_state(manager.statevars)
+    fetch = lambda particle_equil_events, only_current_statevars=False: pd.DataFrame([dict(state, p=dict(state)['kT']) for state in manager.states])
+    manager.fetch_data = fetch
+    runs.clear()
+    manager.refine(None, 1, 3, 1, 'p', 'kT', max_points=10, tolerance=0.1)
+    assert runs == [[0, 1, 2]]
+    with pytest.raises(RuntimeError):
+        manager.refine(None, 1, 3, 1, 'p', 'ndensity', max_points=10)
+
+def test_warm_start_source_is_nearest_finished_state(tmp_path, monkeypatch):
+    import pydynamo
+    manager = make_manager(tmp_path, monkeypatch, [[('N', [10]), ('ndensity', [0.5])]], executor=None)
+    def finished(statevars, counters=(0, 1)):
+        state = pydynamo.make_state(statevars)[1]
+        d = os.path.basename(manager.getstatedir(state, 0))
+        os.makedirs(os.path.join(manager.workdir, d))
+        manager.db.record({'dir':d, 'state':state, 'blocks':[write_block_files(os.path.join(manager.workdir, d), counter, 1.0) for counter in counters]})
+        return os.path.join(manager.workdir, d, str(counters[-1])+'.config.xml')
+    low = finished({'N':10, 'ndensity':0.5})
+    high = finished({'N':10, 'ndensity':1.0})
+    #Not finished (only equilibrated), or differing in more than the density
+    finished({'N':10, 'ndensity':0.7}, counters=(0,))
+    finished({'N':20, 'ndensity':0.7})
+    assert manager.warm_start_source((('N', 10), ('ndensity', 0.6))) == low
+    assert manager.warm_start_source((('N', 10), ('ndensity', 0.9))) == high
+    #Restarts take different neighbours when they are equally near
+    assert {manager.warm_start_source((('N', 10), ('ndensity', 0.75)), restart) for restart in (0, 1)} == {low, high}
+    assert manager.warm_start_source((('N', 30), ('ndensity', 0.6))) is None
+    assert manager.warm_start_source((('N', 10), ('kT', 1.0))) is None
+
+def test_warm_start_config(tmp_path, monkeypatch):
+    import pydynamo
+    monkeypatch.setattr(pydynamo.XMLFile, 'use_cache', False)
+    source = str(tmp_path / 'source.config.xml')
+    make_config(source, 8, x=1.0)
+    density = 8 / (10 * 11 * 12)
+    calls = []
+    monkeypatch.setattr(pydynamo, 'supervised_call', lambda args, logfile, name=None: calls.append(args))
+    startconfig = str(tmp_path / 'start.config.xml')
+    with open(str(tmp_path / 'run.log'), 'w') as logfile:
+        #Halving the density scales the positions and box by 2^(1/3), without dynarun
+        pydynamo.warm_start_config(source, startconfig, (('ndensity', density / 2),), logfile)
+        assert calls == []
+        #Compressing is left to dynarun, as it could overlap particles
+        pydynamo.warm_start_config(source, str(tmp_path / 'dense.config.xml'), (('ndensity', density * 2),), logfile)
+        assert calls[0][:6] == ['dynarun', source, '--engine', '3', '--target-density', repr(density * 2)]
+    config = pydynamo.ConfigFile(startconfig)
+    scale = 2 ** (1.0 / 3)
+    assert np.allclose(config.image_dimensions(), [10 * scale, 11 * scale, 12 * scale])
+    assert np.allclose(config.particles()['P'][3], [3 * scale, scale, 2 * scale])
+    assert np.isclose(config.n(), density / 2)
+
+def test_skip_state_prunes_before_tasks(tmp_path, monkeypatch):
+    import pydynamo, pickle
+    def skip(state):
+        if state['kT'] == 3.0:
+            raise pydynamo.SkipThisPoint()
+        return state['N'] > 10 and state['kT'] > 1.0
+    manager = make_manager(tmp_path, monkeypatch, [[('N', [10, 20]), ('kT', [1.0, 2.0, 3.0])]], pydynamo.ThreadExecutor(slots=2), skip_state=skip)
+    assert sorted(manager.states) == [(('N', 10), ('kT', 1.0)), (('N', 10), ('kT', 2.0)), (('N', 20), ('kT', 1.0))]
+    #No tasks are made for the skipped states
+    monkeypatch.setattr(pydynamo, 'worker', fake_worker)
+    manager.run(None, 1, 2, 1)
+    assert sorted(manager.db.dirs()) == sorted(os.path.basename(manager.getstatedir(state, 0)) for state in manager.states)
+    #The filter stays in this process, so it can be a lambda
+    manager._skip_state = lambda state: False
+    assert '_skip_state' not in pickle.loads(pickle.dumps(manager)).__dict__
+    with pytest.raises(RuntimeError):
+        make_manager(tmp_path, monkeypatch, [[('N', [10])]], None, skip_state=lambda state: True)
+
+def test_journal_fast_path(tmp_path, monkeypatch):
+    import pydynamo, pickle, types
+    monkeypatch.setattr(pydynamo.XMLFile, 'use_cache', False)
+    workdir = str(tmp_path / 'N_10_0')
+    os.mkdir(workdir)
+    state = (('N', 10),)
+    pickle.dump(state, open(os.path.join(workdir, 'state.pkl'), 'wb'))
+    make_config(os.path.join(workdir, 'start.config.xml'), 10)
+    #Each block is 10 particle events
+    blocks = [write_block_files(workdir, counter, float(counter)) for counter in range(3)]
+    for block in blocks:
+        pydynamo.append_journal(workdir, block, block['counter'] * 10)
+    assert pydynamo.read_journal_tail(workdir)['counter'] == 2
+    #The journalled blocks are trusted on their file sizes, nothing is parsed or run
+    def fail(*args, **kwargs):
+        raise AssertionError('Not on the journal fast path')
+    for name in ('validate_outputfile', 'load_particle_arrays', 'supervised_call', 'run_checkpointed'):
+        monkeypatch.setattr(pydynamo, name, fail)
+    record = pydynamo.worker(state, workdir, [], 1, 20, 10, None, codec='none')
+    assert record['dir'] == 'N_10_0' and [block['counter'] for block in record['blocks']] == [0, 1, 2]
+    assert record['blocks'][2]['data_checksum'] == '2.0'
+    manager = types.SimpleNamespace(workdir=str(tmp_path))
+    assert [block['counter'] for block in pydynamo.scan_dir(('N_10_0', manager))['blocks']] == [0, 1, 2]
+    #A long journal is still read from its end, and a torn last line is ignored
+    for counter in range(200):
+        pydynamo.append_journal(workdir, blocks[2], 20)
+    with open(os.path.join(workdir, pydynamo.journal_name), 'a') as f:
+        f.write('{"counter": 3, "da')
+    assert pydynamo.read_journal_tail(workdir) is None
+    assert sorted(pydynamo.read_journal(workdir)) == [0, 1, 2]
+    #A block whose files changed size isn't trusted
+    with open(os.path.join(workdir, pydynamo.journal_name), 'a') as f:
+        f.write('\n')
+    with open(os.path.join(workdir, '2.data.xml'), 'a') as f:
+        f.write(' ')
+    assert pydynamo.journal_record(workdir, state, [])['blocks'][-1]['counter'] == 1
+
+def test_run_retries_then_quarantines(tmp_path, monkeypatch):
+    import pydynamo, collections
+    calls = collections.Counter()
+    transient = [True]
+    def worker(*args):
+        state, workdir = dict(args[0]), args[1]
+        calls[state['N']] += 1
+        if state['N'] == 20 and transient:
+            transient.pop()
+            raise RuntimeError('A transient failure')
+        if state['N'] == 30:
+            #Completes the equilibration, then keeps failing
+            os.makedirs(workdir, exist_ok=True)
+            pydynamo.append_journal(workdir, write_block_files(workdir, 0, 1.0), 0)
+            raise RuntimeError('A persistent failure')
+        return fake_worker(*args)
+    monkeypatch.setattr(pydynamo, 'worker', worker)
+    manager = make_manager(tmp_path, monkeypatch, [[('N', [10, 20, 30])]], pydynamo.ThreadExecutor(slots=2))
+    dirname = lambda N: os.path.basename(manager.getstatedir((('N', N),), 0))
+    with pytest.raises(RuntimeError, match='Parallel execution failed'):
+        manager.run(None, 1, 2, 1, retries=1, retry_delay=0.01)
+    #The transient failure was retried, only the failing chain was abandoned
+    assert calls == {10: 2, 20: 3, 30: 2}
+    assert [block['counter'] for block in manager.db.blocks(dirname(20))] == [0, 1, 2]
+    quarantined = manager.quarantined()
+    assert list(quarantined) == [dirname(30)]
+    assert quarantined[dirname(30)]['attempts'] == 2 and 'A persistent failure' in quarantined[dirname(30)]['error']
+    #The blocks it completed before failing were taken from its journal
+    assert [block['counter'] for block in manager.db.blocks(dirname(30))] == [0]
+    assert os.path.isfile(str(tmp_path / 'error.log'))
+    #Later runs skip it, unless asked to retry it
+    calls.clear()
+    manager.run(None, 1, 2, 1, retries=0)
+    assert calls[30] == 0
+    with pytest.raises(RuntimeError):
+        manager.run(None, 1, 2, 1, retries=0, retry_quarantined=True)
+    assert calls[30] == 1 and list(manager.quarantined()) == [dirname(30)]
+    manager.release()
+    assert manager.quarantined() == {}
+
+def test_supervisor_pins_process(tmp_path):
+    import pydynamo
+    available = os.sched_getaffinity(0)
+    cores = sorted(available)[-1:]
+    #The process is pinned just after it starts, so it waits before checking
+    script = 'import os, time; time.sleep(0.5); print(sorted(os.sched_getaffinity(0)))'
+    with open(str(tmp_path / 'run.log'), 'w') as logfile:
+        pydynamo.supervisor().check_call([sys.executable, '-c', script], logfile, cores=cores)
+    assert (tmp_path / 'run.log').read_text().strip() == str(cores)
+    #Only the child was pinned
+    assert os.sched_getaffinity(0) == available
+
+def test_supervisor_log_keeps_split_characters(tmp_path):
+    import pydynamo
+    #The two bytes of "é" are written (and so read) separately
+    script = ('import sys, time; out = sys.stdout.buffer; out.write(b"caf\\xc3"); out.flush(); time.sleep(0.3);'
+              'out.write(b"\\xa9 \\xff\\n"); out.flush()')
+    with open(str(tmp_path / 'run.log'), 'w', encoding='utf-8') as logfile:
+        pydynamo.supervisor().check_call([sys.executable, '-c', script], logfile)
+    #Invalid bytes are still replaced
+    assert (tmp_path / 'run.log').read_text(encoding='utf-8') == 'café �\n'
+
+def test_run_releases_executor_and_port_on_error(tmp_path, monkeypatch):
+    import pydynamo, socket
+    class BrokenExecutor(pydynamo.Executor):
+        closed = False
+        def submit(self, fn, args, callback, error_callback):
+            raise KeyboardInterrupt()
+        def close(self):
+            self.closed = True
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    executor = BrokenExecutor()
+    manager = make_manager(tmp_path, monkeypatch, [[('N', [10])]], executor, metrics_port=port)
+    with pytest.raises(KeyboardInterrupt):
+        manager.run(None, 1, 2, 1)
+    assert executor.closed
+    #The metrics port was released
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', port))
+    sock.close()
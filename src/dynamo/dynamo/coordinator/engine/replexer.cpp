@@ -64,8 +64,9 @@ namespace dynamo {
     SeqSelect(false),
     nSims(0)
   {
-    if (vm["events"].as<size_t>() != std::numeric_limits<size_t>::max())
-      M_throw() << "You cannot use collisions to control a replica exchange simulation\n"
+    if ((vm["events"].as<size_t>() != std::numeric_limits<size_t>::max())
+	&& (vm["replex-swap-mode"].as<unsigned int>() != NoSwapping))
+      M_throw() << "You cannot use collisions to control a replica exchange simulation (unless swapping is disabled with --replex-swap-mode 0)\n"
 		<< "See the following DynamO issue: https://github.com/toastedcrumpets/DynamO/issues/7\n";
   }
 
@@ -90,11 +91,16 @@ namespace dynamo {
 	postSimInit(Simulations[i]);
       }
 
-    //Ensure we are in the right ensemble for all simulations
-    for (size_t i = nSims; i != 0;)
-      if (dynamic_cast<const dynamo::EnsembleNVT* >(Simulations[--i].ensemble.get()) == NULL)
-	M_throw() << vm["config-file"].as<std::vector<std::string> >()[i]
-		  << " does not have an NVT ensemble";
+    //Without swapping, the simulations are independent and can be
+    //of any kind (e.g., state points batched into one process)
+    if (ReplexMode != NoSwapping)
+      {
+	//Ensure we are in the right ensemble for all simulations
+	for (size_t i = nSims; i != 0;)
+	  if (dynamic_cast<const dynamo::EnsembleNVT* >(Simulations[--i].ensemble.get()) == NULL)
+	    M_throw() << vm["config-file"].as<std::vector<std::string> >()[i]
+		      << " does not have an NVT ensemble";
+      }
 
     //Ensure the types of the simulation Dynamics match
     const Dynamics& dyn0 = *Simulations[0].dynamics;
@@ -108,33 +114,38 @@ namespace dynamo {
 		  << vm["config-file"].as<std::vector<std::string> >()[0];
     }
 
-    //Test a thermostat is available
-    for (size_t i = 0; i < nSims; i++)
-      try {
-	Simulations[i].systems["Thermostat"];
-      } catch (...) {
-	M_throw() << "Could not find the Thermostat for system " << i 
-		  << "\nFilename " << vm["config-file"].as<std::vector<std::string> >()[i];
+    if (ReplexMode != NoSwapping)
+      {
+	//Test a thermostat is available
+	for (size_t i = 0; i < nSims; i++)
+	  try {
+	    Simulations[i].systems["Thermostat"];
+	  } catch (...) {
+	    M_throw() << "Could not find the Thermostat for system " << i 
+		      << "\nFilename " << vm["config-file"].as<std::vector<std::string> >()[i];
+	  }
+
+	for (unsigned int i = 1; i < nSims; i++)
+	  if (Simulations[0].N() != Simulations[i].N())
+	    M_throw() << "Every replica configuration file must have the same number of particles!";
+
+	for (unsigned int i = 0; i < nSims; i++)
+	  if (dynamic_cast<SysAndersen*>(Simulations[i].systems["Thermostat"].get()) == NULL)
+	    M_throw() << "Found a System event called \"Thermostat\" but could not convert it to an Andersen Thermostat";
       }
   
     //Set up the replex organisation
     temperatureList.clear();
 
-    for (unsigned int i = 1; i < nSims; i++)
-      if (Simulations[0].N() != Simulations[i].N())
-	M_throw() << "Every replica configuration file must have the same number of particles!";
-  
     for (unsigned int i = 0; i < nSims; i++)
-      {
-	shared_ptr<System>& sysPtr1 = Simulations[i].systems["Thermostat"];
-	if (dynamic_cast<SysAndersen*>(sysPtr1.get()) == NULL)
-	  M_throw() << "Found a System event called \"Thermostat\" but could not convert it to an Andersen Thermostat";
-
-	temperatureList.push_back
-	  (replexPair(Simulations[i].ensemble->getEnsembleVals()[2], simData(i,Simulations[i].ensemble->getReducedEnsembleVals()[2])));
-      }
+      temperatureList.push_back
+	(replexPair(Simulations[i].ensemble->getEnsembleVals()[2], simData(i,Simulations[i].ensemble->getReducedEnsembleVals()[2])));
   
-    std::sort(temperatureList.begin(), temperatureList.end());  
+    //Without swapping, the simulations are left in the order they
+    //were loaded, so the %ID of their output files is their position
+    //on the command line.
+    if (ReplexMode != NoSwapping)
+      std::sort(temperatureList.begin(), temperatureList.end());  
   
     SimDirection.resize(temperatureList.size(), 0);
     roundtrip.resize(temperatureList.size(), false);
@@ -150,18 +161,12 @@ namespace dynamo {
     if (vm.count("ticker-period"))
       for (size_t i = 0; i < nSims; ++i)
 	{
-	  double tFactor 
-	    = std::sqrt(temperatureList.begin()->second.realTemperature
-			/ Simulations[i].ensemble->getReducedEnsembleVals()[2]); 
-	  Simulations[i].setTickerPeriod(vm["ticker-period"].as<double>() * tFactor);
+	  Simulations[i].setTickerPeriod(vm["ticker-period"].as<double>() * timeFactor(i));
 	}
 
     if (vm.count("snapshot"))
       for (size_t i = 0; i < nSims; ++i)
-	{
-	  double tFactor = std::sqrt(temperatureList.begin()->second.realTemperature / Simulations[i].ensemble->getReducedEnsembleVals()[2]);
-	  dynamic_cast<SysSnapshot &>(*Simulations[i].systems["SnapshotTimer"]).setTickerPeriod(vm["snapshot"].as<double>() * tFactor);
-	}
+	dynamic_cast<SysSnapshot &>(*Simulations[i].systems["SnapshotTimer"]).setTickerPeriod(vm["snapshot"].as<double>() * timeFactor(i));
   }
 
   void
@@ -375,8 +380,7 @@ namespace dynamo {
   {
     _start_time = std::chrono::system_clock::now();
     
-    while (((Simulations[temperatureList.front().second.simID].systemTime / Simulations[temperatureList.front().second.simID].units.unitTime()) < replicaEndTime)
-	   && (Simulations[0].eventCount < vm["events"].as<size_t>()))
+    while (simulationsRunning())
       {
 	if (_SIGTERM)
 	  {
@@ -502,11 +506,7 @@ namespace dynamo {
 		  M_throw() << "Could not find the time halt event error";
 #endif			
 		//Each simulations exchange time is inversly proportional to its temperature
-		double tFactor 
-		  = std::sqrt(temperatureList.begin()->second.realTemperature
-			      / Simulations[i].ensemble->getReducedEnsembleVals()[2]); 
-
-		tmpRef->increasedt(vm["replex-interval"].as<double>() * tFactor);
+		tmpRef->increasedt(vm["replex-interval"].as<double>() * timeFactor(i));
 
 		Simulations[i].ptrScheduler->rebuildSystemEvents();
 
@@ -520,7 +520,8 @@ namespace dynamo {
 	    tasks.reserve(nSims);
 
 	    for (size_t i(0); i < nSims; ++i)
-	      tasks.push_back(std::bind(&Simulation::runSimulation, &static_cast<Simulation&>(Simulations[i]), true));
+	      if (simulationRunning(i))
+		tasks.push_back(std::bind(&Simulation::runSimulation, &static_cast<Simulation&>(Simulations[i]), true));
 
 	    threads.queueTasks(tasks);
             try {
@@ -571,6 +572,42 @@ namespace dynamo {
   _end_time = std::chrono::system_clock::now();
   }
 
+  double
+  EReplicaExchangeSimulation::timeFactor(const size_t id) const
+  {
+    if (ReplexMode == NoSwapping)
+      return 1;
+
+    return std::sqrt(temperatureList.begin()->second.realTemperature
+		     / Simulations[id].ensemble->getReducedEnsembleVals()[2]);
+  }
+
+  bool
+  EReplicaExchangeSimulation::simulationRunning(const size_t id) const
+  {
+    if (ReplexMode != NoSwapping)
+      return true;
+
+    return ((Simulations[id].systemTime / Simulations[id].units.unitTime()) < replicaEndTime)
+      && (Simulations[id].eventCount < vm["events"].as<size_t>());
+  }
+
+  bool
+  EReplicaExchangeSimulation::simulationsRunning() const
+  {
+    if (ReplexMode == NoSwapping)
+      {
+	for (size_t i(0); i < nSims; ++i)
+	  if (simulationRunning(i))
+	    return true;
+	return false;
+      }
+
+    const Simulation& coldest = Simulations[temperatureList.front().second.simID];
+    return ((coldest.systemTime / coldest.units.unitTime()) < replicaEndTime)
+      && (Simulations[0].eventCount < vm["events"].as<size_t>());
+  }
+
   void 
   EReplicaExchangeSimulation::outputConfigs()
   {
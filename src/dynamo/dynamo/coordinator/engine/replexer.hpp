@@ -232,5 +232,24 @@ namespace dynamo {
       \param id2 Second Simulation to attempt to exchange.
      */
     void AttemptSwap(const unsigned int id1, const unsigned int id2);
+
+    /*! \brief The factor the exchange interval of a Simulation is
+      scaled by, to keep the calculation time of each approximately
+      equal.
+     
+      Without swapping, there's no need and every Simulation uses
+      the unscaled interval.
+     */
+    double timeFactor(const size_t id) const;
+
+    /*! \brief If any Simulation has yet to reach its end.
+     
+      Without swapping the Simulations are independent (e.g., several
+      state points batched into one process), so each runs to its own
+      end time/event count. Otherwise they stop when the coldest
+      Simulation reaches the end.
+     */
+    bool simulationRunning(const size_t id) const;
+    bool simulationsRunning() const;
   };
 }
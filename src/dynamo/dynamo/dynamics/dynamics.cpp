@@ -152,7 +152,8 @@ namespace dynamo {
   void 
   Dynamics::outputParticleXMLData(magnet::xml::XmlStream& XML, bool applyBC) const
   {
-    XML << magnet::xml::tag("ParticleData");
+    XML << magnet::xml::tag("ParticleData")
+	<< magnet::xml::attr("N") << Sim->N();
   
     if (hasOrientationData())
       XML << magnet::xml::attr("OrientationData") << "Y";
@@ -254,16 +254,16 @@ namespace dynamo
     
       \param filename The path to the XML file to write (this file
       will either be created or overwritten). The filename must end in
-      either ".xml" (or ".xml.bz2" where bzip2 compressed
-      configuration files are supported).
+      either ".xml" (or ".xml.bz2", ".xml.gz", ".xml.zst", or
+      ".xml.lz4" where compressed configuration files are supported).
     */
     void outputData(std::string filename);
 
     /*! \brief Loads a Simulation from the passed XML file.
 
       \param filename The path to the XML file to load. The filename
-      must end in either ".xml" (or ".xml.bz2" where bzip2 compressed
-      configuration files are supported).
+      must end in either ".xml" (or ".xml.bz2", ".xml.gz", ".xml.zst", or
+      ".xml.lz4" where compressed configuration files are supported).
     */
     void loadXMLfile(std::string filename);
     
@@ -271,8 +271,8 @@ namespace dynamo
 
       \param filename The path to the XML file to write (this file
       will either be created or overwritten). The filename
-      must end in either ".xml" (or ".xml.bz2" where bzip2 compressed
-      configuration files are supported).
+      must end in either ".xml" (or ".xml.bz2", ".xml.gz", ".xml.zst", or
+      ".xml.lz4" where compressed configuration files are supported).
 
       \param round If true, the data in the XML file will be written
       out at 2 s.f. lower precision to round all the values. This is
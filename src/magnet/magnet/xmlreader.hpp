@@ -23,6 +23,17 @@
 #ifdef DYNAMO_bzip2_support
 # include <bzlib.h>
 #endif
+#ifdef DYNAMO_zlib_support
+# include <zlib.h>
+#endif
+#ifdef DYNAMO_zstd_support
+# include <zstd.h>
+#endif
+#ifdef DYNAMO_lz4_support
+# include <lz4frame.h>
+#endif
+#include <cstdio>
+#include <cstring>
 #include <fstream>
 #include <iostream>
 #include <vector>
@@ -31,6 +42,39 @@ namespace magnet {
   //!Namespace enclosing the XML tools included in magnet.
   namespace xml {
     namespace detail {
+      //! \brief The compression formats which can be read.
+      enum Compression { NONE, BZIP2, GZIP, ZSTD, LZ4 };
+
+      /*! \brief Determines the compression of a file from its magic
+          bytes.
+       */
+      inline Compression detectCompression(const std::string& filename) {
+	FILE* f = fopen(filename.c_str(), "rb");
+	if (!f)
+	  M_throw() << "Failed to open " << filename << " for reading." ;
+	unsigned char magic[4] = {0, 0, 0, 0};
+	const size_t n = fread(magic, 1, 4, f);
+	fclose(f);
+
+	if ((n >= 3) && (magic[0] == 'B') && (magic[1] == 'Z') && (magic[2] == 'h'))
+	  return BZIP2;
+	if ((n >= 2) && (magic[0] == 0x1f) && (magic[1] == 0x8b))
+	  return GZIP;
+	if ((n == 4) && (magic[0] == 0x28) && (magic[1] == 0xB5) && (magic[2] == 0x2F) && (magic[3] == 0xFD))
+	  return ZSTD;
+	if ((n == 4) && (magic[0] == 0x04) && (magic[1] == 0x22) && (magic[2] == 0x4D) && (magic[3] == 0x18))
+	  return LZ4;
+	return NONE;
+      }
+
+      //! \brief Reads the raw contents of a file into a string.
+      inline std::string readFile(const std::string& filename) {
+	std::ifstream t(filename, std::ios::binary);
+	if (!t.is_open())
+	  M_throw() << "Failed to open " << filename << " for reading." ;
+	return std::string((std::istreambuf_iterator<char>(t)), std::istreambuf_iterator<char>());
+      }
+
       /*! \brief Generates a string representation of the passed XML
           rapidxml node.
        */
@@ -317,47 +361,24 @@ namespace magnet {
       /*! \brief Decompress (if needed) and parse an XML file. */
       Document(std::string filename) {
 	_data.clear();
-	
-	if (std::string(filename.end() - 4, filename.end()) == ".bz2") {
-#ifdef DYNAMO_bzip2_support
-	  FILE* f = fopen (filename.c_str(), "r");
-	  if (!f) {
-	    M_throw() << "Failed to open " << filename << " for reading." ;
-	  }
-	  int bzerror;
-	  BZFILE* b = BZ2_bzReadOpen(&bzerror, f, 0, 0, NULL, 0);
-	  if (bzerror != BZ_OK) {
-	    BZ2_bzReadClose(&bzerror, b);
-	    fclose(f);
-	    M_throw() << "Failed beginning decompression of " << filename << " for reading." ;
-	  }
-	  char buf[1024 * 10];
-	  bzerror = BZ_OK;
-	  while (bzerror == BZ_OK) {
-	    size_t nBuf = BZ2_bzRead(&bzerror, b, buf, sizeof(buf));
-	    if ((bzerror == BZ_OK) || (bzerror == BZ_STREAM_END))
-	      _data.append(buf, nBuf);
-	  }
-	  
-	  if (bzerror != BZ_STREAM_END ) {
-	    BZ2_bzReadClose (&bzerror, b);
-	    fclose(f);
-	    M_throw() << "Failed while decompressing " << filename << " for reading. (bzerror=" << bzerror << ")";
-	  } else {
-	    BZ2_bzReadClose ( &bzerror, b );
-	    fclose(f);
+
+	//The compression is detected from the magic bytes at the start
+	//of the file, so misnamed files are still read correctly.
+	switch (detail::detectCompression(filename)) {
+	case detail::BZIP2: loadBZ2(filename); break;
+	case detail::GZIP:  loadGZ(filename);  break;
+	case detail::ZSTD:  loadZSTD(filename); break;
+	case detail::LZ4:   loadLZ4(filename); break;
+	default:
+	  {
+	    std::ifstream t(filename);
+	    if (!t.is_open())
+	      M_throw() << "Failed to open " << filename << " for reading." ;
+	    t.seekg(0, std::ios::end);
+	    _data.reserve(t.tellg());
+	    t.seekg(0, std::ios::beg);
+	    _data.assign((std::istreambuf_iterator<char>(t)), std::istreambuf_iterator<char>());
 	  }
-#else
-	  M_throw() << "bz2 compressed file support was not built in! (only available on linux)";
-#endif
-	} else {
-	  std::ifstream t(filename);
-	  if (!t.is_open())
-	    M_throw() << "Failed to open " << filename << " for reading." ;
-	  t.seekg(0, std::ios::end);
-	  _data.reserve(t.tellg());
-	  t.seekg(0, std::ios::beg);
-	  _data.assign((std::istreambuf_iterator<char>(t)), std::istreambuf_iterator<char>());
 	}
 	parseData();
       }
@@ -376,6 +397,144 @@ namespace magnet {
       }
 
     protected:
+      //! \brief Reads a (possibly multi-stream) bz2 compressed file.
+      void loadBZ2(const std::string& filename) {
+#ifdef DYNAMO_bzip2_support
+	  FILE* f = fopen (filename.c_str(), "r");
+	  if (!f) {
+	    M_throw() << "Failed to open " << filename << " for reading." ;
+	  }
+	  //The file may be several bz2 streams concatenated together
+	  //(as written by pbzip2 or XmlStream), so we keep reading
+	  //streams until the file is exhausted.
+	  char unused[BZ_MAX_UNUSED];
+	  int nUnused = 0;
+	  while (true) {
+	    int bzerror;
+	    BZFILE* b = BZ2_bzReadOpen(&bzerror, f, 0, 0, unused, nUnused);
+	    if (bzerror != BZ_OK) {
+	      BZ2_bzReadClose(&bzerror, b);
+	      fclose(f);
+	      M_throw() << "Failed beginning decompression of " << filename << " for reading." ;
+	    }
+	    char buf[1024 * 10];
+	    bzerror = BZ_OK;
+	    while (bzerror == BZ_OK) {
+	      size_t nBuf = BZ2_bzRead(&bzerror, b, buf, sizeof(buf));
+	      if ((bzerror == BZ_OK) || (bzerror == BZ_STREAM_END))
+		_data.append(buf, nBuf);
+	    }
+	    
+	    if (bzerror != BZ_STREAM_END ) {
+	      BZ2_bzReadClose (&bzerror, b);
+	      fclose(f);
+	      M_throw() << "Failed while decompressing " << filename << " for reading. (bzerror=" << bzerror << ")";
+	    }
+
+	    //Carry over any data read past the end of this stream
+	    void* unusedPtr;
+	    BZ2_bzReadGetUnused(&bzerror, b, &unusedPtr, &nUnused);
+	    std::copy(static_cast<char*>(unusedPtr), static_cast<char*>(unusedPtr) + nUnused, unused);
+	    BZ2_bzReadClose(&bzerror, b);
+
+	    if (nUnused == 0) {
+	      const int c = fgetc(f);
+	      if (c == EOF) break;
+	      ungetc(c, f);
+	    }
+	  }
+	  fclose(f);
+#else
+	  M_throw() << "bz2 compressed file support was not built in! (only available on linux)";
+#endif
+      }
+
+      //! \brief Reads a gzip compressed file.
+      void loadGZ(const std::string& filename) {
+#ifdef DYNAMO_zlib_support
+	gzFile f = gzopen(filename.c_str(), "rb");
+	if (!f)
+	  M_throw() << "Failed to open " << filename << " for reading." ;
+	char buf[1024 * 64];
+	int nBuf;
+	while ((nBuf = gzread(f, buf, sizeof(buf))) > 0)
+	  _data.append(buf, nBuf);
+	
+	int errnum;
+	const std::string msg = gzerror(f, &errnum);
+	gzclose(f);
+	if (nBuf < 0)
+	  M_throw() << "Failed while decompressing " << filename << " for reading. (" << msg << ")";
+#else
+	M_throw() << "gzip compressed file support was not built in! (zlib was not found)";
+#endif
+      }
+
+      //! \brief Reads a zstd compressed file.
+      void loadZSTD(const std::string& filename) {
+#ifdef DYNAMO_zstd_support
+	const std::string in = detail::readFile(filename);
+	ZSTD_DStream* stream = ZSTD_createDStream();
+	ZSTD_initDStream(stream);
+	ZSTD_inBuffer input = {in.data(), in.size(), 0};
+	std::vector<char> buf(ZSTD_DStreamOutSize());
+	size_t ret = 0;
+	bool flushed = false;
+	//Keep going until all the input is read and all output flushed
+	while ((input.pos < input.size) || !flushed) {
+	  ZSTD_outBuffer output = {buf.data(), buf.size(), 0};
+	  ret = ZSTD_decompressStream(stream, &output, &input);
+	  if (ZSTD_isError(ret)) {
+	    ZSTD_freeDStream(stream);
+	    M_throw() << "Failed while decompressing " << filename << " for reading. (" << ZSTD_getErrorName(ret) << ")";
+	  }
+	  _data.append(buf.data(), output.pos);
+	  flushed = output.pos < output.size;
+	}
+	ZSTD_freeDStream(stream);
+	if (ret != 0)
+	  M_throw() << "Failed while decompressing " << filename << " for reading. (truncated file)";
+#else
+	M_throw() << "zstd compressed file support was not built in! (libzstd was not found)";
+#endif
+      }
+
+      //! \brief Reads a lz4 (frame format) compressed file.
+      void loadLZ4(const std::string& filename) {
+#ifdef DYNAMO_lz4_support
+	const std::string in = detail::readFile(filename);
+	LZ4F_dctx* dctx;
+	if (LZ4F_isError(LZ4F_createDecompressionContext(&dctx, LZ4F_VERSION)))
+	  M_throw() << "Failed beginning decompression of " << filename << " for reading." ;
+	
+	const char* src = in.data();
+	size_t remaining = in.size();
+	char buf[1024 * 64];
+	while (true) {
+	  size_t dstSize = sizeof(buf);
+	  size_t srcSize = remaining;
+	  const size_t ret = LZ4F_decompress(dctx, buf, &dstSize, src, &srcSize, NULL);
+	  if (LZ4F_isError(ret)) {
+	    LZ4F_freeDecompressionContext(dctx);
+	    M_throw() << "Failed while decompressing " << filename << " for reading. (" << LZ4F_getErrorName(ret) << ")";
+	  }
+	  _data.append(buf, dstSize);
+	  src += srcSize;
+	  remaining -= srcSize;
+	  //ret is zero when a frame is complete, there may be further frames
+	  if ((ret == 0) && (remaining == 0))
+	    break;
+	  if ((remaining == 0) && (dstSize == 0)) {
+	    LZ4F_freeDecompressionContext(dctx);
+	    M_throw() << "Failed while decompressing " << filename << " for reading. (truncated file)";
+	  }
+	}
+	LZ4F_freeDecompressionContext(dctx);
+#else
+	M_throw() << "lz4 compressed file support was not built in! (liblz4 was not found)";
+#endif
+      }
+
       /*! \brief Parse the stored XML data.
        */
       inline void parseData()
@@ -23,9 +23,21 @@
 #include <string>
 #include <sstream>
 #include <fstream>
+#include <vector>
+#include <algorithm>
+#include <thread>
 #ifdef DYNAMO_bzip2_support
 # include <bzlib.h>
-# include <vector>
+# include <future>
+#endif
+#ifdef DYNAMO_zlib_support
+# include <zlib.h>
+#endif
+#ifdef DYNAMO_zstd_support
+# include <zstd.h>
+#endif
+#ifdef DYNAMO_lz4_support
+# include <lz4frame.h>
 #endif
 
 namespace magnet {
@@ -59,19 +71,45 @@ namespace magnet {
 	while (tags.size()) endTag(tags.top());
       }
 
+      /*! \brief Write the stream to a file, compressing it according
+          to the file extension (.bz2, .gz, .zst, .lz4 or none).
+       */
       inline void write_file(std::string filename) {
-	if (std::string(filename.end() - 4, filename.end()) == ".bz2") {
+	if (hasSuffix(filename, ".gz"))
+	  write_gz(filename);
+	else if (hasSuffix(filename, ".zst"))
+	  write_zstd(filename);
+	else if (hasSuffix(filename, ".lz4"))
+	  write_lz4(filename);
+	else if (hasSuffix(filename, ".bz2")) {
 #ifdef DYNAMO_bzip2_support
-	  BZFILE* f = BZ2_bzopen(filename.c_str(), "w");
-	  if (!f)
+	  std::ofstream of(filename, std::ios::binary);
+	  if (!of)
 	    M_throw() << "Failed to open compressed file " << filename << " for writing.";
 
-	  std::vector<char> buf((std::istreambuf_iterator<char>(s)), std::istreambuf_iterator<char>());
+	  const std::string buf = s.str();
+	  //The uncompressed size of each bz2 stream written
+	  const size_t bz2BlockSize = 900000;
 	  
-	  int nWritten = BZ2_bzwrite(f, buf.data(), buf.size());
-	  if (nWritten <= 0)
+	  //The data is compressed in independent blocks, each written
+	  //as its own bz2 stream. This is the same layout as pbzip2
+	  //uses, so the blocks can be compressed (and later
+	  //decompressed) in parallel, while remaining a valid bz2 file.
+	  const size_t nBlocks = std::max(size_t(1), (buf.size() + bz2BlockSize - 1) / bz2BlockSize);
+	  const size_t nThreads = std::max(1u, std::thread::hardware_concurrency());
+	  for (size_t batch(0); batch < nBlocks; batch += nThreads) {
+	    std::vector<std::future<std::vector<char> > > blocks;
+	    for (size_t i(batch); i < std::min(nBlocks, batch + nThreads); ++i)
+	      blocks.push_back(std::async(std::launch::async, compressBZ2Block, buf.data() + i * bz2BlockSize, std::min(bz2BlockSize, buf.size() - i * bz2BlockSize)));
+	    
+	    for (auto& block : blocks) {
+	      const std::vector<char> data = block.get();
+	      of.write(data.data(), data.size());
+	    }
+	  }
+
+	  if (!of)
 	    M_throw() << "Failed to while writing contents of compressed file " << filename << ".";
-	  BZ2_bzclose(f);
 #else
 	  M_throw() << "bz2 compressed file support was not built in! (only available on linux)";
 #endif
@@ -88,6 +126,94 @@ namespace magnet {
       void clear() {
 	s.str("");
       }
+
+      //! \brief Test if a filename ends with the passed extension.
+      static bool hasSuffix(const std::string& filename, const std::string& suffix) {
+	return (filename.size() >= suffix.size()) && std::equal(suffix.rbegin(), suffix.rend(), filename.rbegin());
+      }
+
+      //! \brief Write the stream as a gzip compressed file.
+      inline void write_gz(const std::string& filename) {
+#ifdef DYNAMO_zlib_support
+	gzFile f = gzopen(filename.c_str(), "wb");
+	if (!f)
+	  M_throw() << "Failed to open compressed file " << filename << " for writing.";
+	const std::string buf = s.str();
+	//gzwrite takes an unsigned int length, so write in chunks
+	const size_t chunk = 1 << 30;
+	for (size_t pos(0); pos < buf.size(); pos += chunk) {
+	  const unsigned int len = std::min(chunk, buf.size() - pos);
+	  if (gzwrite(f, buf.data() + pos, len) != int(len)) {
+	    gzclose(f);
+	    M_throw() << "Failed to while writing contents of compressed file " << filename << ".";
+	  }
+	}
+	if (gzclose(f) != Z_OK)
+	  M_throw() << "Failed to while writing contents of compressed file " << filename << ".";
+#else
+	M_throw() << "gzip compressed file support was not built in! (zlib was not found)";
+#endif
+      }
+
+      //! \brief Write the stream as a zstd compressed file.
+      inline void write_zstd(const std::string& filename) {
+#ifdef DYNAMO_zstd_support
+	const std::string buf = s.str();
+	std::vector<char> dest(ZSTD_compressBound(buf.size()));
+	ZSTD_CCtx* cctx = ZSTD_createCCtx();
+	ZSTD_CCtx_setParameter(cctx, ZSTD_c_compressionLevel, 3);
+	//Multithreaded compression is only available if libzstd was
+	//built with it, so errors here are ignored.
+	ZSTD_CCtx_setParameter(cctx, ZSTD_c_nbWorkers, std::thread::hardware_concurrency());
+	const size_t size = ZSTD_compress2(cctx, dest.data(), dest.size(), buf.data(), buf.size());
+	ZSTD_freeCCtx(cctx);
+	if (ZSTD_isError(size))
+	  M_throw() << "Failed while compressing data (" << ZSTD_getErrorName(size) << ")";
+	write_raw(filename, dest.data(), size);
+#else
+	M_throw() << "zstd compressed file support was not built in! (libzstd was not found)";
+#endif
+      }
+
+      //! \brief Write the stream as a lz4 (frame format) compressed file.
+      inline void write_lz4(const std::string& filename) {
+#ifdef DYNAMO_lz4_support
+	const std::string buf = s.str();
+	std::vector<char> dest(LZ4F_compressFrameBound(buf.size(), NULL));
+	const size_t size = LZ4F_compressFrame(dest.data(), dest.size(), buf.data(), buf.size(), NULL);
+	if (LZ4F_isError(size))
+	  M_throw() << "Failed while compressing data (" << LZ4F_getErrorName(size) << ")";
+	write_raw(filename, dest.data(), size);
+#else
+	M_throw() << "lz4 compressed file support was not built in! (liblz4 was not found)";
+#endif
+      }
+
+      //! \brief Write an already compressed buffer to a file.
+      static void write_raw(const std::string& filename, const char* data, size_t size) {
+	std::ofstream of(filename, std::ios::binary);
+	if (!of)
+	  M_throw() << "Failed to open compressed file " << filename << " for writing.";
+	of.write(data, size);
+	if (!of)
+	  M_throw() << "Failed to while writing contents of compressed file " << filename << ".";
+      }
+
+#ifdef DYNAMO_bzip2_support
+      /*! \brief Compresses a block of data into a complete bz2
+          stream.
+       */
+      static std::vector<char> compressBZ2Block(const char* data, size_t size) {
+	//The bz2 documentation guarantees the output fits in 1% + 600 bytes more than the input
+	unsigned int destLen = size + size / 100 + 600;
+	std::vector<char> dest(destLen);
+	int bzerror = BZ2_bzBuffToBuffCompress(dest.data(), &destLen, const_cast<char*>(data), size, 9, 0, 0);
+	if (bzerror != BZ_OK)
+	  M_throw() << "Failed while compressing data (bzerror=" << bzerror << ")";
+	dest.resize(destLen);
+	return dest;
+      }
+#endif
       
       /*! \brief Main insertion operator which changes the state of
         the XmlStream.